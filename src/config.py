@@ -2,6 +2,8 @@ config = {
     "BIRD_LIST": "src/data/lists/BirdList.csv",
     "PENTAD_LIST": "src/data/lists/pentads.csv",
     "PENTAD_LIST_2KM": "src/data/lists/2km_grid.csv",
+    "GRID_2KM_BOUNDING_BOXES": "src/google_ee/assets/grid_2km.csv",
+    "GRID_CACHE_DIR": "src/data/lists/grid_cache",
     "SABAP2_SPECIES_URL": "https://api.birdmap.africa/sabap2/v2/cards/species/info/{}/all/all?format=csv&inclnull=1",
     "SABAP2_DATA_DIR": "src/data/abap2",
     "SABAP2_COMBINED_FILE": "combined_sabap2.feather",
@@ -32,7 +34,7 @@ config = {
     "KAGGLE_EBIRDS_FEATHER": "ebirds-africa.feather",
     "KAGGLE_INAT_DATASET": "manatok/bird-observations",
     "KAGGLE_INAT_CSV": "inat_aves_africa.csv",
-    "KAGGLE_INAT_FEATHER": "inat_aves_africa.csv",
+    "KAGGLE_INAT_FEATHER": "inat_aves_africa.feather",
     "KAGGLE_BIOCLIM_DATASET": "manatok/worldclim",
     "KAGGLE_GOOGLE_EE_DATASET": "manatok/africa-bioclim-google-ee",
     "KAGGLE_AGGREGATE_DATASET": "manatok/african-bird-observations-and-covariates-by-pentad",
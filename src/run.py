@@ -1,14 +1,40 @@
+import os
+
 import click
 
-from .sdm.data_prep.abap import download_saba2_species, download_all, combine
+from .sdm.data_prep.abap import (
+    DEFAULT_DOWNLOAD_WORKERS,
+    DEFAULT_REQUESTS_PER_SECOND,
+    download_saba2_species,
+    download_all,
+    changed_species,
+    combine,
+    combine_changed,
+)
 from .sdm.data_prep.two_km_grid import generate_bounding_box as _generate_bounding_box
+from .sdm.data_prep.grids import PENTAD_GRID, TWO_KM_GRID
+from .sdm.data_prep.alignment import load_alignment
+from .sdm.data_prep.sparse_observations import sparse_file_name
 from .sdm.data_prep.observations import (
     aggregate_by_pentad_and_sabap_ids,
+    apply_observation_delta,
     sum_observations as _sum_observations,
     generate_sabap_species_diff,
 )
+from .sdm.data_prep.occurrences import convert_occurrences, occurrence_file
 from .config import config
+from .sdm.data_prep.covariate_scaler import DEFAULT_CHUNK_ROWS
+from .sdm.data_prep.covariate_reduction import (
+    CORRELATION_METHOD,
+    DEFAULT_CORRELATION_THRESHOLD,
+    DEFAULT_EXPLAINED_VARIANCE,
+    REDUCTION_METHODS,
+    check_reduction,
+    reduce_covariates as _reduce_covariates,
+    reduced_file_name,
+)
 from .sdm.data_prep.covariates import (
+    DEFAULT_READ_WORKERS,
     combine_bioclim as _combine_bioclim,
     combine_google_ee_covariates as _combine_google_ee_covariates,
     combine_and_scale_all_covariates,
@@ -21,6 +47,7 @@ from .sdm.data_prep.utils import (
 from .sdm.stats import get_stats
 
 from .sdm.models.runner import train_and_predict, train_and_predict_all
+from .sdm.models.benchmark import benchmark_covariates
 from .sdm.data_prep.birdlasser import combine_birdlasser_files
 
 
@@ -30,6 +57,15 @@ def cli():
     pass
 
 
+def _check_pentad_keys(use_2km_pentad: bool, pentad_keys: bool):
+    """The 2km grid ids are not pentads, so they have no pentad key"""
+    if use_2km_pentad and pentad_keys:
+        raise click.UsageError(
+            "--pentad_keys can not be used with --use_2km_pentad, the 2km "
+            "grid ids have no pentad key"
+        )
+
+
 @cli.command()
 @click.option(
     "--sabap2_id",
@@ -52,41 +88,139 @@ def download_sabap2_species(sabap2_id: int):
 )
 @click.option(
     "--combine",
+    "combine_files",
     required=False,
     help="Combine all files into a single file after downloading. This will need to happen at some point.",
 )
-def download_sabap2(overwrite: bool = False, combine: bool = True):
-    """Method to download all species files from SABA2 and combine them into a single file"""
+@click.option(
+    "--workers",
+    type=int,
+    default=DEFAULT_DOWNLOAD_WORKERS,
+    help="Number of species files downloaded at the same time.",
+)
+@click.option(
+    "--requests_per_second",
+    type=float,
+    default=DEFAULT_REQUESTS_PER_SECOND,
+    help="Maximum number of requests started per second.",
+)
+@click.option(
+    "--refresh",
+    is_flag=True,
+    help="Check the downloaded species for changes with conditional requests and only fetch the ones that changed.",
+)
+@click.option(
+    "--combine_workers",
+    type=int,
+    default=1,
+    help="Number of processes used to parse the species files when combining.",
+)
+def download_sabap2(
+    overwrite: bool = False,
+    combine_files: bool = True,
+    workers: int = DEFAULT_DOWNLOAD_WORKERS,
+    requests_per_second: float = DEFAULT_REQUESTS_PER_SECOND,
+    refresh: bool = False,
+    combine_workers: int = 1,
+):
+    """Method to download all species files from SABA2 and combine them into a single file.
+    Interrupted downloads continue where they stopped when run again."""
     make_dir_if_not_exists(config["SABAP2_DATA_DIR"])
-    download_all(config["BIRD_LIST"], overwrite)
+    download_all(
+        config["BIRD_LIST"],
+        config["SABAP2_DATA_DIR"],
+        config["SABAP2_SPECIES_URL"],
+        overwrite,
+        workers,
+        requests_per_second,
+        refresh,
+    )
 
-    if combine:
-        combine(
-            config["SABAP2_DATA_DIR"],
-            config["PENTAD_LIST"],
-            config["AGGREGATE_DIR"],
-            config["SABAP2_COMBINED_FILE"],
+    if combine_files:
+        combined_path = os.path.join(
+            config["AGGREGATE_DIR"], config["SABAP2_COMBINED_FILE"]
         )
 
+        if refresh and os.path.exists(combined_path):
+            # Only the species that changed since the last combine (including
+            # in earlier downloads) need to be combined again
+            combine_changed(
+                config["SABAP2_DATA_DIR"],
+                config["AGGREGATE_DIR"],
+                config["SABAP2_COMBINED_FILE"],
+                changed_species(config["SABAP2_DATA_DIR"]) or [],
+                workers=combine_workers,
+            )
+        else:
+            combine(
+                config["SABAP2_DATA_DIR"],
+                PENTAD_GRID,
+                config["AGGREGATE_DIR"],
+                config["SABAP2_COMBINED_FILE"],
+                workers=combine_workers,
+            )
+
 
 @cli.command()
-def combine_sabap2():
+@click.option(
+    "--pentad_keys",
+    is_flag=True,
+    help="Also store the integer pentad_key column in the output file.",
+)
+@click.option(
+    "--changed_only",
+    is_flag=True,
+    help="Only update the species whose files changed since the combined file was written.",
+)
+@click.option(
+    "--workers",
+    type=int,
+    default=1,
+    help="Number of processes used to parse the species files.",
+)
+def combine_sabap2(
+    pentad_keys: bool = False, changed_only: bool = False, workers: int = 1
+):
     """Combine all of the datasets into observations per dataset"""
+    changed = changed_species(config["SABAP2_DATA_DIR"])
+    combined_path = os.path.join(config["AGGREGATE_DIR"], config["SABAP2_COMBINED_FILE"])
+
+    # Without a combined file to update every species is combined
+    if changed_only and changed is not None and os.path.exists(combined_path):
+        combine_changed(
+            config["SABAP2_DATA_DIR"],
+            config["AGGREGATE_DIR"],
+            config["SABAP2_COMBINED_FILE"],
+            changed,
+            workers=workers,
+            store_pentad_key=pentad_keys,
+        )
+        return
+
     combine(
         config["SABAP2_DATA_DIR"],
-        config["PENTAD_LIST"],
+        PENTAD_GRID,
         config["AGGREGATE_DIR"],
         config["SABAP2_COMBINED_FILE"],
+        pentad_keys,
+        workers,
     )
 
 @cli.command()
-def combine_birdlasser():
+@click.option(
+    "--workers",
+    type=int,
+    default=1,
+    help="Number of processes used to parse the species files.",
+)
+def combine_birdlasser(workers: int = 1):
     """Combine all of the datasets into observations per dataset"""
     combine_birdlasser_files(
         config["BIRDLASSER_DATA_DIR"],
-        config["PENTAD_LIST_2KM"],
+        TWO_KM_GRID,
         config["AGGREGATE_DIR_2KM"],
         config["BIRDLASSER_COMBINED_FILE"],
+        workers,
     )
 
 
@@ -115,36 +249,83 @@ def generate_sabap_ebirds_diff():
     eBirds_SABAP_mappings.csv file into the BirdList.csv file and the
     empty cell filled in where possible."""
     generate_sabap_species_diff(
-        config["EBIRDS_DIR"], config["KAGGLE_EBIRDS_CSV"], config["BIRD_LIST"], "ebirds"
+        config["EBIRDS_DIR"],
+        occurrence_file(
+            config["EBIRDS_DIR"],
+            config["KAGGLE_EBIRDS_CSV"],
+            config["KAGGLE_EBIRDS_FEATHER"],
+        ),
+        config["BIRD_LIST"],
+        "ebirds",
     )
 
 
 @cli.command()
 @click.option("--use_2km_pentad", required=False, help="To rather use 2km pentad instead of 5' pentad.")
-def aggregate_ebirds(use_2km_pentad: bool = False):
+@click.option(
+    "--pentad_keys",
+    is_flag=True,
+    help="Also store the integer pentad_key column in the output file (not with --use_2km_pentad).",
+)
+@click.option(
+    "--workers",
+    type=int,
+    default=1,
+    help="Number of processes used to parse and group the file.",
+)
+@click.option(
+    "--delta",
+    type=click.Path(exists=True, dir_okay=False),
+    required=False,
+    help="Add the new occurrences in this file (CSV or Feather) to the existing aggregate instead of rebuilding it.",
+)
+def aggregate_ebirds(
+    use_2km_pentad: bool = False,
+    pentad_keys: bool = False,
+    workers: int = 1,
+    delta: str = None,
+):
     """Once the BirdList.csv file has been populated with the EBIRDS_name
     column this method can be run to generate a pentad x SABAP2_species_id
     file"""
+    _check_pentad_keys(use_2km_pentad, pentad_keys)
 
     ebirds_aggregate_file = config["EBIRDS_AGGREGATE_FILE"]
-    pentad_list = config["PENTAD_LIST"]
+    grid_name = PENTAD_GRID
     aggregate_dir = config["AGGREGATE_DIR"]
 
     if use_2km_pentad:
         print("Using 2km pentad instead of 5' pentad")
         ebirds_aggregate_file = config["EBIRDS_AGGREGATE_FILE_2KM"]
-        pentad_list = config["PENTAD_LIST_2KM"]
+        grid_name = TWO_KM_GRID
         aggregate_dir = config["AGGREGATE_DIR_2KM"]
 
+    if delta:
+        apply_observation_delta(
+            delta,
+            ebirds_aggregate_file,
+            config["BIRD_LIST"],
+            grid_name,
+            aggregate_dir,
+            "ebirds_name",
+            workers,
+        )
+        return
+
     aggregate_by_pentad_and_sabap_ids(
         config["EBIRDS_DIR"],
-        config["KAGGLE_EBIRDS_CSV"],
+        occurrence_file(
+            config["EBIRDS_DIR"],
+            config["KAGGLE_EBIRDS_CSV"],
+            config["KAGGLE_EBIRDS_FEATHER"],
+        ),
         ebirds_aggregate_file,
         config["BIRD_LIST"],
-        pentad_list,
+        grid_name,
         aggregate_dir,
         "ebirds_name",
-        use_2km_pentad
+        pentad_keys,
+        workers,
     )
 
 
@@ -164,6 +345,35 @@ def download_inat_csv(overwrite: bool = False):
     )
 
 
+@cli.command()
+@click.option(
+    "--dataset",
+    type=click.Choice(["ebirds", "inat"]),
+    required=False,
+    help="Only convert this dataset. Both are converted by default.",
+)
+def convert_raw(dataset: str = None):
+    """Convert the downloaded eBirds and iNaturalist CSV files into Feather
+    files holding only the columns that are used. Once converted, the diff
+    and aggregate commands read the Feather files instead of the CSVs."""
+    datasets = {
+        "ebirds": (
+            config["EBIRDS_DIR"],
+            config["KAGGLE_EBIRDS_CSV"],
+            config["KAGGLE_EBIRDS_FEATHER"],
+        ),
+        "inat": (
+            config["INAT_DIR"],
+            config["KAGGLE_INAT_CSV"],
+            config["KAGGLE_INAT_FEATHER"],
+        ),
+    }
+
+    for name, (input_data_path, csv_file, feather_file) in datasets.items():
+        if dataset is None or dataset == name:
+            convert_occurrences(input_data_path, csv_file, feather_file)
+
+
 @cli.command()
 def generate_sabap_inat_diff():
     """This will load up the reference bird list and join it to the
@@ -173,40 +383,89 @@ def generate_sabap_inat_diff():
     inat_SABAP_mappings.csv file into the BirdList.csv file and the
     empty cell filled in where possible."""
     generate_sabap_species_diff(
-        config["INAT_DIR"], config["KAGGLE_INAT_CSV"], config["BIRD_LIST"], "inat"
+        config["INAT_DIR"],
+        occurrence_file(
+            config["INAT_DIR"], config["KAGGLE_INAT_CSV"], config["KAGGLE_INAT_FEATHER"]
+        ),
+        config["BIRD_LIST"],
+        "inat",
     )
 
 
 @cli.command()
 @click.option("--use_2km_pentad", required=False, help="To rather use 2km pentad instead of 5' pentad.")
-def aggregate_inat(use_2km_pentad: bool = False):
+@click.option(
+    "--pentad_keys",
+    is_flag=True,
+    help="Also store the integer pentad_key column in the output file (not with --use_2km_pentad).",
+)
+@click.option(
+    "--workers",
+    type=int,
+    default=1,
+    help="Number of processes used to parse and group the file.",
+)
+@click.option(
+    "--delta",
+    type=click.Path(exists=True, dir_okay=False),
+    required=False,
+    help="Add the new occurrences in this file (CSV or Feather) to the existing aggregate instead of rebuilding it.",
+)
+def aggregate_inat(
+    use_2km_pentad: bool = False,
+    pentad_keys: bool = False,
+    workers: int = 1,
+    delta: str = None,
+):
     """Once the BirdList.csv file has been populated with the inat_name
     column this method can be run to generate a pentad x SABAP2_species_id
     file"""
+    _check_pentad_keys(use_2km_pentad, pentad_keys)
+
     inat_aggregate_file = config["INAT_AGGREGATE_FILE"]
-    pentad_list = config["PENTAD_LIST"]
+    grid_name = PENTAD_GRID
     aggregate_dir = config["AGGREGATE_DIR"]
 
     if use_2km_pentad:
         print("Using 2km pentad instead of 5' pentad")
         inat_aggregate_file = config["INAT_AGGREGATE_FILE_2KM"]
-        pentad_list = config["PENTAD_LIST_2KM"]
+        grid_name = TWO_KM_GRID
         aggregate_dir = config["AGGREGATE_DIR_2KM"]
 
+    if delta:
+        apply_observation_delta(
+            delta,
+            inat_aggregate_file,
+            config["BIRD_LIST"],
+            grid_name,
+            aggregate_dir,
+            "inat_name",
+            workers,
+        )
+        return
+
     aggregate_by_pentad_and_sabap_ids(
         config["INAT_DIR"],
-        config["KAGGLE_INAT_CSV"],
+        occurrence_file(
+            config["INAT_DIR"], config["KAGGLE_INAT_CSV"], config["KAGGLE_INAT_FEATHER"]
+        ),
         inat_aggregate_file,
         config["BIRD_LIST"],
-        pentad_list,
+        grid_name,
         aggregate_dir,
         "inat_name",
-        use_2km_pentad,
+        pentad_keys,
+        workers,
     )
 
 
 @cli.command()
-def sum_observations():
+@click.option(
+    "--sparse",
+    is_flag=True,
+    help="Also save the observation files as sparse matrices (.npz).",
+)
+def sum_observations(sparse: bool = False):
     """
     Sums and combines the observation files. The iNat + SABAP2 files are
     combined into a single verified observation file, while the eBirds file
@@ -222,11 +481,17 @@ def sum_observations():
         [config["EBIRDS_AGGREGATE_FILE"]],
         config["VERIFIED_OBSERVATIONS_FILE"],
         config["UNVERIFIED_OBSERVATIONS_FILE"],
+        sparse,
     )
 
 
 @cli.command()
-def sum_2km_observations():
+@click.option(
+    "--sparse",
+    is_flag=True,
+    help="Also save the observation files as sparse matrices (.npz).",
+)
+def sum_2km_observations(sparse: bool = False):
     """
     Sums and combines the observation files. The Birdlasser data is used as
     the verified observation file, while the eBirds + iNat files
@@ -241,6 +506,7 @@ def sum_2km_observations():
         ],
         config["VERIFIED_OBSERVATIONS_FILE"],
         config["UNVERIFIED_OBSERVATIONS_FILE"],
+        sparse,
     )
 
 
@@ -264,46 +530,111 @@ def download_google_ee_data():
 
 @cli.command()
 @click.option("--use_2km_pentad", required=False, help="To rather use 2km pentad instead of 5' pentad.")
-def combine_bioclim(use_2km_pentad:bool = False):
+@click.option(
+    "--workers",
+    type=int,
+    default=DEFAULT_READ_WORKERS,
+    help="Number of files read at the same time.",
+)
+@click.option(
+    "--force_reload",
+    is_flag=True,
+    help="Rebuild the file even if its inputs are unchanged.",
+)
+def combine_bioclim(
+    use_2km_pentad:bool = False,
+    workers: int = DEFAULT_READ_WORKERS,
+    force_reload: bool = False,
+):
     """Combines all of the bioclim files into a single file"""
     if use_2km_pentad:
         print("Using 2km grid")
         _combine_bioclim(
             config["BIOCLIM_DIR_2KM"],
+            TWO_KM_GRID,
             config["AGGREGATE_DIR_2KM"],
             config["BIOCLIM_COMBINED_FILE_2KM"],
+            workers,
+            force_reload,
         )
     else:
         _combine_bioclim(
             config["BIOCLIM_DIR"],
+            PENTAD_GRID,
             config["AGGREGATE_DIR"],
             config["BIOCLIM_COMBINED_FILE"],
+            workers,
+            force_reload,
         )
 
 
 @cli.command()
 @click.option("--use_2km_pentad", required=False, help="To rather use 2km pentad instead of 5' pentad.")
-def combine_google_ee_covariates(use_2km_pentad:bool = False):
+@click.option(
+    "--workers",
+    type=int,
+    default=DEFAULT_READ_WORKERS,
+    help="Number of files read at the same time.",
+)
+@click.option(
+    "--force_reload",
+    is_flag=True,
+    help="Rebuild the file even if its inputs are unchanged.",
+)
+def combine_google_ee_covariates(
+    use_2km_pentad:bool = False,
+    workers: int = DEFAULT_READ_WORKERS,
+    force_reload: bool = False,
+):
     """Combines all of the google ee covariates files into a single file"""
     if use_2km_pentad:
         print("Using 2km grid")
         _combine_google_ee_covariates(
             config["GOOGLE_EE_DIR_2KM"],
+            TWO_KM_GRID,
             config["AGGREGATE_DIR_2KM"],
             config["GOOGLE_EE_COMBINED_FILE_2KM"],
+            force_reload,
+            workers,
         )
     else:
         _combine_google_ee_covariates(
             config["GOOGLE_EE_DIR"],
+            PENTAD_GRID,
             config["AGGREGATE_DIR"],
             config["GOOGLE_EE_COMBINED_FILE"],
+            force_reload,
+            workers,
         )
 
 
 @cli.command()
 @click.option("--use_2km_pentad", required=False, help="To rather use 2km pentad instead of 5' pentad.")
-def combine_all_covariates(use_2km_pentad:bool = False):
+@click.option(
+    "--pentad_keys",
+    is_flag=True,
+    help="Also store the integer pentad_key column in the output file (not with --use_2km_pentad).",
+)
+@click.option(
+    "--force_reload",
+    is_flag=True,
+    help="Rebuild the file even if its inputs are unchanged.",
+)
+@click.option(
+    "--chunk_rows",
+    type=int,
+    default=DEFAULT_CHUNK_ROWS,
+    help="Number of rows scaled at a time, which bounds the memory used.",
+)
+def combine_all_covariates(
+    use_2km_pentad:bool = False,
+    pentad_keys: bool = False,
+    force_reload: bool = False,
+    chunk_rows: int = DEFAULT_CHUNK_ROWS,
+):
     """Combines the Google EE and bioclim covariates files into a single"""
+    _check_pentad_keys(use_2km_pentad, pentad_keys)
+
     if use_2km_pentad:
         print("Using 2km grid")
         combine_and_scale_all_covariates(
@@ -311,6 +642,8 @@ def combine_all_covariates(use_2km_pentad:bool = False):
             config["BIOCLIM_COMBINED_FILE_2KM"],
             config["AGGREGATE_DIR_2KM"],
             config["COMBINED_COVARIATES_FILE_2KM"],
+            force_reload,
+            chunk_rows=chunk_rows,
         )
     else:
         combine_and_scale_all_covariates(
@@ -318,9 +651,175 @@ def combine_all_covariates(use_2km_pentad:bool = False):
             config["BIOCLIM_COMBINED_FILE"],
             config["AGGREGATE_DIR"],
             config["COMBINED_COVARIATES_FILE"],
+            force_reload,
+            store_pentad_key=pentad_keys,
+            chunk_rows=chunk_rows,
         )
 
 
+@cli.command()
+@click.option("--use_2km_pentad", required=False, help="To rather use 2km pentad instead of 5' pentad.")
+@click.option(
+    "--method",
+    type=click.Choice(REDUCTION_METHODS),
+    default=CORRELATION_METHOD,
+    help="Keep one covariate per cluster of correlated covariates, or project them on their principal components.",
+)
+@click.option(
+    "--threshold",
+    type=float,
+    default=DEFAULT_CORRELATION_THRESHOLD,
+    help="Absolute correlation at which covariates are clustered (correlation method).",
+)
+@click.option(
+    "--components",
+    type=int,
+    required=False,
+    help="Number of principal components to keep (pca method).",
+)
+@click.option(
+    "--explained_variance",
+    type=float,
+    default=DEFAULT_EXPLAINED_VARIANCE,
+    help="Keep enough principal components to explain this much of the variance, if --components is not given (pca method).",
+)
+@click.option(
+    "--chunk_rows",
+    type=int,
+    default=DEFAULT_CHUNK_ROWS,
+    help="Number of rows read at a time, which bounds the memory used.",
+)
+def reduce_covariates(
+    use_2km_pentad: bool = False,
+    method: str = CORRELATION_METHOD,
+    threshold: float = DEFAULT_CORRELATION_THRESHOLD,
+    components: int = None,
+    explained_variance: float = DEFAULT_EXPLAINED_VARIANCE,
+    chunk_rows: int = DEFAULT_CHUNK_ROWS,
+):
+    """
+    Computes a reduced set of covariates from the combined covariates, once,
+    for generate-distribution --reduced to train on.
+    """
+    if use_2km_pentad:
+        print("Using 2km grid")
+        input_data_path = config["AGGREGATE_DIR_2KM"]
+        covariates_file = config["COMBINED_COVARIATES_FILE_2KM"]
+    else:
+        input_data_path = config["AGGREGATE_DIR"]
+        covariates_file = config["COMBINED_COVARIATES_FILE"]
+
+    _reduce_covariates(
+        input_data_path,
+        covariates_file,
+        method,
+        threshold,
+        components,
+        explained_variance,
+        chunk_rows,
+    )
+
+
+@cli.command()
+@click.option(
+    "--species_id",
+    "species_ids",
+    required=True,
+    multiple=True,
+    help="A SABAP2 bird id to benchmark, can be given more than once.",
+)
+@click.option("--use_2km_pentad", required=False, help="To rather use 2km pentad instead of 5' pentad.")
+@click.option(
+    "--sparse",
+    is_flag=True,
+    help="Read the sparse (.npz) observation files written by sum-observations --sparse.",
+)
+def benchmark_reduced_covariates(
+    species_ids: tuple[str], use_2km_pentad: bool = False, sparse: bool = False
+):
+    """
+    Compares the training time and the test scores of the given species on the
+    full and on the reduced covariates (see reduce-covariates). The results are
+    written to covariate_reduction_benchmark.csv in the output directory.
+    """
+    verified_observations_file = config["VERIFIED_OBSERVATIONS_FILE"]
+    unverified_observations_file = config["UNVERIFIED_OBSERVATIONS_FILE"]
+    if sparse:
+        verified_observations_file = sparse_file_name(verified_observations_file)
+        unverified_observations_file = sparse_file_name(unverified_observations_file)
+
+    if use_2km_pentad:
+        print("Using 2km pentad instead of 5' pentad")
+        input_data_path = config["AGGREGATE_DIR_2KM"]
+        covariates_file = config["COMBINED_COVARIATES_FILE_2KM"]
+        output_dir = config["OUTPUT_DIR_2KM"]
+    else:
+        input_data_path = config["AGGREGATE_DIR"]
+        covariates_file = config["COMBINED_COVARIATES_FILE"]
+        output_dir = config["OUTPUT_DIR"]
+
+    benchmark_covariates(
+        list(species_ids),
+        input_data_path,
+        verified_observations_file,
+        unverified_observations_file,
+        covariates_file,
+        reduced_file_name(covariates_file),
+        f"{output_dir}/covariate_reduction_benchmark.csv",
+        use_2km_pentad,
+    )
+
+
+@cli.command()
+@click.option("--use_2km_pentad", required=False, help="To rather use 2km pentad instead of 5' pentad.")
+@click.option(
+    "--sparse",
+    is_flag=True,
+    help="Align the sparse (.npz) observation files written by sum-observations --sparse.",
+)
+@click.option(
+    "--reduced",
+    is_flag=True,
+    help="Align the reduced covariates written by reduce-covariates.",
+)
+def align_pentads(
+    use_2km_pentad: bool = False, sparse: bool = False, reduced: bool = False
+):
+    """
+    Aligns the covariates and the observation files to the grid, and checks
+    them. This is otherwise done the first time the model is run on them.
+    """
+    verified_observations_file = config["VERIFIED_OBSERVATIONS_FILE"]
+    unverified_observations_file = config["UNVERIFIED_OBSERVATIONS_FILE"]
+    if sparse:
+        verified_observations_file = sparse_file_name(verified_observations_file)
+        unverified_observations_file = sparse_file_name(unverified_observations_file)
+
+    if use_2km_pentad:
+        print("Using 2km grid")
+        input_data_path = config["AGGREGATE_DIR_2KM"]
+        covariates_file = config["COMBINED_COVARIATES_FILE_2KM"]
+        grid_name = TWO_KM_GRID
+    else:
+        input_data_path = config["AGGREGATE_DIR"]
+        covariates_file = config["COMBINED_COVARIATES_FILE"]
+        grid_name = PENTAD_GRID
+
+    if reduced:
+        covariates_file = reduced_file_name(covariates_file)
+        check_reduction(os.path.join(input_data_path, covariates_file))
+
+    alignment = load_alignment(
+        input_data_path,
+        grid_name,
+        covariates_file,
+        [verified_observations_file, unverified_observations_file],
+    )
+
+    for name, rows in alignment.cell_rows.items():
+        print(f"{name}: {(rows >= 0).sum()} of {len(rows)} grid cells", flush=True)
+
+
 @cli.command()
 def download_all_data():
     """Download all of the aggregated data needed to run the model."""
@@ -335,8 +834,17 @@ def download_all_data():
 @cli.command()
 @click.option("--species_id", required=False, help="The SABAP2 bird id to process.")
 @click.option("--use_2km_pentad", required=False, help="To rather use 2km pentad instead of 5' pentad.")
-def stats(species_id: str = None, use_2km_pentad: bool = False):
+@click.option(
+    "--sparse",
+    is_flag=True,
+    help="Read the sparse (.npz) observation files written by sum-observations --sparse.",
+)
+def stats(species_id: str = None, use_2km_pentad: bool = False, sparse: bool = False):
     """Get all the stats for a given species"""
+    verified_observations_file = config["VERIFIED_OBSERVATIONS_FILE"]
+    if sparse:
+        verified_observations_file = sparse_file_name(verified_observations_file)
+
     print("Species: ", species_id, flush=True)
 
     if use_2km_pentad:
@@ -346,7 +854,7 @@ def stats(species_id: str = None, use_2km_pentad: bool = False):
             config["EBIRDS_AGGREGATE_FILE_2KM"],
             config["INAT_AGGREGATE_FILE_2KM"],
             config["BIRDLASSER_COMBINED_FILE"],
-            config["VERIFIED_OBSERVATIONS_FILE"],
+            verified_observations_file,
             species_id,
             plot=True,
         )
@@ -356,7 +864,7 @@ def stats(species_id: str = None, use_2km_pentad: bool = False):
             config["EBIRDS_AGGREGATE_FILE"],
             config["INAT_AGGREGATE_FILE"],
             config["SABAP2_COMBINED_FILE"],
-            config["VERIFIED_OBSERVATIONS_FILE"],
+            verified_observations_file,
             species_id,
             plot=True,
         )
@@ -365,21 +873,48 @@ def stats(species_id: str = None, use_2km_pentad: bool = False):
 @cli.command()
 @click.option("--species_id", required=False, help="The SABAP2 bird id to process.")
 @click.option("--use_2km_pentad", required=False, help="To rather use 2km pentad instead of 5' pentad.")
-def generate_distribution(species_id: str, use_2km_pentad:bool = False):
+@click.option(
+    "--sparse",
+    is_flag=True,
+    help="Read the sparse (.npz) observation files written by sum-observations --sparse.",
+)
+@click.option(
+    "--reduced",
+    is_flag=True,
+    help="Train on the reduced covariates written by reduce-covariates.",
+)
+def generate_distribution(
+    species_id: str,
+    use_2km_pentad:bool = False,
+    sparse: bool = False,
+    reduced: bool = False,
+):
     """
     Run the model for a given species. This will generate:
         1. Some maps in output/maps/species_id_...
         2. A summary file in output/stats/species_id_...
         3. The pentad probabilities file in output/models/species_id_...
     """
+    verified_observations_file = config["VERIFIED_OBSERVATIONS_FILE"]
+    unverified_observations_file = config["UNVERIFIED_OBSERVATIONS_FILE"]
+    if sparse:
+        verified_observations_file = sparse_file_name(verified_observations_file)
+        unverified_observations_file = sparse_file_name(unverified_observations_file)
+
+    covariates_file = config["COMBINED_COVARIATES_FILE"]
+    covariates_file_2km = config["COMBINED_COVARIATES_FILE_2KM"]
+    if reduced:
+        covariates_file = reduced_file_name(covariates_file)
+        covariates_file_2km = reduced_file_name(covariates_file_2km)
+
     if use_2km_pentad:
         print("Using 2km pentad instead of 5' pentad")
         train_and_predict(
             species_id,
             config["AGGREGATE_DIR_2KM"],
-            config["VERIFIED_OBSERVATIONS_FILE"],
-            config["UNVERIFIED_OBSERVATIONS_FILE"],
-            config["COMBINED_COVARIATES_FILE_2KM"],
+            verified_observations_file,
+            unverified_observations_file,
+            covariates_file_2km,
             config["OUTPUT_DIR_2KM"],
             use_2km_pentad,
         )
@@ -387,9 +922,9 @@ def generate_distribution(species_id: str, use_2km_pentad:bool = False):
         train_and_predict(
             species_id,
             config["AGGREGATE_DIR"],
-            config["VERIFIED_OBSERVATIONS_FILE"],
-            config["UNVERIFIED_OBSERVATIONS_FILE"],
-            config["COMBINED_COVARIATES_FILE"],
+            verified_observations_file,
+            unverified_observations_file,
+            covariates_file,
             config["OUTPUT_DIR"],
             use_2km_pentad
         )
@@ -397,33 +932,76 @@ def generate_distribution(species_id: str, use_2km_pentad:bool = False):
 
 @cli.command()
 @click.option("--use_2km_pentad", required=False, help="To rather use 2km pentad instead of 5' pentad.")
-def generate_all_distributions(use_2km_pentad:bool = False):
+@click.option(
+    "--sparse",
+    is_flag=True,
+    help="Read the sparse (.npz) observation files written by sum-observations --sparse.",
+)
+@click.option(
+    "--reduced",
+    is_flag=True,
+    help="Train on the reduced covariates written by reduce-covariates.",
+)
+@click.option(
+    "--workers",
+    type=int,
+    default=1,
+    help="Number of species trained in parallel, in worker processes.",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Skip the species that a previous run already finished on the same inputs.",
+)
+def generate_all_distributions(
+    use_2km_pentad:bool = False,
+    sparse: bool = False,
+    reduced: bool = False,
+    workers: int = 1,
+    resume: bool = False,
+):
     """
     Run the model for all species. This will generate:
         1. Some maps in output/maps/species_id_...
         2. Summary files in output/stats/species_id_...
         3. The pentad probabilities files in output/models/species_id_...
     """
+    verified_observations_file = config["VERIFIED_OBSERVATIONS_FILE"]
+    unverified_observations_file = config["UNVERIFIED_OBSERVATIONS_FILE"]
+    if sparse:
+        verified_observations_file = sparse_file_name(verified_observations_file)
+        unverified_observations_file = sparse_file_name(unverified_observations_file)
+
+    covariates_file = config["COMBINED_COVARIATES_FILE"]
+    covariates_file_2km = config["COMBINED_COVARIATES_FILE_2KM"]
+    if reduced:
+        covariates_file = reduced_file_name(covariates_file)
+        covariates_file_2km = reduced_file_name(covariates_file_2km)
+
     if use_2km_pentad:
         print("Using 2km pentad instead of 5' pentad")
         train_and_predict_all(
             config["BIRD_LIST"],
             config["AGGREGATE_DIR_2KM"],
-            config["VERIFIED_OBSERVATIONS_FILE"],
-            config["UNVERIFIED_OBSERVATIONS_FILE"],
-            config["COMBINED_COVARIATES_FILE_2KM"],
+            verified_observations_file,
+            unverified_observations_file,
+            covariates_file_2km,
             config["OUTPUT_DIR_2KM"],
             use_2km_pentad,
+            workers,
+            resume,
         )
     else:
         train_and_predict_all(
             config["BIRD_LIST"],
             config["AGGREGATE_DIR"],
-            config["VERIFIED_OBSERVATIONS_FILE"],
-            config["UNVERIFIED_OBSERVATIONS_FILE"],
-            config["COMBINED_COVARIATES_FILE"],
+            verified_observations_file,
+            unverified_observations_file,
+            covariates_file,
             config["OUTPUT_DIR"],
-            use_2km_pentad
+            use_2km_pentad,
+            workers,
+            resume,
         )
 
 
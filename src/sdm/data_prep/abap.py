@@ -1,9 +1,109 @@
 import os
 import csv
+import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
 import pandas as pd
-import requests
 from tqdm import tqdm
-from .utils import make_dir_if_not_exists
+from .downloads import DownloadManifest, RateLimiter, fetch, make_session, write_atomic
+from .dtypes import write_counts
+from .grids import PENTAD_GRID, get_grid
+from .species_matrix import species_count_matrix
+from .utils import PENTAD_KEY_COLUMN, make_dir_if_not_exists, add_pentad_key
+
+
+# Keeps track of the downloaded species files in the SABAP2 data dir
+DOWNLOAD_MANIFEST = "download_manifest.json"
+
+# The ids of the species whose files changed since the combined file was
+# last written
+CHANGED_SPECIES_FILE = "changed_species.json"
+
+DEFAULT_DOWNLOAD_WORKERS = 8
+DEFAULT_REQUESTS_PER_SECOND = 5.0
+
+
+def _conditional_headers(entry: dict) -> dict:
+    """Request headers that let the server answer 304 if the file is unchanged"""
+    headers = {}
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+def _fetch_species(
+    sabap2_id: str,
+    sabap2_data_dir: str,
+    species_url: str,
+    session,
+    rate_limiter: RateLimiter | None = None,
+    manifest: DownloadManifest | None = None,
+    conditional: bool = False,
+) -> bool:
+    """
+    Download the file of a single species and record the outcome in the
+    manifest, along with the ETag, Last-Modified and content hash of the
+    response. Errors are recorded before they are raised.
+
+    With conditional, a species that was downloaded before is requested with
+    the stored ETag/Last-Modified, and the file is only rewritten if its
+    content changed. An empty response removes any earlier file of the
+    species, so its old cards are not combined again. Returns whether the
+    species file changed.
+    """
+    file_path = os.path.join(sabap2_data_dir, f"{sabap2_id}.csv")
+    previous = manifest.get(sabap2_id) if manifest is not None else {}
+
+    headers = None
+    if conditional and previous.get("status") in DownloadManifest.COMPLETE:
+        headers = _conditional_headers(previous)
+
+    try:
+        response = fetch(session, species_url.format(sabap2_id), rate_limiter, headers)
+    except Exception as e:
+        if manifest is not None:
+            manifest.record(sabap2_id, "failed", error=str(e))
+        raise
+
+    if response.status_code == 304:
+        if manifest is not None:
+            manifest.record(sabap2_id, previous["status"], **_without_status(previous))
+        return False
+
+    digest = hashlib.sha256(response.content).hexdigest()
+    changed = digest != previous.get("sha256") or (
+        bool(response.content) and not os.path.exists(file_path)
+    )
+
+    if not response.content:
+        print(f"Downloaded empty file for {sabap2_id}", flush=True)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        status = "empty"
+    else:
+        if changed:
+            write_atomic(file_path, response.content)
+        status = "done"
+
+    if manifest is not None:
+        manifest.record(
+            sabap2_id,
+            status,
+            size=len(response.content),
+            sha256=digest,
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+        )
+
+    return changed
+
+
+def _without_status(entry: dict) -> dict:
+    return {k: v for k, v in entry.items() if k not in ("status", "updated_at")}
 
 
 def download_saba2_species(
@@ -15,64 +115,249 @@ def download_saba2_species(
         print(f"File for sabap2_id {sabap2_id} already exists. Skipping download.")
         return
 
-    download_url = species_url.format(sabap2_id)
+    manifest = DownloadManifest(os.path.join(sabap2_data_dir, DOWNLOAD_MANIFEST))
+    with make_session(1) as session:
+        _fetch_species(str(sabap2_id), sabap2_data_dir, species_url, session, None, manifest)
 
-    try:
-        response = requests.get(download_url)
-        if response.content:
-            with open(file_path, "wb") as out_file:
-                out_file.write(response.content)
-        else:
-            print(f"Downloaded empty file for {sabap2_id}")
-    except Exception as e:
-        print(f"Error downloading file for {sabap2_id}: {e}")
+
+def _seed_manifest(manifest: DownloadManifest, sabap2_data_dir: str):
+    """
+    Record the species files that were downloaded before there was a
+    manifest, so they are not fetched again.
+    """
+    for file in os.listdir(sabap2_data_dir):
+        file_path = os.path.join(sabap2_data_dir, file)
+        sabap2_id = file.split(".")[0]
+
+        if file.endswith(".csv") and sabap2_id not in manifest and os.path.getsize(file_path):
+            with open(file_path, "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            manifest.record(
+                sabap2_id, "done", size=os.path.getsize(file_path), sha256=digest
+            )
 
 
 def download_all(
-    bird_list: str, sabap2_data_dir: str, species_url: str, overwrite=False
-):
+    bird_list: str,
+    sabap2_data_dir: str,
+    species_url: str,
+    overwrite=False,
+    workers: int = DEFAULT_DOWNLOAD_WORKERS,
+    requests_per_second: float | None = DEFAULT_REQUESTS_PER_SECOND,
+    refresh: bool = False,
+) -> list[str]:
+    """
+    Download the file of every species in the bird list, using a pool of
+    `workers` threads that share a session and a rate limit.
+
+    Finished species are recorded in a manifest in the data dir, and are
+    skipped when the download is run again, so an interrupted run continues
+    where it stopped. With overwrite the manifest is cleared and every
+    species is downloaded again. With refresh the finished species are
+    requested again with conditional requests, so only the cards that
+    changed are fetched and rewritten.
+
+    Failed species are retried on the next run, and raise an error once all
+    of the others are done. Returns the ids of the species whose files
+    changed in this run. They are added to the ids saved by earlier runs
+    that were not combined yet (see changed_species).
+    """
     with open(bird_list, "r") as file:
-        reader = csv.DictReader(file)
+        sabap2_ids = [row["SABAP2_number"] for row in csv.DictReader(file)]
+
+    manifest = DownloadManifest(os.path.join(sabap2_data_dir, DOWNLOAD_MANIFEST))
+    if overwrite:
+        manifest.reset()
+    elif not os.path.exists(manifest.path):
+        _seed_manifest(manifest, sabap2_data_dir)
+
+    pending = [i for i in sabap2_ids if refresh or not manifest.is_complete(i)]
+    print(
+        f"Downloading {len(pending)} of {len(sabap2_ids)} species with {workers} workers",
+        flush=True,
+    )
 
-        for row in reader:
-            sabap2_id = row["SABAP2_number"]
-            download_saba2_species(sabap2_id, sabap2_data_dir, species_url, overwrite)
-            print(f"Download for {sabap2_id} complete.")
+    rate_limiter = RateLimiter(requests_per_second)
+    changed = []
+    failed = {}
+
+    with make_session(workers) as session, ThreadPoolExecutor(workers) as executor:
+        futures = {
+            executor.submit(
+                _fetch_species,
+                sabap2_id,
+                sabap2_data_dir,
+                species_url,
+                session,
+                rate_limiter,
+                manifest,
+                refresh,
+            ): sabap2_id
+            for sabap2_id in pending
+        }
+
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Downloading"):
+            try:
+                if future.result():
+                    changed.append(futures[future])
+            except Exception as e:
+                failed[futures[future]] = e
+                print(f"Error downloading file for {futures[future]}: {e}", flush=True)
+
+    changed = sorted(changed, key=int)
+    _add_changed_species(sabap2_data_dir, changed)
+    print(f"{len(changed)} species files changed", flush=True)
+
+    if failed:
+        raise RuntimeError(
+            f"{len(failed)} species could not be downloaded: {sorted(failed)}. "
+            "Run the download again to retry them."
+        )
 
     print("Download process complete!")
+    return changed
+
+
+def _save_changed_species(sabap2_data_dir: str, sabap2_ids: list[str]):
+    write_atomic(
+        os.path.join(sabap2_data_dir, CHANGED_SPECIES_FILE),
+        json.dumps(sabap2_ids).encode("utf-8"),
+    )
+
+
+def _add_changed_species(sabap2_data_dir: str, sabap2_ids: list[str]):
+    """
+    Add to the saved ids, so the changes of a download that was never
+    combined (e.g. one that raised) are not lost by the next one
+    """
+    saved = changed_species(sabap2_data_dir) or []
+    _save_changed_species(
+        sabap2_data_dir, sorted(set(saved) | set(sabap2_ids), key=int)
+    )
+
+
+def clear_changed_species(sabap2_data_dir: str):
+    """Record that the combined file is up to date with every species file"""
+    _save_changed_species(sabap2_data_dir, [])
+
+
+def changed_species(sabap2_data_dir: str) -> list[str] | None:
+    """
+    The ids of the species whose files changed since the combined file was
+    last written, or None if there is no record of a download.
+    """
+    path = os.path.join(sabap2_data_dir, CHANGED_SPECIES_FILE)
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def _species_cells(file_path: str, grid_name: str) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Count the cards that recorded the species per grid cell. Returns the
+    positions of the cells in the grid and the count for each.
+    """
+    observations = pd.read_csv(file_path, usecols=["Pentad", "Taxonomic_name"])
+
+    # Cards with a "-" name did not record the species
+    observed = (observations["Taxonomic_name"] != "-").to_numpy()
+    cells = get_grid(grid_name).positions(
+        observations["Pentad"].astype(str).str.lower().to_numpy()
+    )
+
+    return np.unique(cells[observed & (cells >= 0)], return_counts=True)
 
 
 def combine(
-    sabap2_data_dir: str, pentad_list_path: str, aggregate_dir: str, output_file: str
+    sabap2_data_dir: str,
+    grid_name: str,
+    aggregate_dir: str,
+    output_file: str,
+    store_pentad_key: bool = False,
+    workers: int = 1,
 ):
     all_files = [f for f in os.listdir(sabap2_data_dir) if f.endswith(".csv")]
 
-    # Load the reference pentad list
-    reference_df = pd.read_csv(pentad_list_path)[["pentad"]]
-
-    for file in tqdm(all_files, desc="Processing files"):
-        species_id = int(file.split(".")[0])
-
-        # Read the file
-        file_path = os.path.join(sabap2_data_dir, file)
-        observations = pd.read_csv(file_path)
+    species_ids, matrix = species_count_matrix(
+        sabap2_data_dir, all_files, grid_name, _species_cells, workers
+    )
 
-        # Process data
-        observations.rename(columns={"Pentad": "pentad"}, inplace=True)
-        observations["observed"] = observations["Taxonomic_name"].apply(
-            lambda x: 0 if x == "-" else 1
-        )
-        observations["pentad"] = observations["pentad"].str.lower()
+    # The reference pentad list with a column per species
+    reference_df = pd.concat(
+        [
+            pd.DataFrame({"pentad": get_grid(grid_name).cells}),
+            pd.DataFrame(matrix, columns=species_ids),
+        ],
+        axis=1,
+    )
 
-        # Group and merge
-        grouped = observations.groupby("pentad")["observed"].sum().reset_index()
-        grouped[species_id] = grouped["observed"].astype(int)
-        reference_df = reference_df.merge(
-            grouped[["pentad", species_id]], on="pentad", how="left"
-        )
-        reference_df[species_id] = reference_df[species_id].fillna(0).astype(int)
+    if store_pentad_key:
+        add_pentad_key(reference_df)
 
     # Save output
     make_dir_if_not_exists(aggregate_dir)
     output_path = os.path.join(aggregate_dir, output_file)
-    reference_df.to_feather(output_path)
+    write_counts(reference_df, output_path)
+
+    # Every species is combined, so none are left to update
+    clear_changed_species(sabap2_data_dir)
+
+
+def combine_changed(
+    sabap2_data_dir: str,
+    aggregate_dir: str,
+    output_file: str,
+    sabap2_ids: list[str],
+    grid_name: str = PENTAD_GRID,
+    workers: int = 1,
+    store_pentad_key: bool = False,
+):
+    """
+    Update the columns of the given species in an existing combined file,
+    leaving the other species as they are. The columns of the given species
+    that no longer have a file (their last download was empty) are zeroed.
+    Once the file is written the saved changed species are cleared.
+    """
+    output_path = os.path.join(aggregate_dir, output_file)
+    reference_df = pd.read_feather(output_path)
+    if store_pentad_key and PENTAD_KEY_COLUMN not in reference_df.columns:
+        add_pentad_key(reference_df)
+
+    files = [
+        f"{sabap2_id}.csv"
+        for sabap2_id in sabap2_ids
+        if os.path.exists(os.path.join(sabap2_data_dir, f"{sabap2_id}.csv"))
+    ]
+    species_ids, matrix = species_count_matrix(
+        sabap2_data_dir, files, grid_name, _species_cells, workers
+    )
+
+    # The combined file is in grid order, so line the new columns up with it
+    positions = get_grid(grid_name).positions(reference_df["pentad"].to_numpy())
+    changed_df = pd.DataFrame(
+        np.where((positions >= 0)[:, None], matrix[positions], 0),
+        columns=[str(i) for i in species_ids],
+        index=reference_df.index,
+    )
+    for sabap2_id in map(str, sabap2_ids):
+        if sabap2_id in reference_df.columns and sabap2_id not in changed_df.columns:
+            changed_df[sabap2_id] = 0
+
+    # Replace the changed columns in place and add any new species at the end
+    columns = list(reference_df.columns) + [
+        c for c in changed_df.columns if c not in reference_df.columns
+    ]
+    reference_df = pd.concat(
+        [
+            reference_df.drop(
+                columns=[c for c in changed_df.columns if c in reference_df.columns]
+            ),
+            changed_df,
+        ],
+        axis=1,
+    )[columns]
+
+    write_counts(reference_df, output_path)
+    clear_changed_species(sabap2_data_dir)
@@ -0,0 +1,319 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+# Above this many cells the counts are kept sparse rather than in a dense array
+DEFAULT_MAX_DENSE_CELLS = 50_000_000
+
+# Number of distinct (row, column) entries held in memory before they are
+# spilled to disk
+DEFAULT_MAX_SPARSE_ENTRIES = 20_000_000
+
+# Number of cells in each block returned by iter_blocks
+DEFAULT_BLOCK_CELLS = 10_000_000
+
+# Number of entries read from the spilled runs at a time, shared between all
+# of the runs that are read together
+RUN_READ_SIZE = 1_000_000
+
+# Number of spilled runs of the same size that are merged into one larger run
+MERGE_FAN_IN = 8
+
+
+class CountAccumulator:
+    """
+    Folds (row, column, count) triples into a fixed size count matrix with
+    shape (n_rows, n_columns), e.g. grid cells x species.
+
+    Small matrices are accumulated in a dense array. Larger ones are kept as
+    sorted (flat key, count) pairs which are compacted as they grow and spilled
+    to disk once there are more than max_sparse_entries of them. Either way the
+    memory used depends on the size of the matrix and never on how many triples
+    are added.
+
+    Spilled runs are merged MERGE_FAN_IN at a time into runs of the next level,
+    so only a few runs of each level are ever on disk. The totals are read back
+    in row blocks with iter_blocks, which merges the spilled runs one block at
+    a time. The runs that are read together share RUN_READ_SIZE entries of
+    buffer, so the memory used does not grow with the number of runs.
+    """
+
+    def __init__(
+        self,
+        n_rows: int,
+        n_columns: int,
+        max_dense_cells: int = DEFAULT_MAX_DENSE_CELLS,
+        max_sparse_entries: int = DEFAULT_MAX_SPARSE_ENTRIES,
+        spill_dir: str | None = None,
+    ):
+        self.shape = (n_rows, n_columns)
+        self.max_sparse_entries = max_sparse_entries
+        self.spill_dir = spill_dir
+
+        self._dense = None
+        if n_rows * n_columns <= max_dense_cells:
+            self._dense = np.zeros(n_rows * n_columns, dtype=np.int64)
+
+        self._keys = np.empty(0, dtype=np.int64)
+        self._counts = np.empty(0, dtype=np.int64)
+        self._pending_keys = []
+        self._pending_counts = []
+        self._pending_size = 0
+        # (path, length, level) of each spilled run
+        self._runs = []
+        self._run_count = 0
+        self._run_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def is_dense(self) -> bool:
+        return self._dense is not None
+
+    @property
+    def run_count(self) -> int:
+        """Number of runs written to disk so far, spilled or merged"""
+        return self._run_count
+
+    def add(self, rows, columns, counts=None):
+        """
+        Add the counts for each (row, column) pair. Each pair counts once if no
+        counts are given.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        columns = np.asarray(columns, dtype=np.int64)
+        counts = (
+            np.ones(len(rows), dtype=np.int64)
+            if counts is None
+            else np.asarray(counts, dtype=np.int64)
+        )
+
+        if len(rows) == 0:
+            return
+
+        if (
+            rows.min() < 0
+            or rows.max() >= self.shape[0]
+            or columns.min() < 0
+            or columns.max() >= self.shape[1]
+        ):
+            raise ValueError(f"Counts are outside of the {self.shape} matrix")
+
+        keys = rows * self.shape[1] + columns
+
+        if self.is_dense:
+            np.add.at(self._dense, keys, counts)
+            return
+
+        self._pending_keys.append(keys)
+        self._pending_counts.append(counts)
+        self._pending_size += len(keys)
+
+        if self._pending_size >= self.max_sparse_entries:
+            self._compact()
+
+    def _compact(self):
+        """Fold the pending triples into the sorted in-memory entries"""
+        if not self._pending_keys:
+            return
+
+        self._keys, self._counts = _sum_by_key(
+            np.concatenate([self._keys] + self._pending_keys),
+            np.concatenate([self._counts] + self._pending_counts),
+        )
+        self._pending_keys = []
+        self._pending_counts = []
+        self._pending_size = 0
+
+        if len(self._keys) > self.max_sparse_entries:
+            self._spill()
+
+    def _run_path(self) -> str:
+        if self._run_dir is None:
+            if self.spill_dir:
+                os.makedirs(self.spill_dir, exist_ok=True)
+            self._run_dir = tempfile.mkdtemp(prefix="counts_", dir=self.spill_dir)
+
+        self._run_count += 1
+        return os.path.join(self._run_dir, f"run_{self._run_count}")
+
+    def _spill(self):
+        """Write the in-memory entries to disk as a sorted run"""
+        run_path = self._run_path()
+        self._keys.tofile(f"{run_path}.keys")
+        self._counts.tofile(f"{run_path}.counts")
+        self._runs.append((run_path, len(self._keys), 0))
+
+        self._keys = np.empty(0, dtype=np.int64)
+        self._counts = np.empty(0, dtype=np.int64)
+
+        level = 0
+        while sum(run_level == level for *_, run_level in self._runs) >= MERGE_FAN_IN:
+            self._merge_runs(level)
+            level += 1
+
+    def _merge_runs(self, level: int):
+        """
+        Merge the spilled runs of a level into a single run of the next level.
+        Runs are only ever added at the end, and the runs of a level are all
+        merged at once, so the runs of a level are the last ones.
+        """
+        merged = [run for run in self._runs if run[2] == level]
+        self._runs = self._runs[: -len(merged)]
+
+        readers = _run_readers([(run_path, length) for run_path, length, _ in merged])
+        run_path = self._run_path()
+        length = 0
+        with open(f"{run_path}.keys", "wb") as keys_file, open(
+            f"{run_path}.counts", "wb"
+        ) as counts_file:
+            for keys, counts in _merge(readers):
+                keys.tofile(keys_file)
+                counts.tofile(counts_file)
+                length += len(keys)
+
+        for merged_path, _, _ in merged:
+            os.remove(f"{merged_path}.keys")
+            os.remove(f"{merged_path}.counts")
+        self._runs.append((run_path, length, level + 1))
+
+    def iter_blocks(self, block_rows: int | None = None):
+        """
+        Yield (first_row, block) pairs, where block is the dense int64 count
+        matrix for the next block_rows rows.
+        """
+        n_rows, n_columns = self.shape
+        if block_rows is None:
+            block_rows = max(1, DEFAULT_BLOCK_CELLS // max(n_columns, 1))
+
+        if not self.is_dense:
+            self._compact()
+
+        runs = _run_readers([(run_path, length) for run_path, length, _ in self._runs])
+        runs.append(_RunReader.from_arrays(self._keys, self._counts))
+
+        for first_row in range(0, n_rows, block_rows):
+            last_row = min(first_row + block_rows, n_rows)
+            start_key, end_key = first_row * n_columns, last_row * n_columns
+
+            if self.is_dense:
+                block = self._dense[start_key:end_key].copy()
+            else:
+                block = np.zeros(end_key - start_key, dtype=np.int64)
+                for run in runs:
+                    for keys, counts in run.read_until(end_key):
+                        np.add.at(block, keys - start_key, counts)
+
+            yield first_row, block.reshape(last_row - first_row, n_columns)
+
+    def to_dense(self) -> np.ndarray:
+        """The full count matrix"""
+        blocks = [block for _, block in self.iter_blocks()]
+        if not blocks:
+            return np.zeros(self.shape, dtype=np.int64)
+        return np.concatenate(blocks)
+
+    def close(self):
+        """Remove any spilled runs"""
+        if self._run_dir is not None:
+            shutil.rmtree(self._run_dir, ignore_errors=True)
+            self._run_dir = None
+            self._runs = []
+
+
+class _RunReader:
+    """
+    Reads a sorted run front to back in pieces of read_size entries, so only a
+    small part of each run is in memory at a time.
+    """
+
+    def __init__(self, run_path: str | None, length: int, read_size: int = RUN_READ_SIZE):
+        self.run_path = run_path
+        self.length = length
+        self.read_size = read_size
+        self.position = 0
+        self._keys = np.empty(0, dtype=np.int64)
+        self._counts = np.empty(0, dtype=np.int64)
+
+    @classmethod
+    def from_arrays(cls, keys: np.ndarray, counts: np.ndarray):
+        reader = cls(None, len(keys))
+        reader._keys, reader._counts = keys, counts
+        reader.position = len(keys)
+        return reader
+
+    def _read(self) -> bool:
+        """Read the next piece of the run, returns False once it is exhausted"""
+        if self.run_path is None or self.position >= self.length:
+            return False
+
+        count = min(self.read_size, self.length - self.position)
+        offset = self.position * np.dtype(np.int64).itemsize
+        self._keys = np.fromfile(
+            f"{self.run_path}.keys", dtype=np.int64, count=count, offset=offset
+        )
+        self._counts = np.fromfile(
+            f"{self.run_path}.counts", dtype=np.int64, count=count, offset=offset
+        )
+        self.position += count
+        return True
+
+    def last_key(self) -> int | None:
+        """
+        The last key of the piece of the run in memory, reading the next piece
+        if this one is used up. None once the run is exhausted.
+        """
+        if len(self._keys) == 0 and not self._read():
+            return None
+        return int(self._keys[-1])
+
+    def read_until(self, end_key: int):
+        """Yield the (keys, counts) of the entries with keys below end_key"""
+        while True:
+            end = np.searchsorted(self._keys, end_key)
+            if end > 0:
+                yield self._keys[:end], self._counts[:end]
+                self._keys, self._counts = self._keys[end:], self._counts[end:]
+
+            if len(self._keys) > 0 or not self._read():
+                return
+
+
+def _run_readers(runs: list[tuple[str, int]]) -> list[_RunReader]:
+    """Readers for the (path, length) runs, sharing RUN_READ_SIZE entries"""
+    read_size = max(1, RUN_READ_SIZE // max(len(runs), 1))
+    return [_RunReader(run_path, length, read_size) for run_path, length in runs]
+
+
+def _merge(readers: list[_RunReader]):
+    """
+    Yield the summed (keys, counts) of the runs in key order. Every run has
+    read past the smallest of the last keys in memory, so the entries up to it
+    can be summed without reading any further.
+    """
+    while True:
+        last_keys = [key for key in (r.last_key() for r in readers) if key is not None]
+        if not last_keys:
+            return
+
+        pieces = [
+            piece for reader in readers for piece in reader.read_until(min(last_keys) + 1)
+        ]
+        keys, counts = zip(*pieces)
+        yield _sum_by_key(np.concatenate(keys), np.concatenate(counts))
+
+
+def _sum_by_key(keys: np.ndarray, counts: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Sorted unique keys and the summed counts for each"""
+    order = np.argsort(keys, kind="stable")
+    keys, counts = keys[order], counts[order]
+    del order
+
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    return keys[starts], np.add.reduceat(counts, starts) if len(keys) else counts
@@ -0,0 +1,154 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from .covariate_cache import array_digest
+from .grids import get_grid
+from .sparse_observations import is_sparse
+
+# The alignment is stored next to the covariates file it was built for
+ALIGNMENT_SUFFIX = ".alignment.npz"
+
+
+def alignment_path(input_data_path: str, covariates_file: str) -> str:
+    stem = os.path.splitext(covariates_file)[0]
+    return os.path.join(input_data_path, stem + ALIGNMENT_SUFFIX)
+
+
+def _file_signature(path: str) -> np.ndarray:
+    """Size and modification time of an aligned file"""
+    return np.array([os.stat(path).st_size, os.stat(path).st_mtime_ns], dtype=np.int64)
+
+
+def read_pentads(path: str) -> np.ndarray:
+    """The pentad id of each row of a Feather or sparse observations file"""
+    if is_sparse(path):
+        with np.load(path, allow_pickle=False) as f:
+            return f["pentads"]
+
+    return pd.read_feather(path, columns=["pentad"])["pentad"].to_numpy(dtype=str)
+
+
+def cell_rows(pentads: np.ndarray, grid_name: str, name: str = "") -> np.ndarray:
+    """
+    The row of each grid cell in a file with the given pentads, -1 for the
+    cells that are not in it. A pentad that is in the file more than once can
+    not be aligned, so raises a ValueError. Rows of pentads that are not in
+    the grid are left out, with a message.
+    """
+    grid = get_grid(grid_name)
+    cells = grid.positions(pentads)
+    in_grid = cells >= 0
+
+    unique, counts = np.unique(cells[in_grid], return_counts=True)
+    if (counts > 1).any():
+        duplicates = grid.cells[unique[counts > 1]][:5].tolist()
+        raise ValueError(
+            f"{name} has pentads that are in it more than once: {duplicates}"
+        )
+
+    if not in_grid.all():
+        print(
+            f"{(~in_grid).sum()} rows of {name} are not in the {grid_name} grid "
+            "and are left out of the alignment",
+            flush=True,
+        )
+
+    rows = np.full(len(grid), -1, dtype=np.int64)
+    rows[cells[in_grid]] = np.flatnonzero(in_grid)
+    return rows
+
+
+class PentadAlignment:
+    """
+    The row of every grid cell in each of a set of files (the covariates and
+    the observation files), -1 where the cell is not in the file. Rows of one
+    file are matched to the rows of another by integer position through the
+    grid, rather than by joining on the pentad ids.
+    """
+
+    def __init__(self, grid_name: str, cell_rows: dict[str, np.ndarray]):
+        self.grid_name = grid_name
+        self.cell_rows = cell_rows
+
+    def cells(self, name: str, n_rows: int) -> np.ndarray:
+        """The grid cell of each of the n_rows rows of a file, -1 if none"""
+        rows = self.cell_rows[name]
+        in_file = np.flatnonzero(rows >= 0)
+
+        cells = np.full(n_rows, -1, dtype=np.int64)
+        cells[rows[in_file]] = in_file
+        return cells
+
+    def rows(self, source: str, n_rows: int, target: str) -> np.ndarray:
+        """
+        The row in the target file of each of the n_rows rows of the source
+        file, -1 for the rows whose pentad is not in the target.
+        """
+        cells = self.cells(source, n_rows)
+        return np.where(cells >= 0, self.cell_rows[target][cells], -1)
+
+
+def load_alignment(
+    input_data_path: str,
+    grid_name: str,
+    covariates_file: str,
+    observation_files: list[str],
+    pentads: dict[str, np.ndarray] | None = None,
+) -> PentadAlignment:
+    """
+    Load the alignment of the covariates and the observation files to the
+    grid, stored next to the covariates (see alignment_path). A file is
+    aligned again if it changed since it was aligned, or if the grid did.
+    The pentads of the files can be passed in if they were already read,
+    otherwise they are read from the files.
+
+    Each file is checked to have every pentad at most once. The alignment of
+    any other files that was stored is kept, as long as they exist.
+    """
+    pentads = pentads or {}
+    path = alignment_path(input_data_path, covariates_file)
+    grid_digest = array_digest(get_grid(grid_name).cells.astype(str), grid_name)
+
+    stored = {}
+    if os.path.exists(path):
+        with np.load(path, allow_pickle=False) as f:
+            if str(f["grid"]) == grid_digest:
+                stored = dict(zip(f["names"].tolist(), zip(f["signatures"], f["rows"])))
+
+    # Forget the files that were removed since
+    changed = False
+    for name in list(stored):
+        if not os.path.exists(os.path.join(input_data_path, name)):
+            del stored[name]
+            changed = True
+
+    for name in [covariates_file] + observation_files:
+        signature = _file_signature(os.path.join(input_data_path, name))
+        if name in stored and np.array_equal(stored[name][0], signature):
+            continue
+
+        print(f"Aligning {name} to the {grid_name} grid", flush=True)
+        file_pentads = pentads.get(name)
+        if file_pentads is None:
+            file_pentads = read_pentads(os.path.join(input_data_path, name))
+
+        stored[name] = (signature, cell_rows(file_pentads, grid_name, name))
+        changed = True
+
+    if changed:
+        names = list(stored)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(
+            tmp_path,
+            grid=np.array(grid_digest),
+            names=np.array(names, dtype=str),
+            signatures=np.stack([stored[n][0] for n in names]),
+            rows=np.stack([stored[n][1] for n in names]),
+        )
+        os.replace(tmp_path, path)
+
+    return PentadAlignment(
+        grid_name, {name: rows for name, (_, rows) in stored.items()}
+    )
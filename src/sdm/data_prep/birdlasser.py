@@ -1,44 +1,53 @@
 import os
-from tqdm import tqdm
+import numpy as np
 import pandas as pd
 
-from .two_km_grid import add_two_km_pentad_from_lat_long
+from .dtypes import write_counts
+from .grids import get_grid
+from .species_matrix import species_count_matrix
 
 
-def combine_birdlasser_files(
-    birdlasser_dir: str, pentad_list_path: str, aggregate_dir: str, output_file: str
-):
-    all_files = [f for f in os.listdir(birdlasser_dir) if f.endswith(".csv")]
+def _species_cells(file_path: str, grid_name: str) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Count the observations of the species per grid cell, placing each
+    observation with the grid's bounding box index. Returns the positions of
+    the cells in the grid and the count for each.
+    """
+    observations = pd.read_csv(
+        file_path, usecols=["locationLatitude", "locationLongitude"]
+    )
 
-    # Load the reference pentad list
-    reference_df = pd.read_csv(pentad_list_path)[["pentad"]]
+    cells = get_grid(grid_name).locate(
+        observations["locationLatitude"].to_numpy(dtype=np.float64),
+        observations["locationLongitude"].to_numpy(dtype=np.float64),
+    )
 
-    grid_df = pd.read_csv('src/google_ee/assets/grid_2km.csv')
+    return np.unique(cells[cells >= 0], return_counts=True)
 
-    for file in tqdm(all_files, desc="Processing files"):
-        species_id = int(file.split(".")[0])
-        # Read the file
-        file_path = os.path.join(birdlasser_dir, file)
-        observations = pd.read_csv(file_path)
 
-        observations = observations[['locationLatitude', 'locationLongitude']]
+def combine_birdlasser_files(
+    birdlasser_dir: str,
+    grid_name: str,
+    aggregate_dir: str,
+    output_file: str,
+    workers: int = 1,
+):
+    all_files = [f for f in os.listdir(birdlasser_dir) if f.endswith(".csv")]
 
-        add_two_km_pentad_from_lat_long(
-            observations,
-            grid_df,
-            lat_column_name="locationLatitude",
-            lng_column_name="locationLongitude"
-        )
+    species_ids, matrix = species_count_matrix(
+        birdlasser_dir, all_files, grid_name, _species_cells, workers
+    )
 
-        # Group and merge
-        grouped = observations.groupby("pentad").size().reset_index(name='observed')
-        grouped[species_id] = grouped["observed"].astype(int)
-        reference_df = reference_df.merge(
-            grouped[["pentad", species_id]], on="pentad", how="left"
-        )
-        reference_df[species_id] = reference_df[species_id].fillna(0).astype(int)
+    # The reference pentad list with a column per species
+    reference_df = pd.concat(
+        [
+            pd.DataFrame({"pentad": get_grid(grid_name).cells}),
+            pd.DataFrame(matrix, columns=species_ids),
+        ],
+        axis=1,
+    )
 
     # Save output
     output_path = os.path.join(aggregate_dir, output_file)
-    reference_df.to_feather(output_path)
-    print(reference_df.head())
\ No newline at end of file
+    write_counts(reference_df, output_path)
+    print(reference_df.head())
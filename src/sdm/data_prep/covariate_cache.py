@@ -0,0 +1,85 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from .ingest_manifest import file_sha256
+
+# Bump to rebuild every cached covariate artifact when the way they are built
+# changes
+CACHE_VERSION = 1
+
+
+def cache_path(artifact_path: str) -> str:
+    """The cache record kept next to a covariate artifact"""
+    return os.path.splitext(artifact_path)[0] + ".cache.json"
+
+
+def load_cache(artifact_path: str) -> dict:
+    path = cache_path(artifact_path)
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_cache(artifact_path: str, record: dict):
+    """Write the cache record atomically, so a crash never leaves half a file"""
+    path = cache_path(artifact_path)
+    tmp_path = f"{path}.tmp"
+
+    with open(tmp_path, "w") as f:
+        json.dump(record, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def input_fingerprints(paths: list[str], previous: dict | None = None) -> dict:
+    """
+    The size, mtime and sha256 of each input file, keyed on the file name.
+    Files are only hashed again if their size or mtime changed since the
+    previous fingerprints.
+    """
+    previous = previous or {}
+    fingerprints = {}
+
+    for path in sorted(paths, key=os.path.basename):
+        stat = os.stat(path)
+        fingerprint = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+        known = previous.get(os.path.basename(path), {})
+        if known.get("size") == stat.st_size and known.get("mtime_ns") == stat.st_mtime_ns:
+            fingerprint["sha256"] = known["sha256"]
+        else:
+            fingerprint["sha256"] = file_sha256(path)
+
+        fingerprints[os.path.basename(path)] = fingerprint
+
+    return fingerprints
+
+
+def cache_key(fingerprints: dict, params: dict) -> str:
+    """
+    The key of an artifact, a hash of the content of its inputs and the
+    parameters it was built with. Touching an input without changing it does
+    not change the key.
+    """
+    content = {name: f["sha256"] for name, f in fingerprints.items()}
+    payload = json.dumps(
+        {"version": CACHE_VERSION, "inputs": content, "params": params}, sort_keys=True
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def is_cached(artifact_path: str, record: dict, key: str) -> bool:
+    return os.path.exists(artifact_path) and record.get("key") == key
+
+
+def array_digest(values: np.ndarray, *parts: str) -> str:
+    """sha256 of the bytes of an array, along with some identifying strings"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+    digest.update(np.ascontiguousarray(values).tobytes())
+    return digest.hexdigest()
@@ -0,0 +1,210 @@
+import os
+from functools import cache
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from .dtypes import COVARIATE_DTYPE, ID_COLUMNS
+from .utils import PENTAD_KEY_COLUMN
+
+# The matrix and its index are stored next to the covariates Feather file
+MATRIX_SUFFIX = ".matrix.npy"
+INDEX_SUFFIX = ".index.npz"
+
+# The most characters of a pentad id stored in the index, which is written a
+# block of rows at a time into fixed width arrays
+INDEX_ID_WIDTH = 16
+
+
+def matrix_paths(feather_path: str) -> tuple[str, str]:
+    """The paths of the matrix and the index for a covariates Feather file"""
+    stem = os.path.splitext(feather_path)[0]
+    return stem + MATRIX_SUFFIX, stem + INDEX_SUFFIX
+
+
+def _source_signature(path: str) -> np.ndarray:
+    """Size and modification time of the Feather file the matrix is built from"""
+    return np.array([os.stat(path).st_size, os.stat(path).st_mtime_ns], dtype=np.int64)
+
+
+class CovariateMatrix:
+    """
+    The scaled covariates as a contiguous, row-major COVARIATE_DTYPE matrix,
+    memory-mapped read-only, with an index of the pentad (and pentad_key)
+    of each row and the name of each feature column.
+
+    Every process that maps the same file shares its pages, so training and
+    predicting any number of species never copies the full matrix. Rows are
+    gathered as they are needed.
+    """
+
+    def __init__(self, values: np.ndarray, index: pd.core.frame.DataFrame, features):
+        self.values = values
+        self.index = index
+        self.features = list(features)
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def pentads(self) -> np.ndarray:
+        return self.index["pentad"].to_numpy()
+
+
+class CovariateMatrixWriter:
+    """
+    Writes the matrix of a covariates Feather file and the index of its rows
+    a block of rows at a time, straight into memory-mapped .npy files. The
+    index is moved into its .npz file on close, which has to happen after the
+    Feather file itself is written.
+    """
+
+    def __init__(self, feather_path: str, n_rows: int, features: list[str]):
+        self.feather_path = feather_path
+        self.features = list(features)
+        self.n_rows = n_rows
+        self._tmp_suffix = f".{os.getpid()}.tmp"
+
+        matrix_path, index_path = matrix_paths(feather_path)
+        self._matrix = np.lib.format.open_memmap(
+            matrix_path + self._tmp_suffix + ".npy",
+            mode="w+",
+            dtype=COVARIATE_DTYPE,
+            shape=(n_rows, len(self.features)),
+        )
+        self._index_prefix = index_path + self._tmp_suffix
+        self._index = {"pentad": self._open_index("pentad", f"<U{INDEX_ID_WIDTH}")}
+
+    def _open_index(self, column: str, dtype) -> np.ndarray:
+        return np.lib.format.open_memmap(
+            f"{self._index_prefix}.{column}.npy",
+            mode="w+",
+            dtype=dtype,
+            shape=(self.n_rows,),
+        )
+
+    def write(self, start: int, block: np.ndarray, index_df: pd.core.frame.DataFrame):
+        """Write a block of rows, along with the index (pentad and pentad_key) of each"""
+        pentads = index_df["pentad"].to_numpy(dtype=str)
+        if len(pentads) and np.char.str_len(pentads).max() > INDEX_ID_WIDTH:
+            raise ValueError(
+                f"Pentad ids of more than {INDEX_ID_WIDTH} characters can not be indexed"
+            )
+
+        if PENTAD_KEY_COLUMN in index_df.columns and PENTAD_KEY_COLUMN not in self._index:
+            self._index[PENTAD_KEY_COLUMN] = self._open_index(
+                PENTAD_KEY_COLUMN, index_df[PENTAD_KEY_COLUMN].dtype
+            )
+
+        end = start + len(block)
+        self._matrix[start:end] = block
+        self._index["pentad"][start:end] = pentads
+        if PENTAD_KEY_COLUMN in self._index:
+            self._index[PENTAD_KEY_COLUMN][start:end] = index_df[PENTAD_KEY_COLUMN]
+
+    def close(self):
+        """Write the index of the rows, and move both files into place"""
+        matrix_path, index_path = matrix_paths(self.feather_path)
+
+        self._matrix.flush()
+        del self._matrix
+
+        # The index is copied from the memory-mapped columns a buffer at a time
+        np.savez(
+            self._index_prefix + ".npz",
+            features=np.array(self.features, dtype=str),
+            signature=_source_signature(self.feather_path),
+            **self._index,
+        )
+        for column in list(self._index):
+            del self._index[column]
+            os.remove(f"{self._index_prefix}.{column}.npy")
+
+        # Move the files into place last, so processes that still have the
+        # old matrix mapped keep reading a complete file
+        os.replace(matrix_path + self._tmp_suffix + ".npy", matrix_path)
+        os.replace(self._index_prefix + ".npz", index_path)
+
+
+def write_covariate_matrix(df: pd.core.frame.DataFrame, feather_path: str):
+    """
+    Write the matrix and the index for a covariates frame, alongside the
+    Feather file it was saved to.
+    """
+    features = [c for c in df.columns if c not in ID_COLUMNS]
+
+    writer = CovariateMatrixWriter(feather_path, len(df), features)
+    writer.write(
+        0,
+        df[features].to_numpy(dtype=COVARIATE_DTYPE),
+        df[[c for c in ID_COLUMNS if c in df.columns]],
+    )
+    writer.close()
+
+
+def write_covariate_chunks(chunks, feather_path: str, features: list[str], n_rows: int):
+    """
+    Write a covariates Feather file and its matrix from chunks of rows, given
+    as the index (pentad and optionally pentad_key) of the rows along with
+    their COVARIATE_DTYPE values. Only one chunk is held in memory at a time.
+    """
+    tmp_path = f"{feather_path}.tmp"
+    matrix = CovariateMatrixWriter(feather_path, n_rows, features)
+    writer = None
+    start = 0
+
+    for index_df, block in chunks:
+        df = pd.concat(
+            [index_df.reset_index(drop=True), pd.DataFrame(block, columns=features)],
+            axis=1,
+        )
+        batch = pa.RecordBatch.from_pandas(df, preserve_index=False)
+        if writer is None:
+            writer = pa.ipc.new_file(
+                tmp_path, batch.schema, options=pa.ipc.IpcWriteOptions(compression="lz4")
+            )
+        writer.write_batch(batch)
+
+        matrix.write(start, block, index_df)
+        start += len(block)
+
+    if writer is None:
+        pd.DataFrame(columns=["pentad"] + features).to_feather(tmp_path)
+    else:
+        writer.close()
+    os.replace(tmp_path, feather_path)
+
+    matrix.close()
+
+
+def _is_current(feather_path: str) -> bool:
+    matrix_path, index_path = matrix_paths(feather_path)
+    if not (os.path.exists(matrix_path) and os.path.exists(index_path)):
+        return False
+
+    with np.load(index_path, allow_pickle=False) as index:
+        return np.array_equal(index["signature"], _source_signature(feather_path))
+
+
+@cache
+def _map_matrix(matrix_path: str, index_path: str, mtime_ns: int) -> CovariateMatrix:
+    with np.load(index_path, allow_pickle=False) as index:
+        index_df = pd.DataFrame({c: index[c] for c in ID_COLUMNS if c in index.files})
+        features = index["features"]
+
+    return CovariateMatrix(np.load(matrix_path, mmap_mode="r"), index_df, features)
+
+
+def load_covariate_matrix(feather_path: str) -> CovariateMatrix:
+    """
+    Map the covariate matrix of a covariates Feather file. The matrix is
+    (re)built from the Feather file the first time, or if the file changed
+    since it was built. It is mapped once per process.
+    """
+    if not _is_current(feather_path):
+        print(f"Building the covariate matrix for {feather_path}", flush=True)
+        write_covariate_matrix(pd.read_feather(feather_path), feather_path)
+
+    matrix_path, index_path = matrix_paths(feather_path)
+    return _map_matrix(matrix_path, index_path, os.stat(matrix_path).st_mtime_ns)
@@ -0,0 +1,239 @@
+import json
+import os
+
+import numpy as np
+from sklearn.decomposition import IncrementalPCA
+from tqdm import tqdm
+
+from .covariate_cache import cache_key, input_fingerprints
+from .covariate_matrix import load_covariate_matrix, write_covariate_chunks
+from .covariate_scaler import DEFAULT_CHUNK_ROWS
+from .dtypes import COVARIATE_DTYPE
+
+REDUCED_SUFFIX = "_reduced"
+
+CORRELATION_METHOD = "correlation"
+PCA_METHOD = "pca"
+REDUCTION_METHODS = [CORRELATION_METHOD, PCA_METHOD]
+
+# Covariates with an absolute correlation of at least this are clustered,
+# and only the first of each cluster is kept
+DEFAULT_CORRELATION_THRESHOLD = 0.9
+
+# Keep the principal components that explain this much of the variance
+DEFAULT_EXPLAINED_VARIANCE = 0.95
+
+
+def reduced_file_name(file_name: str) -> str:
+    """The name of the reduced version of a covariates file"""
+    stem, extension = os.path.splitext(file_name)
+    return stem + REDUCED_SUFFIX + extension
+
+
+def _reduction_path(feather_path: str) -> str:
+    """The description of a reduction, kept next to the reduced file"""
+    return os.path.splitext(feather_path)[0] + ".json"
+
+
+def _source_key(source_path: str, previous: dict | None = None) -> tuple[dict, str]:
+    """The fingerprint of the covariates a reduction is computed from, and its key"""
+    fingerprints = input_fingerprints([source_path], previous)
+    return fingerprints, cache_key(fingerprints, {})
+
+
+def check_reduction(covariates_path: str):
+    """
+    If the covariates file is a reduction (see reduced_file_name), check that
+    it was computed from the covariates as they are now. Raises a ValueError
+    if they changed since, so a stale reduction is never trained on.
+    """
+    stem = os.path.splitext(os.path.basename(covariates_path))[0]
+    if not stem.endswith(REDUCED_SUFFIX):
+        return
+
+    description = {}
+    if os.path.exists(_reduction_path(covariates_path)):
+        with open(_reduction_path(covariates_path)) as f:
+            description = json.load(f)
+
+    source = description.get("source", stem[: -len(REDUCED_SUFFIX)])
+    source_path = os.path.join(os.path.dirname(covariates_path), source)
+    if (
+        not os.path.exists(source_path)
+        or _source_key(source_path, description.get("inputs"))[1] != description.get("key")
+    ):
+        raise ValueError(
+            f"{os.path.basename(covariates_path)} was not reduced from the current "
+            f"{source}, run reduce-covariates again"
+        )
+
+
+def covariate_correlations(
+    values: np.ndarray, chunk_rows: int = DEFAULT_CHUNK_ROWS
+) -> np.ndarray:
+    """
+    The correlation matrix of the columns of a (memory-mapped) covariate
+    matrix, accumulated a chunk of rows at a time in float64.
+    """
+    n_features = values.shape[1]
+    sums = np.zeros(n_features)
+    products = np.zeros((n_features, n_features))
+
+    for start in range(0, len(values), chunk_rows):
+        block = np.asarray(values[start : start + chunk_rows], dtype=np.float64)
+        sums += block.sum(axis=0)
+        products += block.T @ block
+
+    n = len(values)
+    covariance = products / n - np.outer(sums / n, sums / n)
+    std = np.sqrt(np.clip(np.diag(covariance), 0, None))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        correlations = covariance / np.outer(std, std)
+
+    # Constant columns are not correlated with anything but themselves
+    correlations[~np.isfinite(correlations)] = 0
+    np.fill_diagonal(correlations, 1)
+    return correlations
+
+
+def correlation_clusters(
+    correlations: np.ndarray, features: list[str], threshold: float
+) -> list[list[str]]:
+    """
+    Greedily cluster the features, in order, with every feature that is not
+    in a cluster yet and has an absolute correlation of at least threshold
+    with it. The first feature of each cluster represents it.
+    """
+    clustered = np.zeros(len(features), dtype=bool)
+    clusters = []
+
+    for i in range(len(features)):
+        if clustered[i]:
+            continue
+
+        members = np.flatnonzero(~clustered & (np.abs(correlations[i]) >= threshold))
+        clustered[members] = True
+        clusters.append([features[j] for j in [i] + [j for j in members if j != i]])
+
+    return clusters
+
+
+def _fit_pca(values: np.ndarray, chunk_rows: int) -> IncrementalPCA:
+    n_features = values.shape[1]
+    pca = IncrementalPCA(n_components=n_features)
+
+    # Each partial fit needs at least n_components rows, so a short last
+    # chunk is fitted along with the one before it
+    starts = list(range(0, len(values), max(chunk_rows, n_features)))
+    if len(starts) > 1 and len(values) - starts[-1] < n_features:
+        starts.pop()
+
+    for i, start in enumerate(tqdm(starts, desc="Fitting the PCA")):
+        end = starts[i + 1] if i + 1 < len(starts) else len(values)
+        pca.partial_fit(np.asarray(values[start:end], dtype=np.float64))
+
+    return pca
+
+
+def reduce_covariates(
+    input_data_path: str,
+    covariates_file: str,
+    method: str = CORRELATION_METHOD,
+    threshold: float = DEFAULT_CORRELATION_THRESHOLD,
+    n_components: int | None = None,
+    explained_variance: float = DEFAULT_EXPLAINED_VARIANCE,
+    chunk_rows: int = DEFAULT_CHUNK_ROWS,
+) -> str:
+    """
+    Compute a reduced feature set from the scaled covariates of the whole grid
+    and store it next to them (see reduced_file_name), in the same format so
+    that it can be trained on instead of the full covariates.
+
+    With the correlation method, strongly correlated covariates are clustered
+    and one covariate is kept per cluster. With the pca method the covariates
+    are projected on their principal components (fitted with an incremental
+    PCA), keeping n_components or else enough to explain explained_variance.
+
+    Both read the memory-mapped covariate matrix a chunk at a time. A JSON
+    description of the reduction is saved alongside, with the key of the
+    covariates it was computed from (see check_reduction). Returns the name of
+    the reduced file.
+    """
+    if method not in REDUCTION_METHODS:
+        raise ValueError(
+            f"Unknown reduction method: {method}. Expected one of {REDUCTION_METHODS}"
+        )
+
+    source_path = os.path.join(input_data_path, covariates_file)
+    fingerprints, key = _source_key(source_path)
+    covariates = load_covariate_matrix(source_path)
+    values = covariates.values
+
+    output_file = reduced_file_name(covariates_file)
+    output_path = os.path.join(input_data_path, output_file)
+
+    if method == CORRELATION_METHOD:
+        clusters = correlation_clusters(
+            covariate_correlations(values, chunk_rows), covariates.features, threshold
+        )
+        features = [cluster[0] for cluster in clusters]
+        columns = [covariates.features.index(f) for f in features]
+        description = {"threshold": threshold, "clusters": clusters}
+
+        def reduce(block):
+            return block[:, columns]
+
+    else:
+        pca = _fit_pca(values, chunk_rows)
+        cumulative = np.cumsum(pca.explained_variance_ratio_)
+        if n_components is None:
+            n_components = int(np.searchsorted(cumulative, explained_variance) + 1)
+        n_components = min(n_components, len(cumulative))
+
+        features = [f"pc{i + 1}" for i in range(n_components)]
+        components = pca.components_[:n_components]
+        description = {
+            "explained_variance": float(cumulative[n_components - 1]),
+            "explained_variance_ratio": (
+                pca.explained_variance_ratio_[:n_components].tolist()
+            ),
+            "mean": pca.mean_.tolist(),
+            "components": components.tolist(),
+        }
+
+        def reduce(block):
+            return (block.astype(np.float64) - pca.mean_) @ components.T
+
+    print(
+        f"Reduced {len(covariates.features)} covariates to {len(features)} ({method})",
+        flush=True,
+    )
+
+    def chunks():
+        for start in range(0, len(values), chunk_rows):
+            yield (
+                covariates.index.iloc[start : start + chunk_rows],
+                np.ascontiguousarray(
+                    reduce(values[start : start + chunk_rows]), dtype=COVARIATE_DTYPE
+                ),
+            )
+
+    write_covariate_chunks(chunks(), output_path, features, len(values))
+
+    with open(_reduction_path(output_path), "w") as f:
+        json.dump(
+            {
+                "method": method,
+                "source": covariates_file,
+                "key": key,
+                "inputs": fingerprints,
+                "source_features": covariates.features,
+                "features": features,
+                **description,
+            },
+            f,
+            indent=2,
+        )
+
+    return output_file
@@ -0,0 +1,134 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from .dtypes import COVARIATE_DTYPE
+
+# Rows of the covariates held in memory at a time
+DEFAULT_CHUNK_ROWS = 65536
+
+
+class RunningStats:
+    """
+    The count, mean and sum of squared deviations of each column, along with
+    the number of NaNs, updated a chunk of rows at a time. Chunks are merged
+    with the pairwise update of Chan et al., so the result matches the
+    statistics of all of the rows at once.
+
+    NaNs are left out of the statistics, as StandardScaler does.
+    """
+
+    def __init__(self, n_columns: int):
+        self.count = np.zeros(n_columns, dtype=np.int64)
+        self.nan_count = np.zeros(n_columns, dtype=np.int64)
+        self._mean = np.zeros(n_columns, dtype=np.float64)
+        self._m2 = np.zeros(n_columns, dtype=np.float64)
+
+    def update(self, block: np.ndarray):
+        block = block.astype(np.float64)
+        count = (~np.isnan(block)).sum(axis=0)
+        self.nan_count += len(block) - count
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.nansum(block, axis=0) / count
+            m2 = np.nansum((block - mean) ** 2, axis=0)
+
+            total = self.count + count
+            delta = mean - self._mean
+            merged_mean = self._mean + delta * count / total
+            merged_m2 = self._m2 + m2 + delta**2 * self.count * count / total
+
+        observed = count > 0
+        self._mean = np.where(observed, merged_mean, self._mean)
+        self._m2 = np.where(observed, merged_m2, self._m2)
+        self.count = total
+
+    @property
+    def mean(self) -> np.ndarray:
+        return np.where(self.count > 0, self._mean, np.nan)
+
+    @property
+    def scale(self) -> np.ndarray:
+        """The standard deviation, with 1 for constant columns as StandardScaler"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            scale = np.sqrt(self._m2 / self.count)
+        return np.where(scale < 10 * np.finfo(np.float64).eps, 1.0, scale)
+
+
+def iter_feather_chunks(path: str, chunk_rows: int = DEFAULT_CHUNK_ROWS):
+    """
+    Yield a Feather file as DataFrames of at most chunk_rows rows. Only one
+    record batch is decompressed at a time.
+    """
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            for start in range(0, batch.num_rows, chunk_rows):
+                yield batch.slice(start, chunk_rows).to_pandas()
+
+
+class FeatherRows:
+    """
+    Looks up the rows of a Feather file by their pentad. Only the pentad
+    column is held in memory, the record batches holding the rows that are
+    asked for are read as they are needed.
+    """
+
+    def __init__(self, path: str):
+        self._source = pa.memory_map(path)
+        self._reader = pa.ipc.open_file(self._source)
+        names = self._reader.schema.names
+        self.columns = [c for c in names if c != "pentad"]
+
+        pentad_reader = pa.ipc.open_file(
+            self._source,
+            options=pa.ipc.IpcReadOptions(included_fields=[names.index("pentad")]),
+        )
+        pentads = [
+            pentad_reader.get_batch(i).column(0).to_numpy(zero_copy_only=False)
+            for i in range(pentad_reader.num_record_batches)
+        ]
+
+        self._offsets = np.cumsum([0] + [len(p) for p in pentads])
+
+        # The first row of each pentad
+        index = pd.Index(np.concatenate(pentads + [np.empty(0, dtype=object)]))
+        first = ~index.duplicated()
+        self._index = index[first]
+        self._rows = np.flatnonzero(first)
+
+        self._batch_index = -1
+        self._batch = None
+
+    def close(self):
+        self._source.close()
+
+    def _get_batch(self, i: int) -> np.ndarray:
+        # Rows are asked for in (close to) file order, so keep the last batch
+        if i != self._batch_index:
+            batch = self._reader.get_batch(i)
+            self._batch = np.column_stack(
+                [batch.column(c).to_numpy(zero_copy_only=False) for c in self.columns]
+            ).astype(COVARIATE_DTYPE, copy=False)
+            self._batch_index = i
+        return self._batch
+
+    def take(self, pentads: np.ndarray) -> np.ndarray:
+        """
+        The values of the rows of the pentads, in the order given, with NaN
+        for the pentads that are not in the file. The first row is used for a
+        pentad that is in the file more than once.
+        """
+        found = self._index.get_indexer(pentads)
+        rows = np.full(len(pentads), -1, dtype=np.int64)
+        rows[found >= 0] = self._rows[found[found >= 0]]
+
+        values = np.full((len(pentads), len(self.columns)), np.nan, dtype=COVARIATE_DTYPE)
+        batches = np.searchsorted(self._offsets, rows, side="right") - 1
+
+        for i in np.unique(batches[rows >= 0]):
+            in_batch = (batches == i) & (rows >= 0)
+            values[in_batch] = self._get_batch(i)[rows[in_batch] - self._offsets[i]]
+
+        return values
@@ -1,12 +1,42 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import pandas as pd
-import pyarrow.feather as feather
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 from sklearn.preprocessing import StandardScaler
 from tqdm import tqdm
 
+from .covariate_cache import (
+    array_digest,
+    cache_key,
+    input_fingerprints,
+    is_cached,
+    load_cache,
+    save_cache,
+)
+from .covariate_matrix import write_covariate_chunks
+from .covariate_scaler import (
+    DEFAULT_CHUNK_ROWS,
+    FeatherRows,
+    RunningStats,
+    iter_feather_chunks,
+)
+from .dtypes import COVARIATE_DTYPE, write_covariates
+from .grids import get_grid
+from .sparse_observations import feather_columns
+from .utils import add_pentad_key
+
+# Number of covariate files read at the same time
+DEFAULT_READ_WORKERS = 4
+
 
 def scale_covariates(covariates_df: pd.core.frame.DataFrame) -> pd.core.frame.DataFrame:
+    """
+    Standard scale the covariate columns in memory. combine_and_scale_all_covariates
+    streams the same scaling, for covariates that do not fit in memory.
+    """
     scaler = StandardScaler()
     X = covariates_df.drop("pentad", axis=1)
     X_scaled = scaler.fit_transform(X)
@@ -17,136 +47,369 @@ def scale_covariates(covariates_df: pd.core.frame.DataFrame) -> pd.core.frame.Da
     return pd.concat([covariates_df["pentad"], df_scaled], axis=1)
 
 
+def _merged_chunks(
+    combined_google_ee_feather_path: str, bioclim_rows: FeatherRows, chunk_rows: int
+):
+    """
+    Yield the pentads and covariates of the Google EE rows, with the bioclim
+    covariates of the same pentads alongside (a left join), a chunk at a time.
+    """
+    google_ee_columns = [
+        c for c in feather_columns(combined_google_ee_feather_path) if c != "pentad"
+    ]
+
+    for chunk in iter_feather_chunks(combined_google_ee_feather_path, chunk_rows):
+        pentads = chunk["pentad"].to_numpy()
+        yield pentads, np.hstack(
+            [
+                chunk[google_ee_columns].to_numpy(dtype=COVARIATE_DTYPE),
+                bioclim_rows.take(pentads),
+            ]
+        )
+
+
+def _scaler_stats(features: list[str], stats: RunningStats) -> dict:
+    """The mean, scale and NaN count of each covariate"""
+    return {
+        feature: {
+            "mean": float(stats.mean[j]),
+            "scale": float(stats.scale[j]),
+            "nan_count": int(stats.nan_count[j]),
+        }
+        for j, feature in enumerate(features)
+    }
+
+
+def _scaled_chunks(chunks, features: list[str], scaler_stats: dict, store_pentad_key: bool):
+    """
+    Scale each chunk as StandardScaler does (in float32) and fill the missing
+    values with the mean of the scaled covariate. Yields the pentads of each
+    chunk along with the scaled values.
+    """
+    mean = np.array([scaler_stats[f]["mean"] for f in features])
+    scale = np.array([scaler_stats[f]["scale"] for f in features])
+
+    # The mean of the scaled values, which is only off 0 by the rounding of
+    # the mean to float32
+    fill = ((mean - mean.astype(COVARIATE_DTYPE)) / scale.astype(COVARIATE_DTYPE)).astype(
+        COVARIATE_DTYPE
+    )
+
+    for pentads, block in chunks:
+        block -= mean.astype(COVARIATE_DTYPE)
+        block /= scale.astype(COVARIATE_DTYPE)
+        block = np.where(np.isnan(block), fill, block)
+
+        # Make sure the letters in the pentad column are all lowercase
+        index_df = pd.DataFrame({"pentad": pd.Series(pentads).str.lower()})
+        if store_pentad_key:
+            add_pentad_key(index_df)
+
+        yield index_df, block
+
+
 def combine_and_scale_all_covariates(
     combined_google_ee_file: str,
     combined_bioclim_file: str,
     output_dir: str,
     output_file_name: str,
-    force_reload=True,
-) -> pd.core.frame.DataFrame:
+    force_reload=False,
+    store_pentad_key: bool = False,
+    chunk_rows: int = DEFAULT_CHUNK_ROWS,
+):
     """
-    Combine the Google EE + Bioclim data
+    Combine the Google EE + Bioclim data, standard scale each covariate and
+    fill the missing values with the mean of the scaled covariate.
+
+    The covariates are streamed in chunks of chunk_rows rows, so memory does
+    not grow with the size of the grid. The first pass accumulates the
+    running mean, variance and NaN count of each covariate, the second scales
+    and imputes each chunk and writes it straight to the output file and the
+    covariate matrix. The result matches scale_covariates to float32
+    precision.
+
+    The result is cached on the content of the two combined files, and is
+    only rebuilt when they change (or with force_reload).
     """
-    # first check if the processed version of the file exists
-
     feather_path = output_dir + "/" + output_file_name
 
     combined_google_ee_feather_path = output_dir + "/" + combined_google_ee_file
     combined_bioclim_feather_path = output_dir + "/" + combined_bioclim_file
 
-    if os.path.exists(feather_path) and not force_reload:
-        print("Cached scaled covariates file already exists...")
+    record = load_cache(feather_path)
+    fingerprints = input_fingerprints(
+        [combined_google_ee_feather_path, combined_bioclim_feather_path],
+        record.get("inputs"),
+    )
+    params = {"scaler": "standard", "impute": "mean", "store_pentad_key": store_pentad_key}
+    key = cache_key(fingerprints, params)
+
+    if not force_reload and is_cached(feather_path, record, key):
+        print("Cached scaled covariates file is up to date...")
         return
-    else:
-        # load and flatten all of the bioclim files
-        df_covariates = feather.read_feather(combined_google_ee_feather_path)
-        # load the covariates exported from Google EE
-        df_google_ee_covariates = feather.read_feather(combined_bioclim_feather_path)
-
-        df_final = pd.merge(
-            df_covariates, df_google_ee_covariates, on="pentad", how="left"
+
+    bioclim_rows = FeatherRows(combined_bioclim_feather_path)
+    try:
+        features = [
+            c for c in feather_columns(combined_google_ee_feather_path) if c != "pentad"
+        ] + bioclim_rows.columns
+
+        def chunks():
+            return _merged_chunks(combined_google_ee_feather_path, bioclim_rows, chunk_rows)
+
+        # First pass, the statistics of each covariate
+        stats = RunningStats(len(features))
+        n_rows = 0
+        for _, block in tqdm(chunks(), desc="Fitting the scaler"):
+            stats.update(block)
+            n_rows += len(block)
+
+        scaler_stats = _scaler_stats(features, stats)
+        print(
+            f"Filling {int(stats.nan_count.sum())} missing values in "
+            f"{int((stats.nan_count > 0).sum())} covariates",
+            flush=True,
         )
 
-        # # Fill in any missing values with NaN
-        df_final.fillna(value=np.nan, inplace=True)
+        # Second pass, scale each chunk and write it straight to the output
+        write_covariate_chunks(
+            _scaled_chunks(
+                tqdm(chunks(), desc="Scaling"), features, scaler_stats, store_pentad_key
+            ),
+            feather_path,
+            features,
+            n_rows,
+        )
+    finally:
+        bioclim_rows.close()
 
-        # # Scale the values
-        df_scaled = scale_covariates(df_final)
+    save_cache(
+        feather_path,
+        {"key": key, "inputs": fingerprints, "params": params, "scaler": scaler_stats},
+    )
 
-        # # Make sure the letters in the pentad column are all lowercase
-        df_scaled["pentad"] = df_scaled["pentad"].str.lower()
 
-        mean_values = df_scaled.loc[:, df_scaled.columns != "pentad"].mean()
+def _is_numeric(data_type: pa.DataType) -> bool:
+    # A column that is empty in the first block is inferred as null
+    return (
+        pa.types.is_integer(data_type)
+        or pa.types.is_floating(data_type)
+        or pa.types.is_null(data_type)
+    )
 
-        # Fill NA with mean values for all columns except 'pentad'
-        df_scaled.loc[:, df_scaled.columns != "pentad"] = df_scaled.loc[
-            :, df_scaled.columns != "pentad"
-        ].fillna(mean_values)
 
-        # # We will read from this file next time
-        feather.write_feather(df_scaled, feather_path)
+def _numeric_columns(file_path: str, id_column: str) -> list[str]:
+    """
+    The columns of a layer file other than the id that hold numbers, going by
+    the types Arrow infers from the first block of the file. The other
+    columns are left out, with a message.
+    """
+    reader = pa_csv.open_csv(
+        file_path,
+        convert_options=pa_csv.ConvertOptions(column_types={id_column: pa.string()}),
+    )
+    schema = reader.schema
+    reader.close()
+
+    columns = [f.name for f in schema if f.name != id_column and _is_numeric(f.type)]
+    skipped = [f.name for f in schema if f.name != id_column and not _is_numeric(f.type)]
+    if skipped:
+        print(
+            f"Skipping the non-numeric columns {skipped} of {os.path.basename(file_path)}",
+            flush=True,
+        )
+    return columns
 
 
-def combine_bioclim(bioclim_dir: str, output_dir: str, output_file_name: str) -> pd.core.frame.DataFrame:
+def _read_layer(
+    file_path: str, id_column: str, value_columns: list[str] | None = None
+) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+    """
+    Read the ids and the values of a covariate layer file, with the values
+    parsed straight to COVARIATE_DTYPE by the multi-threaded Arrow CSV
+    reader. Reads every numeric column but the id if value_columns is None.
+    """
+    if value_columns is None:
+        value_columns = _numeric_columns(file_path, id_column)
+
+    table = pa_csv.read_csv(
+        file_path,
+        read_options=pa_csv.ReadOptions(use_threads=True),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=[id_column] + value_columns,
+            column_types={
+                id_column: pa.string(),
+                **{c: pa.from_numpy_dtype(COVARIATE_DTYPE) for c in value_columns},
+            },
+        ),
+    )
+
+    ids = table.column(id_column).to_numpy(zero_copy_only=False)
+    values = {
+        c: table.column(c).to_numpy(zero_copy_only=False).astype(COVARIATE_DTYPE, copy=False)
+        for c in value_columns
+    }
+    return ids, values
+
+
+def _align_layers(files: list[str], layers, grid_name: str) -> pd.core.frame.DataFrame:
+    """
+    Scatter the values of each layer (read from the file of the same
+    position) into the grid's cell order. Returns a frame with a row for each
+    cell that is in at least one layer, with NaN where a layer has no value
+    for the cell. A column that was already read from an earlier file is
+    skipped, with a message.
+    """
+    grid = get_grid(grid_name)
+    present = np.zeros(len(grid), dtype=bool)
+    columns = {}
+    column_files = {}
+    outside = 0
+
+    for file, (ids, values) in zip(files, layers):
+        positions = grid.positions(ids)
+        in_grid = positions >= 0
+        positions = positions[in_grid]
+        outside += int((~in_grid).sum())
+        present[positions] = True
+
+        for name, layer_values in values.items():
+            if name in columns:
+                print(
+                    f"Skipping the covariate column {name} of {file}, it is "
+                    f"already read from {column_files[name]}",
+                    flush=True,
+                )
+                continue
+
+            column = np.full(len(grid), np.nan, dtype=COVARIATE_DTYPE)
+            column[positions] = layer_values[in_grid]
+            columns[name] = column
+            column_files[name] = file
+
+    if outside:
+        print(f"Skipped {outside} covariate rows for cells outside the grid", flush=True)
+
+    return pd.DataFrame(
+        {"pentad": grid.cells[present], **{n: c[present] for n, c in columns.items()}}
+    )
+
+
+def _layers_cache_key(
+    feather_path: str, layer_dir: str, csv_files: list[str], grid_name: str
+) -> tuple[dict, dict, str]:
+    """
+    The cache record of a combined layers file, with the fingerprints of the
+    layer files and the key they give along with the cells of the grid.
+    """
+    record = load_cache(feather_path)
+    fingerprints = input_fingerprints(
+        [os.path.join(layer_dir, f) for f in csv_files], record.get("inputs")
+    )
+    params = {"grid": array_digest(get_grid(grid_name).cells.astype(str), grid_name)}
+
+    return record, fingerprints, cache_key(fingerprints, params)
+
+
+def combine_bioclim(
+    bioclim_dir: str,
+    grid_name: str,
+    output_dir: str,
+    output_file_name: str,
+    workers: int = DEFAULT_READ_WORKERS,
+    force_reload=False,
+) -> pd.core.frame.DataFrame | None:
+    """
+    Combine the bioclim layers into a single file in grid order. Files without
+    an underscore prefix hold a single layer in their MEAN column, named after
+    the file, while files with the prefix hold several layers.
+
+    The result is cached on the content of the layer files, and is only
+    rebuilt when they change (or with force_reload).
+    """
     feather_path = os.path.join(output_dir, output_file_name)
 
     csv_files = [f for f in os.listdir(bioclim_dir) if f.endswith(".csv")]
 
-    # Initialize df_final as None for the first file processing
-    df_final = None
+    record, fingerprints, key = _layers_cache_key(
+        feather_path, bioclim_dir, csv_files, grid_name
+    )
+    if not force_reload and is_cached(feather_path, record, key):
+        print("Cached bioclim file is up to date...")
+        return
 
-    for file in tqdm(csv_files, desc="Processing files"):
-        file_path = os.path.join(bioclim_dir, file)
+    # The single layer files come first, as before
+    csv_files = [f for f in csv_files if not f.startswith("_")] + [
+        f for f in csv_files if f.startswith("_")
+    ]
 
-        if not file.startswith("_"):
-            print("Processing file: " + file, flush=True)
-            # For files without underscore prefix
-            df = pd.read_csv(file_path, usecols=["Name", "MEAN"], dtype=str)
-            col_name = file.rsplit("/", 1)[-1].rstrip(".csv").lower()
-            df.rename(columns={"MEAN": col_name, "Name": "pentad"}, inplace=True)
-            df.set_index("pentad", inplace=True)
-
-            # Append or merge with df_final
-            if df_final is None:
-                df_final = df
-            else:
-                df_final = df_final.join(df, how='left')
-
-    for file in tqdm(csv_files, desc="Processing files"):
+    def read_layer(file):
+        file_path = os.path.join(bioclim_dir, file)
         if file.startswith("_"):
-            print("processing file: " + file, flush=True)
-            print(f"Pre shape: {df_final.shape}", flush=True)
-            file_path = os.path.join(bioclim_dir, file)
-
-            # For files with underscore prefix, include all columns
-            df = pd.read_csv(file_path, dtype=str)
-            df.rename(columns={"Name": "pentad"}, inplace=True)
-            df.set_index("pentad", inplace=True)
-            print(df.head())
-            df_final = df_final.merge(df, on="pentad", how='left')
-            print(f"Post shape: {df_final.shape}", flush=True)
-
-    # # Fill any missing values with 0
-    # df_final.fillna(0, inplace=True)
+            return _read_layer(file_path, "Name")
+
+        # Single layer files are named after the file, e.g. Bio1.csv -> bio1
+        ids, values = _read_layer(file_path, "Name", ["MEAN"])
+        return ids, {file.rsplit("/", 1)[-1].rstrip(".csv").lower(): values["MEAN"]}
+
+    # Arrow releases the GIL while parsing, so the files are read in threads
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        layers = list(
+            tqdm(
+                executor.map(read_layer, csv_files),
+                total=len(csv_files),
+                desc="Processing files",
+            )
+        )
 
-    # Reset index to turn 'pentad' back into a column
-    df_final.reset_index(inplace=True)
+    df_final = _align_layers(csv_files, layers, grid_name)
 
     print(df_final.dtypes)
     print(df_final.head())
 
     # Save the final DataFrame to a Feather file
-    feather.write_feather(df_final, feather_path)
-
+    df_final = write_covariates(df_final, feather_path)
+    save_cache(feather_path, {"key": key, "inputs": fingerprints})
     return df_final
 
+
 def combine_google_ee_covariates(
-    google_ee_dir: str, output_dir: str, output_file_name: str, force_reload=False
-) -> pd.core.frame.DataFrame:
+    google_ee_dir: str,
+    grid_name: str,
+    output_dir: str,
+    output_file_name: str,
+    force_reload=False,
+    workers: int = DEFAULT_READ_WORKERS,
+) -> pd.core.frame.DataFrame | None:
     feather_path = output_dir + "/" + output_file_name
 
-    if os.path.exists(feather_path) and not force_reload:
-        print("Found existing file...")
-
     # Get a list of all CSV files in the folder
     csv_files = [f for f in os.listdir(google_ee_dir) if f.endswith(".csv")]
 
-    # Initialize an empty DataFrame
-    merged_df = None
+    # Only rebuild when the content of the files changed
+    record, fingerprints, key = _layers_cache_key(
+        feather_path, google_ee_dir, csv_files, grid_name
+    )
+    if not force_reload and is_cached(feather_path, record, key):
+        print("Found existing file, the Google EE files are unchanged...")
+        return
 
-    # Iterate over the CSV files
-    for file in tqdm(csv_files, desc="Processing files"):
-        file_path = os.path.join(google_ee_dir, file)
-        # Read each CSV file into a DataFrame
-        df = pd.read_csv(file_path)
+    # Read the files in threads, Arrow releases the GIL while parsing
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        layers = list(
+            tqdm(
+                executor.map(
+                    lambda file: _read_layer(os.path.join(google_ee_dir, file), "pentad"),
+                    csv_files,
+                ),
+                total=len(csv_files),
+                desc="Processing files",
+            )
+        )
 
-        # Check if merged_df is empty (first iteration)
-        if merged_df is None:
-            # Set merged_df to the current DataFrame
-            merged_df = df
-        else:
-            # Merge the current DataFrame with the existing merged_df based on the 'pentad' column
-            merged_df = merged_df.merge(df, on="pentad", how="outer")
+    merged_df = _align_layers(csv_files, layers, grid_name)
 
     # We will read from this file next time
-    feather.write_feather(merged_df, feather_path)
+    merged_df = write_covariates(merged_df, feather_path)
+    save_cache(feather_path, {"key": key, "inputs": fingerprints})
+    return merged_df
@@ -0,0 +1,160 @@
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Responses that are worth retrying, the rest are returned or raised as is
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (10, 120)
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF = 1.0
+
+
+class RateLimiter:
+    """
+    Spaces out the start of requests so that at most `rate` requests start
+    per second, across all of the threads that share it.
+    """
+
+    def __init__(self, rate: float | None):
+        self.interval = 1 / rate if rate else 0
+        self._next_start = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self.interval
+
+        if start > now:
+            time.sleep(start - now)
+
+
+def make_session(pool_size: int) -> requests.Session:
+    """A session that keeps up to pool_size connections open per host"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _retry_delay(attempt: int, backoff: float, response=None) -> float:
+    """
+    Exponential backoff with jitter, or the server's Retry-After if it sent
+    one (in seconds).
+    """
+    if response is not None:
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return float(retry_after)
+
+    delay = backoff * 2**attempt
+    return delay + random.uniform(0, delay / 2)
+
+
+def fetch(
+    session: requests.Session,
+    url: str,
+    rate_limiter: RateLimiter | None = None,
+    headers: dict | None = None,
+    retries: int = DEFAULT_RETRIES,
+    backoff: float = DEFAULT_BACKOFF,
+    timeout: tuple[float, float] = DEFAULT_TIMEOUT,
+) -> requests.Response:
+    """
+    GET a url, retrying connection errors, timeouts and RETRY_STATUS_CODES
+    with exponential backoff. Raises once the retries are used up, or for
+    any other error status.
+    """
+    for attempt in range(retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.wait()
+
+        try:
+            response = session.get(url, headers=headers, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+            time.sleep(_retry_delay(attempt, backoff))
+            continue
+
+        if response.status_code in RETRY_STATUS_CODES and attempt < retries:
+            time.sleep(_retry_delay(attempt, backoff, response))
+            continue
+
+        response.raise_for_status()
+        return response
+
+
+def write_atomic(path: str, content: bytes):
+    """
+    Write to a temporary file in the same directory and move it into place,
+    so an interrupted download never leaves a partial file behind.
+    """
+    directory, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory or ".", prefix=f".{name}.", suffix=".part")
+
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class DownloadManifest:
+    """
+    A JSON record of the state of each download in a directory, keyed on an
+    id. It is saved after every update so an interrupted run can carry on
+    where it stopped. Safe to update from several threads.
+    """
+
+    # Downloads in these states do not need to be fetched again
+    COMPLETE = {"done", "empty"}
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.entries = {}
+
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def __contains__(self, key) -> bool:
+        return str(key) in self.entries
+
+    def get(self, key) -> dict:
+        return self.entries.get(str(key), {})
+
+    def is_complete(self, key) -> bool:
+        return self.get(key).get("status") in self.COMPLETE
+
+    def record(self, key, status: str, **details):
+        with self._lock:
+            self.entries[str(key)] = {
+                **details,
+                "status": status,
+                "updated_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            }
+            self._save()
+
+    def reset(self):
+        with self._lock:
+            self.entries = {}
+            self._save()
+
+    def _save(self):
+        write_atomic(self.path, json.dumps(self.entries, indent=2).encode("utf-8"))
@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+
+from .utils import PENTAD_KEY_COLUMN
+
+# Counts are stored in the smallest of these that holds the largest count
+COUNT_DTYPES = [np.uint16, np.uint32]
+
+COVARIATE_DTYPE = np.float32
+
+# Columns that identify the pentad and keep their own dtype
+ID_COLUMNS = ["pentad", PENTAD_KEY_COLUMN]
+
+
+def count_dtype(max_count: int) -> type:
+    """The smallest count dtype that can hold max_count"""
+    for dtype in COUNT_DTYPES:
+        if max_count <= np.iinfo(dtype).max:
+            return dtype
+
+    raise OverflowError(
+        f"A count of {max_count} does not fit in any of {[d.__name__ for d in COUNT_DTYPES]}"
+    )
+
+
+def check_counts(values: np.ndarray, dtype: type = COUNT_DTYPES[-1]):
+    """Raise if any of the counts are negative or too large for the dtype"""
+    if len(values) == 0:
+        return
+
+    if values.min() < 0:
+        raise ValueError("Counts can not be negative")
+    if values.max() > np.iinfo(dtype).max:
+        raise OverflowError(f"A count of {values.max()} does not fit in {dtype.__name__}")
+
+
+def compact_counts(df: pd.core.frame.DataFrame) -> pd.core.frame.DataFrame:
+    """
+    Store each count column in the smallest count dtype that holds its largest
+    value. Missing counts are treated as 0.
+    """
+    columns = {}
+    for column in df.columns:
+        if column in ID_COLUMNS:
+            columns[column] = df[column]
+            continue
+
+        values = df[column].fillna(0).to_numpy()
+        check_counts(values)
+        columns[column] = values.astype(count_dtype(values.max() if len(values) else 0))
+
+    return pd.DataFrame(columns, index=df.index)
+
+
+def compact_covariates(df: pd.core.frame.DataFrame) -> pd.core.frame.DataFrame:
+    """Store every covariate column as COVARIATE_DTYPE"""
+    return pd.DataFrame(
+        {
+            column: df[column]
+            if column in ID_COLUMNS
+            else pd.to_numeric(df[column]).astype(COVARIATE_DTYPE)
+            for column in df.columns
+        },
+        index=df.index,
+    )
+
+
+def report_memory(name: str, before_bytes: int, after_bytes: int):
+    print(
+        f"{name}: {before_bytes / 1e6:.1f} MB -> {after_bytes / 1e6:.1f} MB in memory",
+        flush=True,
+    )
+
+
+def write_counts(df: pd.core.frame.DataFrame, path: str) -> pd.core.frame.DataFrame:
+    """
+    Write a pentad x species count frame with the compact count dtypes.
+    Returns the compacted frame.
+    """
+    compact_df = compact_counts(df)
+    report_memory(
+        path,
+        df.memory_usage(deep=True).sum(),
+        compact_df.memory_usage(deep=True).sum(),
+    )
+    compact_df.to_feather(path)
+    return compact_df
+
+
+def write_covariates(df: pd.core.frame.DataFrame, path: str) -> pd.core.frame.DataFrame:
+    """
+    Write a pentad x covariates frame with float32 covariates. Returns the
+    compacted frame.
+    """
+    compact_df = compact_covariates(df)
+    report_memory(
+        path,
+        df.memory_usage(deep=True).sum(),
+        compact_df.memory_usage(deep=True).sum(),
+    )
+    compact_df.to_feather(path)
+    return compact_df
@@ -0,0 +1,254 @@
+import os
+from functools import cache
+
+import numpy as np
+import pandas as pd
+
+from ...config import config
+from .two_km_grid import TwoKmGridIndex, add_lat_long_from_two_km_pentad
+from .utils import (
+    add_lat_long_from_pentad,
+    make_dir_if_not_exists,
+    parse_pentad_keys,
+    pentad_keys_from_lat_long,
+    pentad_keys_from_strings,
+    pentad_keys_to_lat_long,
+)
+
+PENTAD_GRID = "pentad"
+TWO_KM_GRID = "2km"
+
+# The config keys for the cell list and (for the 2km grid) the bounding boxes
+# of each grid
+GRID_FILES = {
+    PENTAD_GRID: ("PENTAD_LIST", None),
+    TWO_KM_GRID: ("PENTAD_LIST_2KM", "GRID_2KM_BOUNDING_BOXES"),
+}
+
+# Half a pentad in degrees, used to move from the pentad corner to its centre
+HALF_PENTAD = 2.5 / 60
+
+
+class Grid:
+    """
+    The cells of a grid in the order of the grid's pentad list, along with
+    their coordinates and an index to find the cell for a pentad id or a
+    latitude/longitude.
+
+    latitudes/longitudes are the reference coordinates used throughout the
+    pipeline (the values from add_lat_long_from_pentad and
+    add_lat_long_from_two_km_pentad), while the centroids are the centre of
+    each cell.
+    """
+
+    def __init__(self, name: str, arrays: dict[str, np.ndarray]):
+        self.name = name
+        self.cells = arrays["cells"]
+        self.latitudes = arrays["latitudes"]
+        self.longitudes = arrays["longitudes"]
+        self.centroid_latitudes = arrays["centroid_latitudes"]
+        self.centroid_longitudes = arrays["centroid_longitudes"]
+
+        self._cell_index = pd.Index(self.cells)
+
+        if name == PENTAD_GRID:
+            # Pentads are looked up by their integer key
+            self._key_order = np.argsort(arrays["keys"], kind="stable")
+            self._sorted_keys = arrays["keys"][self._key_order]
+        else:
+            self.bounding_boxes = TwoKmGridIndex(
+                pd.DataFrame(
+                    {
+                        "pentad": arrays["box_pentads"],
+                        "x_min": arrays["x_min"],
+                        "x_max": arrays["x_max"],
+                        "y_max": arrays["y_max"],
+                        "y_min": arrays["y_min"],
+                    }
+                )
+            )
+            # Position in cells for each bounding box (-1 if not in the list)
+            self._box_cells = np.append(self.positions(arrays["box_pentads"]), -1)
+
+    def __len__(self):
+        return len(self.cells)
+
+    def _key_positions(self, keys: np.ndarray) -> np.ndarray:
+        if len(self._sorted_keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+
+        found = np.clip(
+            np.searchsorted(self._sorted_keys, keys), 0, len(self._sorted_keys) - 1
+        )
+        return np.where(
+            self._sorted_keys[found] == keys, self._key_order[found], -1
+        ).astype(np.int64)
+
+    def positions(self, pentads) -> np.ndarray:
+        """
+        Position of each pentad id in the cell list, -1 if it is not in the grid
+        """
+        pentads = np.asarray(pentads)
+
+        if self.name == PENTAD_GRID:
+            # Ids that are not valid pentads can not be in the grid
+            keys, valid = parse_pentad_keys(pentads)
+            return np.where(valid, self._key_positions(keys), -1)
+
+        return self._cell_index.get_indexer(pentads).astype(np.int64)
+
+    def locate(self, latitudes, longitudes) -> np.ndarray:
+        """
+        Position of the cell containing each point, -1 if it is not in the grid
+        """
+        if self.name == PENTAD_GRID:
+            return self._key_positions(pentad_keys_from_lat_long(latitudes, longitudes))
+
+        return self._box_cells[self.bounding_boxes.lookup(longitudes, latitudes)]
+
+    def add_lat_long(
+        self,
+        df: pd.core.frame.DataFrame,
+        lat_column_name: str = "latitude",
+        lng_column_name: str = "longitude",
+        pentad_column_name: str = "pentad",
+    ) -> pd.core.frame.DataFrame:
+        """
+        Add the latitude and longitude columns for the pentads in the df,
+        gathered from the precomputed cell coordinates. Pentads that are not in
+        the grid are parsed from their id.
+        """
+        pentads = df[pentad_column_name].to_numpy()
+        positions = self.positions(pentads)
+
+        latitudes = self.latitudes[positions]
+        longitudes = self.longitudes[positions]
+
+        missing = positions < 0
+        if missing.any():
+            add_lat_long = (
+                add_lat_long_from_pentad
+                if self.name == PENTAD_GRID
+                else add_lat_long_from_two_km_pentad
+            )
+            parsed = add_lat_long(pd.DataFrame({"pentad": pentads[missing]}))
+            latitudes[missing] = parsed["latitude"].to_numpy()
+            longitudes[missing] = parsed["longitude"].to_numpy()
+
+        df[lat_column_name] = latitudes
+        df[lng_column_name] = longitudes
+
+        return df
+
+
+def _source_signature(paths: list[str]) -> np.ndarray:
+    """Size and modification time of the files a grid is built from"""
+    return np.array(
+        [[os.stat(p).st_size, os.stat(p).st_mtime_ns] for p in paths], dtype=np.int64
+    )
+
+
+def _build_arrays(name: str, cells_file: str, bounding_box_file: str | None) -> dict:
+    cells = pd.read_csv(cells_file, usecols=["pentad"])["pentad"].to_numpy(dtype=str)
+
+    if name == PENTAD_GRID:
+        keys = pentad_keys_from_strings(cells)
+        latitudes, longitudes = pentad_keys_to_lat_long(keys)
+
+        # The pentad coordinates are the corner closest to the equator and
+        # the prime meridian
+        return {
+            "cells": cells,
+            "keys": keys,
+            "latitudes": latitudes,
+            "longitudes": longitudes,
+            "centroid_latitudes": latitudes + np.copysign(HALF_PENTAD, latitudes),
+            "centroid_longitudes": longitudes + np.copysign(HALF_PENTAD, longitudes),
+        }
+
+    boxes = pd.read_csv(bounding_box_file)
+    coordinates = pd.Series(cells).str.split("_", expand=True).astype(float)
+    longitudes = coordinates[0].to_numpy() / 100
+    latitudes = -coordinates[1].to_numpy() / 100
+
+    box_pentads = boxes["pentad"].to_numpy(dtype=str)
+    box_positions = pd.Index(box_pentads).get_indexer(cells)
+    in_boxes = box_positions >= 0
+
+    # Cells without a bounding box are centred on their id
+    centroid_longitudes = longitudes.copy()
+    centroid_latitudes = latitudes.copy()
+    centroid_longitudes[in_boxes] = (
+        boxes["x_min"].to_numpy()[box_positions[in_boxes]]
+        + boxes["x_max"].to_numpy()[box_positions[in_boxes]]
+    ) / 2
+    centroid_latitudes[in_boxes] = (
+        boxes["y_min"].to_numpy()[box_positions[in_boxes]]
+        + boxes["y_max"].to_numpy()[box_positions[in_boxes]]
+    ) / 2
+
+    return {
+        "cells": cells,
+        "latitudes": latitudes,
+        "longitudes": longitudes,
+        "centroid_latitudes": centroid_latitudes,
+        "centroid_longitudes": centroid_longitudes,
+        "box_pentads": box_pentads,
+        "x_min": boxes["x_min"].to_numpy(dtype=np.float64),
+        "x_max": boxes["x_max"].to_numpy(dtype=np.float64),
+        "y_min": boxes["y_min"].to_numpy(dtype=np.float64),
+        "y_max": boxes["y_max"].to_numpy(dtype=np.float64),
+    }
+
+
+def load_grid(
+    name: str,
+    cells_file: str,
+    bounding_box_file: str | None = None,
+    cache_dir: str | None = None,
+) -> Grid:
+    """
+    Load a grid from its source CSV files. If a cache_dir is given the arrays
+    are stored there as an uncompressed npz, which is reused for as long as the
+    source files are unchanged.
+    """
+    sources = [p for p in [cells_file, bounding_box_file] if p]
+    signature = _source_signature(sources)
+    cache_path = os.path.join(cache_dir, f"{name}.npz") if cache_dir else None
+
+    if cache_path and os.path.exists(cache_path):
+        with np.load(cache_path, allow_pickle=False) as cached:
+            if np.array_equal(cached["signature"], signature):
+                return Grid(name, {k: cached[k] for k in cached.files})
+
+    arrays = _build_arrays(name, cells_file, bounding_box_file)
+
+    if cache_path:
+        try:
+            make_dir_if_not_exists(cache_dir)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp.npz"
+            np.savez(tmp_path, signature=signature, **arrays)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"Could not cache the {name} grid: {e}", flush=True)
+
+    return Grid(name, arrays)
+
+
+@cache
+def get_grid(name: str) -> Grid:
+    """
+    The grid registry. Each grid is loaded once per process from the files in
+    the config.
+    """
+    if name not in GRID_FILES:
+        raise ValueError(f"Unknown grid: {name}. Expected one of {list(GRID_FILES)}")
+
+    cells_key, bounding_box_key = GRID_FILES[name]
+
+    return load_grid(
+        name,
+        config[cells_key],
+        config[bounding_box_key] if bounding_box_key else None,
+        config["GRID_CACHE_DIR"],
+    )
@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+
+import pandas as pd
+import pyarrow as pa
+
+# Columns used to tell which occurrences are new, in order of preference.
+# gbifIDs are assigned as records are published, so unlike eventDate they
+# also catch old observations that were only recently uploaded.
+WATERMARK_COLUMNS = ["gbifID", "eventDate"]
+
+# The manifest is also stored in the schema metadata of the aggregate, so it
+# is replaced in the same step as the counts it describes
+MANIFEST_METADATA_KEY = b"ingest_manifest"
+
+
+def manifest_path(aggregate_path: str) -> str:
+    """The manifest kept next to an aggregate file"""
+    return os.path.splitext(aggregate_path)[0] + ".manifest.json"
+
+
+def manifest_metadata(manifest: dict) -> dict:
+    """The schema metadata that stores the manifest in the aggregate file"""
+    return {MANIFEST_METADATA_KEY: json.dumps(manifest).encode("utf-8")}
+
+
+def _file_manifest(aggregate_path: str) -> dict | None:
+    """The manifest stored in the schema metadata of the aggregate, if any"""
+    if not os.path.exists(aggregate_path):
+        return None
+
+    with pa.memory_map(aggregate_path) as source:
+        metadata = pa.ipc.open_file(source).schema.metadata or {}
+
+    if MANIFEST_METADATA_KEY not in metadata:
+        return None
+    return json.loads(metadata[MANIFEST_METADATA_KEY])
+
+
+def load_manifest(aggregate_path: str) -> dict | None:
+    """
+    The manifest of an aggregate. The copy in the schema metadata of the
+    aggregate was written along with its counts, so it is used over the JSON
+    file. If a crash left the JSON file behind the file, it is rewritten.
+    """
+    path = manifest_path(aggregate_path)
+    manifest = None
+    if os.path.exists(path):
+        with open(path) as f:
+            manifest = json.load(f)
+
+    file_manifest = _file_manifest(aggregate_path)
+    if file_manifest is None:
+        return manifest
+
+    if file_manifest != manifest:
+        print(f"Updating {path} from {aggregate_path}", flush=True)
+        save_manifest(aggregate_path, file_manifest)
+    return file_manifest
+
+
+def save_manifest(aggregate_path: str, manifest: dict):
+    """Write the manifest atomically, so a crash never leaves half a file"""
+    path = manifest_path(aggregate_path)
+    tmp_path = f"{path}.tmp"
+
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def new_manifest(source_file: str, grid_name: str, watermark: dict) -> dict:
+    """The manifest of an aggregate built from a full occurrence file"""
+    return {
+        "grid": grid_name,
+        "watermark": watermark,
+        "ingested": [_ingest_record(source_file, None)],
+    }
+
+
+def add_to_manifest(manifest: dict, delta_file: str, digest: str, watermark: dict):
+    """Record an applied delta and move the watermark forward"""
+    manifest["watermark"] = merge_watermarks([manifest["watermark"], watermark])
+    manifest["ingested"].append(_ingest_record(delta_file, digest))
+
+
+def is_ingested(manifest: dict, digest: str) -> bool:
+    return any(record.get("sha256") == digest for record in manifest["ingested"])
+
+
+def _ingest_record(path: str, digest: str | None) -> dict:
+    return {
+        "file": os.path.basename(path),
+        "size": os.path.getsize(path),
+        "sha256": digest,
+        "ingested_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+    }
+
+
+def file_sha256(path: str, block_size: int = 16 * 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(block_size):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def chunk_watermark(chunk: pd.core.frame.DataFrame) -> dict:
+    """The highest value of each watermark column in a chunk of occurrences"""
+    watermark = {}
+
+    if "gbifID" in chunk.columns and chunk["gbifID"].notna().any():
+        watermark["gbifID"] = int(chunk["gbifID"].max())
+
+    if "eventDate" in chunk.columns and chunk["eventDate"].notna().any():
+        watermark["eventDate"] = str(chunk["eventDate"].dropna().astype(str).max())
+
+    return watermark
+
+
+def merge_watermarks(watermarks: list[dict]) -> dict:
+    merged = {}
+    for watermark in watermarks:
+        for column, value in watermark.items():
+            merged[column] = value if column not in merged else max(merged[column], value)
+    return merged
+
+
+def newer_than_watermark(chunk: pd.core.frame.DataFrame, watermark: dict) -> pd.Series:
+    """
+    Mask of the occurrences in the chunk that are past the watermark. Each
+    occurrence is compared on the first of the WATERMARK_COLUMNS that it and
+    the watermark have a value for, so an occurrence without a gbifID is
+    compared on its eventDate. Occurrences with none of them can not be
+    compared and are left out, with a message. If the chunk has none of the
+    columns at all, every occurrence is past the watermark.
+    """
+    columns = [
+        column
+        for column in WATERMARK_COLUMNS
+        if column in chunk.columns
+        and chunk[column].notna().any()
+        and watermark.get(column) is not None
+    ]
+    if not columns:
+        return pd.Series(True, index=chunk.index)
+
+    newer = pd.Series(False, index=chunk.index)
+    undecided = pd.Series(True, index=chunk.index)
+    for column in columns:
+        values = chunk[column]
+        compared = undecided & values.notna()
+        if column == "eventDate":
+            values = values.astype(object).where(values.notna(), "")
+
+        newer[compared] = values[compared] > watermark[column]
+        undecided &= ~compared
+
+    if undecided.any():
+        print(
+            f"Skipped {undecided.sum()} occurrences with no {' or '.join(columns)} "
+            "to compare to the watermark",
+            flush=True,
+        )
+    return newer
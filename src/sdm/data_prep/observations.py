@@ -1,107 +1,528 @@
+import copy
+import io
 import os
-import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
-from .utils import (
-    add_pentad_from_lat_long,
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from .accumulator import CountAccumulator
+from .dtypes import COUNT_DTYPES, check_counts, report_memory, write_counts
+from .grids import TWO_KM_GRID, get_grid
+from .ingest_manifest import (
+    WATERMARK_COLUMNS,
+    add_to_manifest,
+    chunk_watermark,
+    file_sha256,
+    is_ingested,
+    load_manifest,
+    manifest_metadata,
+    merge_watermarks,
+    new_manifest,
+    newer_than_watermark,
+    save_manifest,
+)
+from .occurrences import (
+    CSV_READ_OPTIONS,
+    is_converted,
+    occurrence_batch_count,
+    read_occurrence_batches,
+    read_unique_species,
 )
-from .two_km_grid import (
-    add_two_km_pentad_from_lat_long
+from .sparse_observations import (
+    ID_COLUMNS,
+    feather_columns,
+    read_observation_columns,
+    sparse_file_name,
+    write_sparse_observations,
+)
+from .species_columns import SpeciesColumns
+from .utils import (
+    PENTAD_KEY_COLUMN,
+    add_pentad_key,
+    pentad_keys_to_strings,
 )
 
-def aggregate_by_pentad_and_sabap_ids(
-    input_data_path: str,
-    input_csv_file: str,
-    output_file: str,
-    bird_list_file: str,
-    pentad_list_file: str,
-    aggregate_dir: str,
-    join_column: str,
-    use_2km_pentad: bool = False,
+
+# Only these columns of the GBIF occurrence files are used when aggregating
+OCCURRENCE_COLUMNS = ["species", "decimalLatitude", "decimalLongitude"]
+
+# Size of the byte ranges handed to each worker when aggregating in parallel
+BYTE_RANGE_SIZE = 256 * 1024 * 1024
+
+CHUNK_SIZE = int(1e6)  # Adjust based on memory
+
+
+def _read_columns(filepath: str) -> list[str]:
+    """The OCCURRENCE_COLUMNS plus the WATERMARK_COLUMNS that the file has"""
+    if is_converted(filepath):
+        names = feather_columns(filepath)
+    else:
+        names = pd.read_csv(filepath, nrows=0, **CSV_READ_OPTIONS).columns
+
+    return OCCURRENCE_COLUMNS + [c for c in WATERMARK_COLUMNS if c in names]
+
+
+def _group_chunk(
+    chunk: pd.core.frame.DataFrame,
+    species_columns: SpeciesColumns,
+    grid_name: str,
+    watermark: dict | None = None,
+) -> tuple[pd.core.frame.DataFrame, dict]:
+    """
+    Count the observations in a chunk of occurrences per grid cell and species
+    column. If a watermark is given only the occurrences past it are counted.
+    Returns the counts and the watermark of the counted occurrences.
+    """
+    grid = get_grid(grid_name)
+
+    if watermark:
+        chunk = chunk[newer_than_watermark(chunk, watermark)]
+    counted_watermark = chunk_watermark(chunk)
+
+    species = species_columns.codes(chunk["species"])
+
+    # The position of the cell in the grid
+    cells = grid.locate(
+        chunk["decimalLatitude"].to_numpy(), chunk["decimalLongitude"].to_numpy()
+    )
+    # remove any observations that were not in the grid
+    in_grid = cells >= 0
+
+    keys, counts = np.unique(
+        cells[in_grid] * len(species_columns) + species[in_grid], return_counts=True
+    )
+    grouped = pd.DataFrame(
+        {
+            "cell": keys // len(species_columns),
+            "species": keys % len(species_columns),
+            "count": counts,
+        }
+    )
+    return grouped, counted_watermark
+
+
+def _byte_ranges(filepath: str, range_size: int) -> tuple[list[str], list[tuple[int, int]]]:
+    """
+    Split a tab separated file into (start, end) byte ranges of roughly
+    range_size bytes, each ending on a line break. Returns the header columns
+    along with the ranges.
+    """
+    file_size = os.path.getsize(filepath)
+
+    with open(filepath, "rb") as f:
+        header = f.readline()
+        columns = header.decode("utf-8").rstrip("\r\n").split("\t")
+
+        ranges = []
+        start = len(header)
+        while start < file_size:
+            f.seek(min(start + range_size, file_size))
+            # Move on to the end of the current line
+            f.readline()
+            end = min(f.tell(), file_size)
+            ranges.append((start, end))
+            start = end
+
+    return columns, ranges
+
+
+def _group_byte_range(
+    byte_range: tuple[int, int],
+    filepath: str,
+    columns: list[str],
+    read_columns: list[str],
+    species_columns: SpeciesColumns,
+    grid_name: str,
+    watermark: dict | None,
+) -> tuple[pd.core.frame.DataFrame, dict]:
+    """
+    Worker for the parallel aggregation. Parses the lines in the byte range
+    and returns the grouped counts.
+    """
+    start, end = byte_range
+    with open(filepath, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    grouped_chunks, watermarks = zip(
+        *[
+            _group_chunk(chunk, species_columns, grid_name, watermark)
+            for chunk in pd.read_csv(
+                io.BytesIO(data),
+                header=None,
+                names=columns,
+                usecols=read_columns,
+                chunksize=CHUNK_SIZE,
+                **CSV_READ_OPTIONS,
+            )
+        ]
+    )
+
+    return pd.concat(grouped_chunks), merge_watermarks(watermarks)
+
+
+def _group_batch(
+    batch_index: int,
+    filepath: str,
+    read_columns: list[str],
+    species_columns: SpeciesColumns,
+    grid_name: str,
+    watermark: dict | None,
+) -> tuple[pd.core.frame.DataFrame, dict]:
+    """
+    Worker for the parallel aggregation of a converted file. Reads a single
+    record batch and returns the grouped counts.
+    """
+    (chunk,) = read_occurrence_batches(filepath, read_columns, [batch_index])
+    return _group_chunk(chunk, species_columns, grid_name, watermark)
+
+
+def _group_in_parallel(
+    filepath: str,
+    read_columns: list[str],
+    species_columns: SpeciesColumns,
+    grid_name: str,
+    watermark: dict | None,
+    workers: int,
 ):
-    bird_list_df = pd.read_csv(bird_list_file, dtype={"SABAP2_number": str})
-    bird_list_df[join_column] = bird_list_df[join_column].fillna("No Match Placeholder")
+    """
+    Yield the grouped counts of each byte range of a CSV file, or of each
+    record batch of a converted file, computed in a pool of worker processes.
+    """
+    if is_converted(filepath):
+        tasks = range(occurrence_batch_count(filepath))
+        print(f"Processing {len(tasks)} batches with {workers} workers", flush=True)
+
+        group_task = partial(
+            _group_batch,
+            filepath=filepath,
+            read_columns=read_columns,
+            species_columns=species_columns,
+            grid_name=grid_name,
+            watermark=watermark,
+        )
+    else:
+        columns, tasks = _byte_ranges(filepath, BYTE_RANGE_SIZE)
+        print(f"Processing {len(tasks)} byte ranges with {workers} workers", flush=True)
+
+        group_task = partial(
+            _group_byte_range,
+            filepath=filepath,
+            columns=columns,
+            read_columns=read_columns,
+            species_columns=species_columns,
+            grid_name=grid_name,
+            watermark=watermark,
+        )
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(group_task, tasks)
 
-    # Initialize an empty DataFrame to store grouped results
-    all_grouped_data = pd.DataFrame()
 
-    filepath = os.path.join(input_data_path, input_csv_file)
-    chunksize = 1e6  # Adjust based on memory
+def _pentad_rows(grid) -> tuple[np.ndarray, np.ndarray]:
+    """
+    The rows are written in pentad order, so the counts are folded in by the
+    rank of each cell's pentad. Returns the cell order and the row of each
+    cell.
+    """
+    pentad_order = np.argsort(grid.cells, kind="stable")
+    cell_rows = np.empty(len(grid), dtype=np.int64)
+    cell_rows[pentad_order] = np.arange(len(grid))
+    return pentad_order, cell_rows
+
+
+def _accumulate_occurrences(
+    counts: CountAccumulator,
+    filepath: str,
+    species_columns: SpeciesColumns,
+    cell_rows: np.ndarray,
+    grid_name: str,
+    workers: int,
+    watermark: dict | None = None,
+) -> dict:
+    """
+    Add the counts of the occurrences in the file (those past the watermark,
+    if one is given) to the accumulator. Returns the watermark of the counted
+    occurrences.
+    """
+    read_columns = _read_columns(filepath)
     chunk_count = 1
 
-    for chunk in pd.read_csv(filepath, sep="\t", chunksize=chunksize):
+    if workers > 1:
+        grouped_chunks = _group_in_parallel(
+            filepath,
+            read_columns,
+            species_columns,
+            grid_name,
+            watermark,
+            workers,
+        )
+    else:
+        if is_converted(filepath):
+            chunks = read_occurrence_batches(filepath, read_columns)
+        else:
+            chunks = pd.read_csv(
+                filepath,
+                usecols=read_columns,
+                chunksize=CHUNK_SIZE,
+                **CSV_READ_OPTIONS,
+            )
+
+        grouped_chunks = (
+            _group_chunk(chunk, species_columns, grid_name, watermark)
+            for chunk in chunks
+        )
+
+    # Fold the grouped chunks into a fixed size cell x species count matrix,
+    # so memory does not grow with the size of the input file
+    watermarks = []
+    for grouped_chunk, grouped_watermark in grouped_chunks:
         print(f"Processing chunk: {chunk_count}", flush=True)
         chunk_count += 1
-        chunk = chunk.merge(
-            bird_list_df[[join_column, "SABAP2_number"]],
-            left_on="species",
-            right_on=join_column,
-            how="left",
+
+        counts.add(
+            cell_rows[grouped_chunk["cell"].to_numpy()],
+            grouped_chunk["species"].to_numpy(),
+            grouped_chunk["count"].to_numpy(),
         )
-        chunk.drop(columns=[join_column], inplace=True)
-        chunk["SABAP2_number"] = chunk["SABAP2_number"].fillna("0")
+        watermarks.append(grouped_watermark)
 
-        if use_2km_pentad:
-            grid_df = pd.read_csv('src/google_ee/assets/grid_2km.csv')
-            add_two_km_pentad_from_lat_long(
-                chunk, grid_df, lat_column_name="decimalLatitude", lng_column_name="decimalLongitude"
-            )
-            # remove any observations that were not in the 2km pentad grid
-            chunk = chunk.dropna(subset=['pentad'])
-        else:
-            add_pentad_from_lat_long(
-                chunk, lat_column_name="decimalLatitude", lng_column_name="decimalLongitude"
-            )
+    return merge_watermarks(watermarks)
 
-        grouped_chunk = (
-            chunk.groupby(["pentad", "SABAP2_number"]).size().reset_index(name="count")
+
+def aggregate_by_pentad_and_sabap_ids(
+    input_data_path: str,
+    input_file: str,
+    output_file: str,
+    bird_list_file: str,
+    grid_name: str,
+    aggregate_dir: str,
+    join_column: str,
+    store_pentad_key: bool = False,
+    workers: int = 1,
+):
+    """
+    Count the observations in a GBIF occurrence file per grid cell and
+    SABAP2_number. The input_file is either the raw CSV or the Feather file
+    written by convert_occurrences, which is read one record batch at a time.
+    With workers > 1 the byte ranges of the CSV (or the record batches) are
+    parsed and grouped in a process pool.
+
+    A manifest with the gbifID/eventDate watermark of the file is written next
+    to the output (and in its schema metadata), so that later deltas can be
+    added with apply_observation_delta.
+    """
+    grid = get_grid(grid_name)
+    species_columns = SpeciesColumns(bird_list_file, join_column)
+    pentad_order, cell_rows = _pentad_rows(grid)
+
+    filepath = os.path.join(input_data_path, input_file)
+    output_path = f"{aggregate_dir}/{output_file}"
+    tmp_path = f"{output_path}.tmp"
+
+    with CountAccumulator(len(grid), len(species_columns), spill_dir=aggregate_dir) as counts:
+        watermark = _accumulate_occurrences(
+            counts,
+            filepath,
+            species_columns,
+            cell_rows,
+            grid_name,
+            workers,
         )
 
-        all_grouped_data = pd.concat([all_grouped_data, grouped_chunk])
+        manifest = new_manifest(filepath, grid_name, watermark)
 
-    final_grouped = (
-        all_grouped_data.groupby(["pentad", "SABAP2_number"])["count"]
-        .sum()
-        .reset_index()
-    )
+        # The 2km grid ids are not pentads so they have no pentad key
+        _write_count_blocks(
+            tmp_path,
+            counts.iter_blocks(),
+            grid.cells[pentad_order],
+            species_columns.columns.to_list(),
+            store_pentad_key and grid.name != TWO_KM_GRID,
+            manifest_metadata(manifest),
+        )
 
-    pentad_df = pd.read_csv(pentad_list_file)
-    merged_df = pd.merge(pentad_df, final_grouped, on="pentad", how="left")
+    os.replace(tmp_path, output_path)
+    save_manifest(output_path, manifest)
 
-    # After the pivot
-    final_df = merged_df.pivot(index="pentad", columns="SABAP2_number", values="count")
 
-    # Reset the index to turn 'pentad' back into a column
-    final_df.reset_index(inplace=True)
+def apply_observation_delta(
+    delta_path: str,
+    output_file: str,
+    bird_list_file: str,
+    grid_name: str,
+    aggregate_dir: str,
+    join_column: str,
+    workers: int = 1,
+):
+    """
+    Add the occurrences in a delta file (a CSV or converted Feather file of a
+    newer GBIF export) to an existing aggregate. Only the occurrences past the
+    watermark in the aggregate's manifest are counted, and a delta that is
+    already in the manifest is skipped, so a delta is never counted twice.
 
-    # Remove the name of the new column (which is now 'index' after resetting)
-    final_df.columns.name = None
+    The updated manifest is written into the schema metadata of the new
+    aggregate, so the counts and the record of the delta are replaced together.
+    """
+    output_path = f"{aggregate_dir}/{output_file}"
+    manifest = load_manifest(output_path)
 
-    # Ensure all SABAP2 numbers are present as columns
-    all_sabap2_numbers = sorted(
-        bird_list_df["SABAP2_number"].unique().astype(int).astype(str)
-    )
+    if manifest is None or not os.path.exists(output_path):
+        raise FileNotFoundError(
+            f"No manifest for {output_path}. Run the full aggregation before applying a delta."
+        )
+    if manifest["grid"] != grid_name:
+        raise ValueError(
+            f"{output_file} was aggregated on the {manifest['grid']} grid, not {grid_name}"
+        )
 
-    # Identify missing columns
-    missing_columns = list(set(all_sabap2_numbers) - set(final_df.columns))
+    digest = file_sha256(delta_path)
+    if is_ingested(manifest, digest):
+        print(f"{delta_path} has already been added to {output_file}", flush=True)
+        return
 
-    # Create a DataFrame with zeros for all missing columns
-    missing_df = pd.DataFrame(0, index=final_df.index, columns=missing_columns)
+    print(f"Adding occurrences past {manifest['watermark']}", flush=True)
 
-    # Concatenate the original DataFrame with the missing columns DataFrame
-    final_df = pd.concat([final_df, missing_df], axis=1)
+    grid = get_grid(grid_name)
+    species_columns = SpeciesColumns(bird_list_file, join_column)
+    pentad_order, cell_rows = _pentad_rows(grid)
 
-    # Ensure the columns are in the correct order
-    final_df = final_df[["pentad"] + all_sabap2_numbers + ["0"]]
+    names = feather_columns(output_path)
+    if [c for c in names if c not in ID_COLUMNS] != species_columns.columns.to_list():
+        raise ValueError(
+            f"The species in {output_file} do not match {bird_list_file}. "
+            "Re-run the full aggregation."
+        )
 
-    # Replace NaN with 0 and convert to integers
-    final_df.fillna(0, inplace=True)
-    final_df = final_df.astype(
-        {col: "int" for col in final_df.columns if col != "pentad"}
+    tmp_path = f"{output_path}.tmp"
+
+    with CountAccumulator(len(grid), len(species_columns), spill_dir=aggregate_dir) as counts:
+        watermark = _accumulate_occurrences(
+            counts,
+            delta_path,
+            species_columns,
+            cell_rows,
+            grid_name,
+            workers,
+            manifest["watermark"],
+        )
+        updated_manifest = copy.deepcopy(manifest)
+        add_to_manifest(updated_manifest, delta_path, digest, watermark)
+
+        _write_count_blocks(
+            tmp_path,
+            _add_existing_counts(
+                output_path, counts, grid.cells[pentad_order], species_columns.columns.to_list()
+            ),
+            grid.cells[pentad_order],
+            species_columns.columns.to_list(),
+            PENTAD_KEY_COLUMN in names,
+            manifest_metadata(updated_manifest),
+        )
+
+    os.replace(tmp_path, output_path)
+    save_manifest(output_path, updated_manifest)
+
+    print(
+        f"Added {delta_path} to {output_file}. Re-run sum-observations to update "
+        "the combined observation files.",
+        flush=True,
     )
 
-    # Now save the DataFrame
-    final_df.to_feather(f"{aggregate_dir}/{output_file}")
-    print(final_df.head())
+
+def _add_existing_counts(
+    aggregate_path: str,
+    counts: CountAccumulator,
+    pentads: np.ndarray,
+    columns: list[str],
+):
+    """
+    Yield the (first_row, block) pairs of the accumulated counts with the
+    counts of the existing aggregate added, reading one record batch of the
+    aggregate at a time.
+    """
+    with pa.memory_map(aggregate_path) as source:
+        reader = pa.ipc.open_file(source)
+        if reader.num_record_batches == 0:
+            return
+
+        blocks = counts.iter_blocks(reader.get_batch(0).num_rows)
+
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            first_row, block = next(blocks, (None, None))
+
+            if (
+                block is None
+                or batch.num_rows != len(block)
+                or not np.array_equal(
+                    batch.column("pentad").to_numpy(zero_copy_only=False),
+                    pentads[first_row : first_row + len(block)],
+                )
+            ):
+                raise ValueError(
+                    f"The pentads in {aggregate_path} do not match the grid. "
+                    "Re-run the full aggregation."
+                )
+
+            existing = np.column_stack(
+                [batch.column(c).to_numpy(zero_copy_only=False) for c in columns]
+            )
+            yield first_row, block + existing
+
+
+def _write_count_blocks(
+    output_path: str,
+    blocks,
+    pentads: np.ndarray,
+    columns: list[str],
+    store_pentad_key: bool = False,
+    metadata: dict | None = None,
+):
+    """
+    Write the (first_row, block) pentad x species counts to a Feather file one
+    block of rows at a time, so the full frame is never held in memory. The
+    largest count is not known up front, so the counts are stored as the
+    widest of the COUNT_DTYPES. The metadata is added to the file's schema.
+    """
+    dtype = COUNT_DTYPES[-1]
+    writer = None
+    accumulated_bytes = 0
+    written_bytes = 0
+
+    try:
+        for first_row, block in blocks:
+            check_counts(block.ravel(), dtype)
+            accumulated_bytes += block.nbytes
+            block = block.astype(dtype)
+            written_bytes += block.nbytes
+
+            block_df = pd.DataFrame(block, columns=columns)
+            block_df.insert(0, "pentad", pentads[first_row : first_row + len(block)])
+
+            if store_pentad_key:
+                add_pentad_key(block_df)
+
+            batch = pa.RecordBatch.from_pandas(block_df, preserve_index=False)
+            if writer is None:
+                print(block_df.head())
+                schema = batch.schema.with_metadata(
+                    {**(batch.schema.metadata or {}), **(metadata or {})}
+                )
+                writer = pa.ipc.new_file(
+                    output_path,
+                    schema,
+                    options=pa.ipc.IpcWriteOptions(compression="lz4"),
+                )
+            writer.write_batch(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    report_memory(output_path, accumulated_bytes, written_bytes)
 
 
 def sum_observations(
@@ -110,6 +531,7 @@ def sum_observations(
     unverified_observations_files: list[str],
     verified_observations_output_file: str,
     unverified_observations_output_file: str,
+    sparse_output: bool = False,
 ):
     """
     This method replaces the combine_all method by keeping verified and unverified
@@ -126,21 +548,36 @@ def sum_observations(
         containing the verified observations
     :param unverified_observations_output_file: The name of the Feather file
         containing the unverified observations
+    :param sparse_output: Also save each output as a sparse matrix (.npz)
+        alongside the Feather file. The input files can be either format.
     """
 
     print("Verified files:", verified_observations_files)
     print("Unverified files:", unverified_observations_files)
 
     verified_observations_dfs = [
-        pd.read_feather(os.path.join(input_data_path, f)).set_index("pentad")
+        read_observation_columns(os.path.join(input_data_path, f))
         for f in verified_observations_files
     ]
 
     unverified_observations_dfs = [
-        pd.read_feather(os.path.join(input_data_path, f)).set_index("pentad")
+        read_observation_columns(os.path.join(input_data_path, f))
         for f in unverified_observations_files
     ]
 
+    # If any of the inputs were stored with integer pentad keys then sum on
+    # the keys rather than on the pentad strings
+    use_pentad_key = any(
+        PENTAD_KEY_COLUMN in df.columns
+        for df in verified_observations_dfs + unverified_observations_dfs
+    )
+    verified_observations_dfs = [
+        _index_by_pentad(df, use_pentad_key) for df in verified_observations_dfs
+    ]
+    unverified_observations_dfs = [
+        _index_by_pentad(df, use_pentad_key) for df in unverified_observations_dfs
+    ]
+
     # Add up all of the observations per pentad
     total_verified_observations_df = (
         pd.concat(verified_observations_dfs)
@@ -181,23 +618,59 @@ def sum_observations(
     total_verified_observations_df.reset_index(inplace=True)
     total_unverified_observations_df.reset_index(inplace=True)
 
+    if use_pentad_key:
+        for df in [total_verified_observations_df, total_unverified_observations_df]:
+            df.insert(0, "pentad", pentad_keys_to_strings(df[PENTAD_KEY_COLUMN]))
+
     # Saving to Feather files
-    total_verified_observations_df.to_feather(
-        os.path.join(input_data_path, verified_observations_output_file)
+    total_verified_observations_df = write_counts(
+        total_verified_observations_df,
+        os.path.join(input_data_path, verified_observations_output_file),
     )
-    total_unverified_observations_df.to_feather(
-        os.path.join(input_data_path, unverified_observations_output_file)
+    total_unverified_observations_df = write_counts(
+        total_unverified_observations_df,
+        os.path.join(input_data_path, unverified_observations_output_file),
     )
 
+    if sparse_output:
+        write_sparse_observations(
+            total_verified_observations_df,
+            os.path.join(
+                input_data_path, sparse_file_name(verified_observations_output_file)
+            ),
+        )
+        write_sparse_observations(
+            total_unverified_observations_df,
+            os.path.join(
+                input_data_path, sparse_file_name(unverified_observations_output_file)
+            ),
+        )
+
+
+def _index_by_pentad(
+    df: pd.core.frame.DataFrame, use_pentad_key: bool
+) -> pd.core.frame.DataFrame:
+    """
+    Index an observation frame on the pentad key (adding it if the file was
+    written without one) or on the pentad string.
+    """
+    if not use_pentad_key:
+        return df.set_index("pentad")
+
+    if PENTAD_KEY_COLUMN not in df.columns:
+        add_pentad_key(df)
+
+    return df.drop(columns=["pentad"]).set_index(PENTAD_KEY_COLUMN)
+
 
 def generate_sabap_species_diff(
     input_data_path: str,
-    input_csv_file: str,
+    input_file: str,
     bird_list_file: str,
     dataset_prefix: str,
 ):
     # Paths
-    csv_path = f"{input_data_path}/{input_csv_file}"
+    input_path = f"{input_data_path}/{input_file}"
     mapping_path = f"{input_data_path}/{dataset_prefix}_SABAP_mapping.csv"
     unmapped_path = f"{input_data_path}/unmapped_{dataset_prefix}.csv"
     column_name = dataset_prefix + "_name"
@@ -208,8 +681,7 @@ def generate_sabap_species_diff(
     bird_list_df[column_name] = ""  # Initialize with empty strings
 
     # Extract unique species names from dataset
-    species_df = pd.read_csv(csv_path, sep="\t", usecols=["species"])
-    unique_species = species_df["species"].unique()
+    unique_species = read_unique_species(input_path)
 
     print(f"Total species in {dataset_prefix}s: {len(unique_species)}", flush=True)
     print(f"Total species in SABAP: {len(bird_list_df)}", flush=True)
@@ -0,0 +1,171 @@
+import csv
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+
+# The columns of the GBIF occurrence files that are kept when converting them.
+# gbifID is only used to find the new occurrences in a later export.
+RAW_COLUMNS = ["species", "decimalLatitude", "decimalLongitude", "eventDate", "gbifID"]
+
+RAW_COLUMN_TYPES = {
+    "species": pa.string(),
+    "decimalLatitude": pa.float64(),
+    "decimalLongitude": pa.float64(),
+    "eventDate": pa.string(),
+    "gbifID": pa.int64(),
+}
+
+# GBIF exports are tab separated and unquoted, a quote character in a field
+# is part of its value. Every reader of the raw files parses them this way, so
+# the serial and parallel aggregation split them into the same records.
+CSV_READ_OPTIONS = {"sep": "\t", "quoting": csv.QUOTE_NONE}
+
+SPECIES_TYPE = pa.dictionary(pa.int32(), pa.string())
+
+# Bytes of the CSV parsed into each record batch of the converted file
+CONVERT_BLOCK_SIZE = 64 * 1024 * 1024
+
+
+def is_converted(path: str) -> bool:
+    return path.endswith(".feather")
+
+
+def occurrence_file(input_data_path: str, csv_file: str, feather_file: str) -> str:
+    """
+    The converted Feather file if convert-raw has been run, otherwise the raw
+    CSV file.
+    """
+    if os.path.exists(os.path.join(input_data_path, feather_file)):
+        return feather_file
+
+    print(
+        f"{feather_file} not found, reading {csv_file}. Run convert-raw to speed this up.",
+        flush=True,
+    )
+    return csv_file
+
+
+def convert_occurrences(input_data_path: str, input_csv_file: str, output_file: str):
+    """
+    Stream a tab separated GBIF occurrence file into a zstd compressed Feather
+    (Arrow IPC) file holding only the RAW_COLUMNS, with the species names
+    dictionary encoded. Each block of the CSV becomes one record batch, so the
+    file is never fully in memory.
+    """
+    csv_path = os.path.join(input_data_path, input_csv_file)
+    output_path = os.path.join(input_data_path, output_file)
+    tmp_path = f"{output_path}.tmp"
+
+    reader = pa_csv.open_csv(
+        csv_path,
+        read_options=pa_csv.ReadOptions(block_size=CONVERT_BLOCK_SIZE),
+        parse_options=pa_csv.ParseOptions(delimiter="\t", quote_char=False),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=RAW_COLUMNS,
+            include_missing_columns=True,
+            column_types=RAW_COLUMN_TYPES,
+        ),
+    )
+    schema = pa.schema(
+        [
+            pa.field(name, SPECIES_TYPE if name == "species" else RAW_COLUMN_TYPES[name])
+            for name in RAW_COLUMNS
+        ]
+    )
+
+    # The species dictionary grows as new names are found. The file only
+    # stores the names added by each batch (dictionary deltas).
+    species_codes = {}
+    species_names = []
+    row_count = 0
+
+    with pa.ipc.new_file(
+        tmp_path,
+        schema,
+        options=pa.ipc.IpcWriteOptions(
+            compression="zstd", emit_dictionary_deltas=True
+        ),
+    ) as writer:
+        for batch in reader:
+            encoded = batch.column("species").dictionary_encode()
+
+            batch_codes = np.empty(len(encoded.dictionary), dtype=np.int32)
+            for i, name in enumerate(encoded.dictionary.to_pylist()):
+                if name not in species_codes:
+                    species_codes[name] = len(species_names)
+                    species_names.append(name)
+                batch_codes[i] = species_codes[name]
+
+            species = pa.DictionaryArray.from_arrays(
+                pc.take(pa.array(batch_codes, type=pa.int32()), encoded.indices),
+                pa.array(species_names, type=pa.string()),
+            )
+
+            writer.write_batch(
+                pa.record_batch(
+                    [species] + [batch.column(name) for name in RAW_COLUMNS[1:]],
+                    schema=schema,
+                )
+            )
+
+            row_count += len(batch)
+            print(f"Converted {row_count} rows", flush=True)
+
+    os.replace(tmp_path, output_path)
+    print(
+        f"Wrote {row_count} rows and {len(species_names)} species to {output_path}",
+        flush=True,
+    )
+
+
+def occurrence_batch_count(path: str) -> int:
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).num_record_batches
+
+
+def read_occurrence_batches(
+    path: str, columns: list[str], batch_indices: list[int] | None = None
+):
+    """
+    Yield each record batch of a converted occurrence file as a DataFrame with
+    only the given columns. Only the buffers of those columns are read.
+    """
+    with pa.memory_map(path) as source:
+        names = pa.ipc.open_file(source).schema.names
+        reader = pa.ipc.open_file(
+            source,
+            options=pa.ipc.IpcReadOptions(
+                included_fields=[names.index(c) for c in columns]
+            ),
+        )
+
+        if batch_indices is None:
+            batch_indices = range(reader.num_record_batches)
+
+        for i in batch_indices:
+            yield reader.get_batch(i).to_pandas()
+
+
+def read_unique_species(path: str) -> np.ndarray:
+    """The distinct species names in a raw CSV or converted occurrence file"""
+    if not is_converted(path):
+        return pd.read_csv(path, usecols=["species"], **CSV_READ_OPTIONS)["species"].unique()
+
+    # The dictionary of the converted file already holds every species name.
+    # Only names that are used by a row are returned, in order of appearance.
+    codes = []
+    dictionary = None
+    for chunk in read_occurrence_batches(path, ["species"]):
+        codes.append(pd.unique(chunk["species"].cat.codes.to_numpy()))
+        dictionary = chunk["species"].cat.categories
+
+    if dictionary is None:
+        return np.array([], dtype=object)
+
+    codes = pd.unique(np.concatenate(codes))
+    species = dictionary.to_numpy(dtype=object)[codes[codes >= 0]]
+    return np.append(species, np.nan) if (codes < 0).any() else species
@@ -0,0 +1,197 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pyarrow import feather
+from scipy import sparse
+
+from .utils import PENTAD_KEY_COLUMN
+
+SPARSE_EXTENSION = ".npz"
+TOTAL_COLUMN = "total_pentad_observations"
+
+# Columns that identify the pentad rather than hold species counts
+ID_COLUMNS = ["pentad", PENTAD_KEY_COLUMN]
+
+
+def sparse_file_name(file_name: str) -> str:
+    """The name of the sparse version of an observations file"""
+    return os.path.splitext(file_name)[0] + SPARSE_EXTENSION
+
+
+def is_sparse(path: str) -> bool:
+    return path.endswith(SPARSE_EXTENSION)
+
+
+def write_sparse_observations(df: pd.core.frame.DataFrame, path: str):
+    """
+    Save a pentad x species observations frame as a compressed CSC matrix. The
+    pentad ids and the total_pentad_observations column are stored alongside
+    as plain arrays.
+    """
+    species_columns = [
+        c for c in df.columns if c not in ID_COLUMNS and c != TOTAL_COLUMN
+    ]
+    matrix = sparse.csc_matrix(df[species_columns].to_numpy())
+
+    arrays = {
+        "data": matrix.data,
+        "indices": matrix.indices,
+        "indptr": matrix.indptr,
+        "shape": np.array(matrix.shape),
+        "columns": np.array(species_columns, dtype=str),
+        "pentads": df["pentad"].to_numpy(dtype=str),
+    }
+    if PENTAD_KEY_COLUMN in df.columns:
+        arrays["pentad_keys"] = df[PENTAD_KEY_COLUMN].to_numpy()
+    if TOTAL_COLUMN in df.columns:
+        arrays["totals"] = df[TOTAL_COLUMN].to_numpy()
+
+    np.savez_compressed(path, **arrays)
+
+
+class SparseObservations:
+    """
+    A pentad x species observations matrix saved by write_sparse_observations.
+    Single species columns and the row totals are read without densifying the
+    matrix.
+    """
+
+    def __init__(self, path: str):
+        with np.load(path, allow_pickle=False) as f:
+            self.matrix = sparse.csc_matrix(
+                (f["data"], f["indices"], f["indptr"]), shape=tuple(f["shape"])
+            )
+            self.columns = f["columns"].tolist()
+            self.pentads = f["pentads"]
+            self.pentad_keys = f["pentad_keys"] if "pentad_keys" in f.files else None
+            self.totals = f["totals"] if "totals" in f.files else None
+
+        self._column_index = {c: i for i, c in enumerate(self.columns)}
+
+        self._id_df = pd.DataFrame({"pentad": self.pentads.astype(object)})
+        if self.pentad_keys is not None:
+            self._id_df[PENTAD_KEY_COLUMN] = self.pentad_keys
+
+    def column(self, species_id: str) -> np.ndarray:
+        """The dense observation counts of a single species"""
+        i = self._column_index[str(species_id)]
+        start, end = self.matrix.indptr[i], self.matrix.indptr[i + 1]
+
+        values = np.zeros(self.matrix.shape[0], dtype=self.matrix.dtype)
+        values[self.matrix.indices[start:end]] = self.matrix.data[start:end]
+        return values
+
+    def row_totals(self) -> np.ndarray:
+        """Total observations per pentad"""
+        if self.totals is not None:
+            return self.totals
+        return np.asarray(self.matrix.sum(axis=1)).ravel()
+
+    def total(self, species_id: str | None = None) -> int:
+        """Total observations for a species, or for all species"""
+        if species_id is not None and str(species_id) in self._column_index:
+            return int(self.column(species_id).sum())
+        return int(self.matrix.sum())
+
+    def to_frame(self, columns: list[str] | None = None) -> pd.core.frame.DataFrame:
+        """
+        A dense frame with the pentad ids and the given columns, which may
+        include total_pentad_observations. All columns if none are given.
+        """
+        if columns is None:
+            columns = self.columns + ([TOTAL_COLUMN] if self.totals is not None else [])
+
+        df = self._id_df.copy()
+
+        data = {}
+        for column in columns:
+            if column == TOTAL_COLUMN:
+                data[column] = self.row_totals()
+            else:
+                data[column] = self.column(column)
+
+        return pd.concat([df, pd.DataFrame(data, index=df.index)], axis=1)
+
+
+class DenseObservations:
+    """
+    A pentad x species observations Feather file, read once into an Arrow
+    table. Single species columns are taken from the table as they are
+    asked for, the same way as from SparseObservations.
+    """
+
+    def __init__(self, path: str):
+        self.table = feather.read_table(path)
+        names = self.table.column_names
+
+        self.columns = [c for c in names if c not in ID_COLUMNS and c != TOTAL_COLUMN]
+        id_columns = [c for c in ID_COLUMNS if c in names]
+        self._id_df = self.table.select(id_columns).to_pandas()
+        self.pentads = self._id_df["pentad"].to_numpy()
+        self.totals = (
+            self.table.column(TOTAL_COLUMN).to_numpy()
+            if TOTAL_COLUMN in names
+            else None
+        )
+
+    def column(self, species_id: str) -> np.ndarray:
+        """The observation counts of a single species"""
+        return self.table.column(str(species_id)).to_numpy()
+
+    def row_totals(self) -> np.ndarray:
+        """Total observations per pentad"""
+        if self.totals is not None:
+            return self.totals
+        return sum(
+            (self.column(c).astype(np.int64) for c in self.columns),
+            np.zeros(len(self.pentads), dtype=np.int64),
+        )
+
+    def to_frame(self, columns: list[str]) -> pd.core.frame.DataFrame:
+        """A frame with the pentad ids and the given columns, as read_feather"""
+        df = self._id_df.copy()
+        data = {c: self.table.column(c).to_numpy() for c in columns}
+        return pd.concat([df, pd.DataFrame(data, index=df.index)], axis=1)
+
+
+def open_observations(path: str) -> SparseObservations | DenseObservations:
+    """Read a dense (Feather) or sparse observations file once"""
+    if is_sparse(path):
+        return SparseObservations(path)
+    return DenseObservations(path)
+
+
+def observation_columns(path: str) -> list[str]:
+    """The species columns of a dense or sparse observations file"""
+    if is_sparse(path):
+        return SparseObservations(path).columns
+
+    return [
+        c for c in feather_columns(path) if c not in ID_COLUMNS and c != TOTAL_COLUMN
+    ]
+
+
+def read_observation_columns(
+    path: str, columns: list[str] | None = None
+) -> pd.core.frame.DataFrame:
+    """
+    Read the pentad ids and the given columns (all columns if none are given)
+    from a dense (Feather) or sparse observations file.
+    """
+    if is_sparse(path):
+        return SparseObservations(path).to_frame(columns)
+
+    if columns is None:
+        return pd.read_feather(path)
+
+    names = feather_columns(path)
+    id_columns = [c for c in ID_COLUMNS if c in names]
+    return pd.read_feather(path, columns=id_columns + list(columns))
+
+
+def feather_columns(path: str) -> list[str]:
+    """Read the column names from the schema of a Feather file"""
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).schema.names
@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+
+# The column that collects the observations of species that are not in the
+# bird list
+UNMATCHED_COLUMN = "0"
+
+
+class SpeciesColumns:
+    """
+    Maps the species names used by a dataset (the ebirds_name or inat_name
+    column of the bird list) to the SABAP2 number columns of the aggregate.
+
+    The lookup is built once from the bird list. Each chunk of occurrences is
+    then mapped on the codes of its distinct species names, so the names are
+    only compared once per chunk rather than once per row.
+    """
+
+    def __init__(self, bird_list_file: str, join_column: str):
+        bird_list_df = pd.read_csv(bird_list_file, dtype={"SABAP2_number": str})
+        sabap2_numbers = bird_list_df["SABAP2_number"].astype(int).astype(str)
+
+        # Ensure all SABAP2 numbers are present as columns, with "0" collecting
+        # the species that could not be matched
+        self.columns = pd.Index(sorted(sabap2_numbers.unique()) + [UNMATCHED_COLUMN])
+        self.unmatched = len(self.columns) - 1
+
+        names = bird_list_df[join_column]
+        named = names.notna()
+        duplicated = names[named].duplicated()
+        if duplicated.any():
+            print(
+                f"Duplicate {join_column} values in the bird list, using the first "
+                f"SABAP2 number for: {names[named][duplicated].unique().tolist()}",
+                flush=True,
+            )
+
+        names = names[named][~duplicated]
+        self._names = pd.Index(names)
+        # The column of each name, with a trailing entry for the names that
+        # are not found (a position of -1)
+        self._name_columns = np.append(
+            self.columns.get_indexer(sabap2_numbers[names.index]), self.unmatched
+        ).astype(np.int32)
+
+    def __len__(self):
+        return len(self.columns)
+
+    def codes(self, species: pd.Series) -> np.ndarray:
+        """
+        The column of each species name. Names that are not in the bird list,
+        or missing, map to the unmatched column.
+        """
+        if isinstance(species.dtype, pd.CategoricalDtype):
+            name_codes = species.cat.codes.to_numpy()
+            categories = species.cat.categories
+        else:
+            name_codes, categories = pd.factorize(species)
+
+        # A trailing entry for the missing names, which have a code of -1
+        category_columns = np.append(
+            self._name_columns[self._names.get_indexer(categories)], self.unmatched
+        ).astype(np.int32)
+
+        return category_columns[name_codes]
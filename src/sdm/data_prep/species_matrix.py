@@ -0,0 +1,75 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Callable
+
+import numpy as np
+from tqdm import tqdm
+
+from .dtypes import count_dtype
+from .grids import get_grid
+
+# Counts the observations of one species file per grid cell, returning the
+# positions of the cells in the grid and the count for each
+CellCounts = Callable[[str, str], tuple[np.ndarray, np.ndarray]]
+
+
+def _file_cell_counts(
+    file: str, data_dir: str, grid_name: str, cell_counts: CellCounts
+) -> tuple[int, np.ndarray, np.ndarray]:
+    """Worker for species_count_matrix, returns the species id with its counts"""
+    cells, counts = cell_counts(os.path.join(data_dir, file), grid_name)
+    return int(file.split(".")[0]), cells, counts
+
+
+def species_count_matrix(
+    data_dir: str,
+    files: list[str],
+    grid_name: str,
+    cell_counts: CellCounts,
+    workers: int = 1,
+) -> tuple[list[int], np.ndarray]:
+    """
+    Count the observations in a directory of per species files (named
+    <species id>.csv) into a cell x species matrix in grid order.
+
+    Each file is reduced to the (cell, count) pairs of its species by
+    cell_counts, in a pool of worker processes if workers > 1. The grid is
+    loaded before the pool is started so forked workers share its index
+    rather than building their own. The counts of all of the species are then
+    scattered into the matrix in one step.
+
+    Returns the species ids in column order and the matrix.
+    """
+    grid = get_grid(grid_name)
+
+    file_cell_counts = partial(
+        _file_cell_counts,
+        data_dir=data_dir,
+        grid_name=grid_name,
+        cell_counts=cell_counts,
+    )
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(
+                tqdm(
+                    executor.map(file_cell_counts, files, chunksize=16),
+                    total=len(files),
+                    desc="Processing files",
+                )
+            )
+    else:
+        results = [file_cell_counts(f) for f in tqdm(files, desc="Processing files")]
+
+    species_ids = [species_id for species_id, _, _ in results]
+    empty = [np.empty(0, dtype=np.int64)]
+    cells = np.concatenate([c for _, c, _ in results] + empty)
+    counts = np.concatenate([n for _, _, n in results] + empty)
+    columns = np.repeat(np.arange(len(results)), [len(c) for _, c, _ in results])
+
+    matrix = np.zeros(
+        (len(grid), len(results)), dtype=count_dtype(counts.max(initial=0))
+    )
+    matrix[cells, columns] = counts
+
+    return species_ids, matrix
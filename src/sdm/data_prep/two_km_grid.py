@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 import matplotlib.pyplot as plt
@@ -48,6 +49,108 @@ def generate_bounding_box(file):
     # plot_map(final_df_grid_delta)
 
 
+class TwoKmGridIndex:
+    """
+    Spatial index over the bounding boxes written by generate_bounding_box.
+
+    The grid is regular, so each cell is addressed by the column of its x_min
+    and the row of its y_min. Points are placed into a column and row with a
+    binary search over the sorted edges, and the cell is then found with a
+    binary search over the sorted (row, column) keys of the cells that exist.
+
+    Lookups give the same result as find_2km_pentad, including points that
+    fall exactly on a shared edge, where the first matching cell in grid_df
+    order wins.
+    """
+
+    def __init__(self, grid_df: pd.core.frame.DataFrame):
+        self.pentads = grid_df["pentad"].to_numpy(dtype=object)
+
+        x_min = grid_df["x_min"].to_numpy(dtype=np.float64)
+        x_max = grid_df["x_max"].to_numpy(dtype=np.float64)
+        y_min = grid_df["y_min"].to_numpy(dtype=np.float64)
+        y_max = grid_df["y_max"].to_numpy(dtype=np.float64)
+
+        self.x_edges, columns = np.unique(x_min, return_inverse=True)
+        self.y_edges, rows = np.unique(y_min, return_inverse=True)
+
+        # Upper edge of each column/row
+        self.x_upper = np.full(len(self.x_edges), -np.inf)
+        np.maximum.at(self.x_upper, columns, x_max)
+        self.y_upper = np.full(len(self.y_edges), -np.inf)
+        np.maximum.at(self.y_upper, rows, y_max)
+
+        # Sorted (row, column) keys, keeping the first cell in grid_df order
+        # if a key is repeated
+        cell_keys = rows.astype(np.int64) * len(self.x_edges) + columns
+        self.cell_keys, first_positions = np.unique(cell_keys, return_index=True)
+        self.cell_positions = first_positions.astype(np.int64)
+
+    def __len__(self):
+        return len(self.pentads)
+
+    @staticmethod
+    def _candidates(edges, upper, values):
+        """
+        The row/column each value falls in, and the previous row/column for
+        values that sit on the shared edge. -1 where there is no match.
+        """
+        index = np.searchsorted(edges, values, side="right") - 1
+        clipped = np.clip(index, 0, None)
+        current = np.where((index >= 0) & (values <= upper[clipped]), index, -1)
+
+        previous_index = index - 1
+        clipped = np.clip(previous_index, 0, None)
+        previous = np.where(
+            (previous_index >= 0) & (values <= upper[clipped]), previous_index, -1
+        )
+
+        return current, previous
+
+    def _cell_position(self, rows, columns):
+        keys = rows * len(self.x_edges) + columns
+        found = np.searchsorted(self.cell_keys, keys)
+        found = np.clip(found, 0, len(self.cell_keys) - 1)
+
+        hit = (rows >= 0) & (columns >= 0) & (self.cell_keys[found] == keys)
+        return np.where(hit, self.cell_positions[found], np.iinfo(np.int64).max)
+
+    def lookup(self, x, y) -> np.ndarray:
+        """
+        Return the position in grid_df of the cell containing each (x, y)
+        point, or -1 for points outside of the grid.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+
+        if len(self.cell_keys) == 0:
+            return np.full(len(x), -1, dtype=np.int64)
+
+        columns = self._candidates(self.x_edges, self.x_upper, x)
+        rows = self._candidates(self.y_edges, self.y_upper, y)
+
+        positions = self._cell_position(rows[0], columns[0])
+
+        # Only points on a shared edge can match more than one cell
+        on_edge = np.flatnonzero((rows[1] >= 0) | (columns[1] >= 0))
+        for row in rows:
+            for column in columns:
+                positions[on_edge] = np.minimum(
+                    positions[on_edge],
+                    self._cell_position(row[on_edge], column[on_edge]),
+                )
+
+        return np.where(positions == np.iinfo(np.int64).max, -1, positions)
+
+    def find_pentads(self, x, y) -> np.ndarray:
+        """
+        Vectorized find_2km_pentad. Returns an object array with the pentad for
+        each point and None for points outside of the grid.
+        """
+        positions = self.lookup(x, y)
+        return np.append(self.pentads, None)[positions]
+
+
 def find_2km_pentad(x, y, grid_df):
     filtered_df = grid_df[(grid_df['x_min'] <= x) & (grid_df['x_max'] >= x) & (grid_df['y_min'] <= y) & (grid_df['y_max'] >= y)]
     if len(filtered_df) > 0:
@@ -61,9 +164,15 @@ def add_two_km_pentad_from_lat_long(
     lng_column_name: str = "decimalLongitude",
     pentad_column_name: str = "pentad",
 ) -> pd.core.frame.DataFrame:
+    """
+    Add the 2km pentad for each observation, or None if it is outside of the
+    grid. grid_df can be the grid DataFrame or a prebuilt TwoKmGridIndex.
+    """
+    grid_index = grid_df if isinstance(grid_df, TwoKmGridIndex) else TwoKmGridIndex(grid_df)
+
     # Create the pentad column based on latitude and longitude values
-    df[pentad_column_name] = df.apply(
-        lambda row: find_2km_pentad(row[lng_column_name], row[lat_column_name], grid_df), axis=1
+    df[pentad_column_name] = grid_index.find_pentads(
+        df[lng_column_name].to_numpy(), df[lat_column_name].to_numpy()
     )
     return df
 
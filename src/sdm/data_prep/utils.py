@@ -1,4 +1,5 @@
 import os
+import numpy as np
 import pandas as pd
 from kaggle.api.kaggle_api_extended import KaggleApi
 
@@ -76,6 +77,284 @@ def make_pentad(x, y):
     return f"{xx}{separator}{yy}"
 
 
+# Quadrant separators in the order returned by pentad_parts. This mirrors the
+# if/else chain in make_pentad.
+PENTAD_SEPARATORS = np.array([b"_", b"a", b"b", b"c"])
+
+# Powers of ten used to split a pentad code into its (up to) five digits
+_PENTAD_DIGIT_DIVISORS = np.array([10000, 1000, 100, 10, 1])
+
+
+def _pentad_code(value: np.ndarray) -> np.ndarray:
+    """
+    Vectorized version of the degree/minute arithmetic in make_pentad. Takes
+    absolute coordinates and returns the integer form of the zero padded
+    string, e.g. 33.92 -> 3355.
+    """
+    degrees = np.trunc(value)
+    fraction = value - degrees
+
+    # get the first digit (the tens) of the minutes
+    tens = np.trunc(6 * fraction).astype(np.int32)
+
+    # Get the second digit (the units) of the minutes. The modulo is kept
+    # (rather than using minutes % 10) so that floating point edge cases round
+    # the same way as make_pentad does.
+    minutes = np.trunc(60 * fraction).astype(np.int32)
+    units = np.where(tens != 0, minutes % np.maximum(tens * 10, 1), minutes)
+
+    # round the units into their 5min pentad
+    units = np.where(units < 5, 0, 5)
+
+    return degrees.astype(np.int32) * 100 + tens * 10 + units
+
+
+def pentad_parts(latitudes, longitudes) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Split coordinates into the three parts of a pentad id without building any
+    strings: the quadrant (index into PENTAD_SEPARATORS) and the latitude and
+    longitude codes (e.g. 3355 and 1825 for "3355_1825").
+
+    Accepts anything that converts to a NumPy array, including pandas Series
+    and pyarrow arrays.
+    """
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+
+    if not (np.isfinite(latitudes).all() and np.isfinite(longitudes).all()):
+        raise ValueError("Cannot make a pentad from a missing latitude or longitude")
+
+    quadrant = np.where(
+        latitudes < 0,
+        np.where(longitudes >= 0, 0, 1),
+        np.where(longitudes < 0, 2, 3),
+    ).astype(np.int8)
+
+    return (
+        quadrant,
+        _pentad_code(np.abs(latitudes)),
+        _pentad_code(np.abs(longitudes)),
+    )
+
+
+def _pentad_code_digits(codes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Return the ASCII digits of each code, left aligned in a 5 byte row and
+    padded with NUL, along with a mask of the codes that need all 5 digits.
+    """
+    digits = (codes[:, None] // _PENTAD_DIGIT_DIVISORS) % 10 + ord("0")
+    wide = codes >= 10000
+
+    # Same as zfill(4): drop the leading digit unless the code needs it
+    narrow_digits = np.zeros_like(digits)
+    narrow_digits[:, :4] = digits[:, 1:]
+
+    return np.where(wide[:, None], digits, narrow_digits).astype(np.uint8), wide
+
+
+def format_pentads(
+    quadrant: np.ndarray, lat_codes: np.ndarray, lng_codes: np.ndarray
+) -> np.ndarray:
+    """
+    Build the pentad strings from the output of pentad_parts. The strings are
+    assembled in a single byte buffer so no Python object is created per row.
+    """
+    lat_codes = np.asarray(lat_codes)
+    lng_codes = np.asarray(lng_codes)
+
+    if (lat_codes >= 100000).any() or (lng_codes >= 100000).any():
+        raise ValueError("Pentad codes must have at most 5 digits")
+
+    rows = np.arange(len(lat_codes))
+    lat_digits, lat_wide = _pentad_code_digits(lat_codes)
+    lng_digits, _ = _pentad_code_digits(lng_codes)
+
+    # Largest pentad is 5 + 1 + 5 characters, unused bytes stay NUL
+    buffer = np.zeros((len(lat_codes), 11), dtype=np.uint8)
+    buffer[:, 0:5] = lat_digits
+    buffer[rows, 4 + lat_wide] = PENTAD_SEPARATORS[quadrant].view(np.uint8)
+    buffer[~lat_wide, 5:10] = lng_digits[~lat_wide]
+    buffer[lat_wide, 6:11] = lng_digits[lat_wide]
+
+    return buffer.view("S11").ravel().astype(str)
+
+
+def make_pentads(latitudes, longitudes) -> np.ndarray:
+    """
+    Vectorized make_pentad. Returns an array with the same strings that
+    make_pentad would return for each latitude/longitude pair.
+    """
+    return format_pentads(*pentad_parts(latitudes, longitudes))
+
+
+# Integer pentad keys. A key packs the quadrant and the number of 5' steps in
+# latitude and longitude into a single int32:
+#   key = (quadrant * PENTAD_LAT_STEPS + lat_step) * PENTAD_LNG_STEPS + lng_step
+PENTAD_KEY_COLUMN = "pentad_key"
+PENTAD_KEY_DTYPE = np.int32
+PENTAD_LAT_STEPS = 91 * 12
+PENTAD_LNG_STEPS = 181 * 12
+
+
+def _pentad_code_to_step(codes: np.ndarray) -> np.ndarray:
+    return (codes // 100) * 12 + (codes % 100) // 5
+
+
+def _pentad_step_to_code(steps: np.ndarray) -> np.ndarray:
+    return (steps // 12) * 100 + (steps % 12) * 5
+
+
+def _pentad_keys(
+    quadrant: np.ndarray, lat_codes: np.ndarray, lng_codes: np.ndarray
+) -> np.ndarray:
+    lat_steps = _pentad_code_to_step(lat_codes)
+    lng_steps = _pentad_code_to_step(lng_codes)
+
+    if (lat_steps >= PENTAD_LAT_STEPS).any() or (lng_steps >= PENTAD_LNG_STEPS).any():
+        raise ValueError("Pentad is outside of the valid latitude/longitude range")
+
+    keys = (
+        quadrant.astype(np.int64) * PENTAD_LAT_STEPS + lat_steps
+    ) * PENTAD_LNG_STEPS + lng_steps
+
+    return keys.astype(PENTAD_KEY_DTYPE)
+
+
+def _split_pentad_keys(keys) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    keys = np.asarray(keys, dtype=np.int64)
+    lng_steps = keys % PENTAD_LNG_STEPS
+    lat_steps = (keys // PENTAD_LNG_STEPS) % PENTAD_LAT_STEPS
+    quadrant = keys // (PENTAD_LNG_STEPS * PENTAD_LAT_STEPS)
+
+    return (
+        quadrant.astype(np.int8),
+        _pentad_step_to_code(lat_steps),
+        _pentad_step_to_code(lng_steps),
+    )
+
+
+def pentad_keys_from_lat_long(latitudes, longitudes) -> np.ndarray:
+    """
+    Integer pentad keys straight from coordinates, without going through the
+    pentad strings.
+    """
+    return _pentad_keys(*pentad_parts(latitudes, longitudes))
+
+
+def pentad_keys_from_strings(pentads) -> np.ndarray:
+    """
+    Vectorized parse of pentad strings such as "3355_1825" (in any case) into
+    integer pentad keys. Raises a ValueError if any of them is not a pentad.
+    """
+    keys, valid = parse_pentad_keys(pentads)
+    if not valid.all():
+        raise ValueError(f"Invalid pentad: {np.asarray(pentads)[~valid][0]}")
+    return keys
+
+
+def parse_pentad_keys(pentads) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Vectorized parse of pentad strings such as "3355_1825" (in any case) into
+    integer pentad keys. Returns the keys along with a mask of the strings
+    that are valid pentads, the keys of the others are 0.
+    """
+    pentads = np.asarray(pentads).astype(str)
+    too_long = np.char.str_len(pentads) > 11
+    try:
+        pentads = pentads.astype("S11")
+    except UnicodeEncodeError:
+        # Non-ASCII ids are not pentads, they only need to fail to parse
+        pentads = np.char.encode(pentads, "utf-8").astype("S11")
+    buffer = pentads.view(np.uint8).reshape(len(pentads), 11)
+
+    # Lowercase the separator, digits and NUL padding are unaffected
+    buffer = np.where((buffer >= ord("A")) & (buffer <= ord("Z")), buffer | 0x20, buffer)
+
+    is_digit = (buffer >= ord("0")) & (buffer <= ord("9"))
+    columns = np.arange(11)
+    separator_position = np.argmax(~is_digit, axis=1)
+    length = (buffer != 0).sum(axis=1)
+
+    separators = buffer[np.arange(len(buffer)), separator_position]
+    quadrant = np.argmax(separators[:, None] == PENTAD_SEPARATORS.view(np.uint8), axis=1)
+
+    lat_mask = columns < separator_position[:, None]
+    lng_mask = (columns > separator_position[:, None]) & (columns < length[:, None])
+
+    valid = (
+        ~too_long
+        & np.isin(separators, PENTAD_SEPARATORS.view(np.uint8))
+        & (separator_position >= 3)
+        & (length - separator_position - 1 >= 3)
+        & (is_digit == (lat_mask | lng_mask)).all(axis=1)
+    )
+
+    digits = np.where(is_digit, buffer - ord("0"), 0).astype(np.int64)
+    lat_powers = np.where(lat_mask, separator_position[:, None] - 1 - columns, 0)
+    lng_powers = np.where(lng_mask, length[:, None] - 1 - columns, 0)
+
+    lat_codes = (np.where(lat_mask, digits * 10**lat_powers, 0)).sum(axis=1)
+    lng_codes = (np.where(lng_mask, digits * 10**lng_powers, 0)).sum(axis=1)
+
+    # Pentad minutes are a multiple of 5, and the pentad is in the valid
+    # latitude/longitude range
+    valid &= ((lat_codes % 100) % 5 == 0) & ((lng_codes % 100) % 5 == 0)
+    valid &= (_pentad_code_to_step(lat_codes) < PENTAD_LAT_STEPS) & (
+        _pentad_code_to_step(lng_codes) < PENTAD_LNG_STEPS
+    )
+
+    keys = np.zeros(len(pentads), dtype=PENTAD_KEY_DTYPE)
+    keys[valid] = _pentad_keys(
+        quadrant[valid].astype(np.int8), lat_codes[valid], lng_codes[valid]
+    )
+    return keys, valid
+
+
+def pentad_keys_to_strings(keys) -> np.ndarray:
+    """
+    Convert integer pentad keys back to (lowercase) pentad strings
+    """
+    return format_pentads(*_split_pentad_keys(keys))
+
+
+def pentad_keys_to_lat_long(keys) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Vectorized parse_pentad for integer pentad keys. Returns the latitude and
+    longitude arrays.
+    """
+    quadrant, lat_codes, lng_codes = _split_pentad_keys(keys)
+
+    # Same signs as parse_pentad: "_" and "a" are south, "a" and "b" are west
+    lat_sign = np.where(quadrant <= 1, -1, 1)
+    lng_sign = np.where((quadrant == 1) | (quadrant == 2), -1, 1)
+
+    latitudes = lat_sign * (lat_codes // 100 + (lat_codes % 100) / 60)
+    longitudes = lng_sign * (lng_codes // 100 + (lng_codes % 100) / 60)
+
+    return latitudes, longitudes
+
+
+def add_pentad_key(
+    df: pd.core.frame.DataFrame,
+    pentad_column_name: str = "pentad",
+    key_column_name: str = PENTAD_KEY_COLUMN,
+) -> pd.core.frame.DataFrame:
+    """
+    Add an int32 pentad key column, directly after the pentad column, based on
+    the pentad strings
+    """
+    keys = pentad_keys_from_strings(df[pentad_column_name].to_numpy())
+
+    if key_column_name in df.columns:
+        df[key_column_name] = keys
+    else:
+        df.insert(
+            df.columns.get_loc(pentad_column_name) + 1, key_column_name, keys
+        )
+
+    return df
+
+
 def parse_pentad(pentad_str):
     # Determine the separator based on the pentad string
     if "_" in pentad_str:
@@ -120,8 +399,8 @@ def add_pentad_from_lat_long(
     """
 
     # Create the pentad column based on latitude and longitude values
-    df[pentad_column_name] = df.apply(
-        lambda row: make_pentad(row[lat_column_name], row[lng_column_name]), axis=1
+    df[pentad_column_name] = make_pentads(
+        df[lat_column_name].to_numpy(), df[lng_column_name].to_numpy()
     )
 
     return df
@@ -136,16 +415,15 @@ def add_lat_long_from_pentad(
     """
     Add a latitude and longitude column to the dataframe based on the pentad
     """
-    # Use a list comprehension to create a list of tuples (latitude, longitude)
-    lat_lng_tuples = [parse_pentad(x) for x in df[pentad_column_name]]
+    if PENTAD_KEY_COLUMN in df.columns:
+        keys = df[PENTAD_KEY_COLUMN].to_numpy()
+    else:
+        keys = pentad_keys_from_strings(df[pentad_column_name].to_numpy())
 
-    # Convert the list of tuples into a DataFrame
-    lat_lng_df = pd.DataFrame(
-        lat_lng_tuples, columns=[lat_column_name, lng_column_name]
-    )
+    latitudes, longitudes = pentad_keys_to_lat_long(keys)
 
     # Add latitude and longitude columns to the input DataFrame
-    df[lat_column_name] = lat_lng_df[lat_column_name]
-    df[lng_column_name] = lat_lng_df[lng_column_name]
+    df[lat_column_name] = latitudes
+    df[lng_column_name] = longitudes
 
     return df
@@ -0,0 +1,89 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from ..data_prep.covariate_matrix import load_covariate_matrix
+from ..data_prep.covariate_reduction import check_reduction
+from .dataset import SpeciesDataset
+from .random_forest import train
+from .runner import prepare_training
+
+
+def benchmark_covariates(
+    species_ids: list[str],
+    input_data_path: str,
+    verified_observations_file: str,
+    unverified_observations_file: str,
+    covariates_file: str,
+    reduced_covariates_file: str,
+    output_file: str,
+    use_2km_grid: bool = False,
+) -> pd.core.frame.DataFrame:
+    """
+    Train each species on the full and on the reduced covariates, and compare
+    how long training takes and how well the models do on the held out test
+    set. Both models are trained on the same pentads, so only the covariates
+    differ. The comparison is written to output_file and returned.
+    """
+    check_reduction(os.path.join(input_data_path, reduced_covariates_file))
+    reduced = load_covariate_matrix(
+        os.path.join(input_data_path, reduced_covariates_file)
+    )
+    dataset = SpeciesDataset(
+        input_data_path,
+        verified_observations_file,
+        unverified_observations_file,
+        covariates_file,
+        use_2km_grid,
+    )
+    rows = []
+
+    for species_id in species_ids:
+        print(f"Benchmarking: {species_id}", flush=True)
+
+        training = prepare_training(str(species_id), dataset)
+        if training is None:
+            continue
+
+        covariates, _, positive_df, negative_df = training
+        if not np.array_equal(reduced.pentads, covariates.pentads):
+            raise ValueError(
+                f"{reduced_covariates_file} is not a reduction of {covariates_file}, "
+                "run reduce-covariates again"
+            )
+
+        balanced_df = pd.concat([positive_df, negative_df])
+
+        for name, matrix in [
+            (covariates_file, covariates),
+            (reduced_covariates_file, reduced),
+        ]:
+            start = time.perf_counter()
+            _, results = train(balanced_df, matrix.values)
+
+            rows.append(
+                {
+                    "species_id": species_id,
+                    "covariates": name,
+                    "features": len(matrix.features),
+                    "train_seconds": time.perf_counter() - start,
+                    **results,
+                }
+            )
+
+    results_df = pd.DataFrame(rows)
+    results_df.to_csv(output_file, index=False)
+
+    if len(results_df):
+        print(
+            results_df.groupby("covariates", sort=False)[
+                ["features", "train_seconds", "roc_auc", "precision_recall_auc"]
+            ]
+            .mean()
+            .to_string(),
+            flush=True,
+        )
+
+    return results_df
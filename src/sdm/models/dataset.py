@@ -0,0 +1,122 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from ..data_prep.alignment import load_alignment
+from ..data_prep.covariate_matrix import load_covariate_matrix
+from ..data_prep.covariate_reduction import check_reduction
+from ..data_prep.grids import PENTAD_GRID, TWO_KM_GRID, get_grid
+from ..data_prep.sparse_observations import open_observations
+from .labels import label_matrix
+
+
+class SpeciesDataset:
+    """
+    The inputs that every species of a run is trained on: the verified and
+    unverified observations and the covariates, along with the lat/long of
+    each covariate row. They are read once and shared by every species.
+
+    The labels of the species (see label_matrix) can be computed for all of
+    them at once with compute_labels, each species then takes its column.
+    """
+
+    def __init__(
+        self,
+        input_data_path: str,
+        verified_observations_file: str,
+        unverified_observations_file: str,
+        covariates_file: str,
+        use_2km_grid: bool = False,
+    ):
+        self.verified = open_observations(
+            os.path.join(input_data_path, verified_observations_file)
+        )
+        self.unverified = open_observations(
+            os.path.join(input_data_path, unverified_observations_file)
+        )
+
+        # The covariates are memory-mapped, only the pentads they are indexed
+        # by are copied
+        check_reduction(os.path.join(input_data_path, covariates_file))
+        self.covariates = load_covariate_matrix(
+            os.path.join(input_data_path, covariates_file)
+        )
+        grid_name = TWO_KM_GRID if use_2km_grid else PENTAD_GRID
+        self.covariates_df = get_grid(grid_name).add_lat_long(
+            self.covariates.index.copy()
+        )
+
+        self._species_ids = set(self.verified.columns)
+
+        # The row of each covariate row in the observations, matched through
+        # the persisted alignment of the files to the grid
+        alignment = load_alignment(
+            input_data_path,
+            grid_name,
+            covariates_file,
+            [verified_observations_file, unverified_observations_file],
+            pentads={
+                covariates_file: self.covariates.pentads,
+                verified_observations_file: self.verified.pentads,
+                unverified_observations_file: self.unverified.pentads,
+            },
+        )
+        n_rows = len(self.covariates)
+        self.verified_rows = alignment.rows(
+            covariates_file, n_rows, verified_observations_file
+        )
+        self.unverified_rows = alignment.rows(
+            covariates_file, n_rows, unverified_observations_file
+        )
+
+        self.thresholds = pd.Series(dtype=np.float64)
+        self.labels = np.empty((n_rows, 0), dtype=np.int8)
+        self._label_columns = {}
+
+    @property
+    def species_ids(self) -> list[str]:
+        return self.verified.columns
+
+    def total_observations(self, species_id: str) -> int:
+        """The verified observations of a species, 0 if it has none"""
+        if str(species_id) not in self._species_ids:
+            return 0
+        return int(self.verified.column(species_id).sum())
+
+    def compute_labels(self, species_ids: list[str]):
+        """
+        Compute the absence thresholds and the label matrix of the given
+        species, in one pass. These replace any computed before.
+        """
+        species_ids = [str(s) for s in species_ids]
+        thresholds, self.labels = label_matrix(
+            self.verified,
+            self.unverified,
+            self.verified_rows,
+            self.unverified_rows,
+            species_ids,
+        )
+        self.thresholds = pd.Series(thresholds, index=species_ids)
+        self._label_columns = {s: i for i, s in enumerate(species_ids)}
+
+    def species_labels(
+        self, species_id: str, absence_observations: float | None = None
+    ) -> np.ndarray:
+        """
+        The label of each covariate row for a species. The column of the label
+        matrix if it was computed, otherwise the labels of the species alone.
+        """
+        species_id = str(species_id)
+        if species_id in self._label_columns and not absence_observations:
+            return self.labels[:, self._label_columns[species_id]]
+
+        _, labels = label_matrix(
+            self.verified,
+            self.unverified,
+            self.verified_rows,
+            self.unverified_rows,
+            [species_id],
+            absence_observations,
+        )
+        return labels[:, 0]
@@ -0,0 +1,125 @@
+import warnings
+
+import numpy as np
+
+from ..data_prep.sparse_observations import DenseObservations, SparseObservations
+
+PRESENCE = 1
+ABSENCE = 0
+UNKNOWN = -1
+
+# The absence threshold of a species is the reciprocal of this percentile of
+# its share of the observations, over the pentads it was observed in
+ABSENCE_PERCENTILE = 10
+
+# Values of a block of species columns held in memory at a time
+LABEL_BLOCK_VALUES = 1 << 24
+
+Observations = SparseObservations | DenseObservations
+
+
+def _columns(observations: Observations, species_ids: list[str]) -> np.ndarray:
+    """The counts of the given species, zeros for the ones not in the file"""
+    present = set(observations.columns)
+    n_rows = len(observations.pentads)
+    return np.column_stack(
+        [
+            observations.column(s) if s in present else np.zeros(n_rows, np.uint8)
+            for s in species_ids
+        ]
+        + [np.empty((n_rows, 0), dtype=np.uint8)]
+    )
+
+
+def _take(values: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """The given rows of values, with zeros where the row is -1"""
+    taken = values[np.maximum(rows, 0)]
+    taken[rows < 0] = 0
+    return taken
+
+
+def absence_thresholds(counts: np.ndarray, totals: np.ndarray) -> np.ndarray:
+    """
+    The absence threshold of each species (column of counts): the reciprocal
+    of the 10th percentile of the ratio of the species to the total number of
+    observations, over the pentads where the species was observed. NaN for a
+    species with no observations.
+    """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ratios = np.where(counts > 0, counts / totals[:, np.newaxis], np.nan)
+        if len(ratios) == 0:
+            return np.full(counts.shape[1], np.nan)
+
+        # Species that were never observed have all-NaN columns
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            tenth_percentile = np.nanpercentile(ratios, ABSENCE_PERCENTILE, axis=0)
+        return np.where(tenth_percentile != 0, 1 / tenth_percentile, np.nan)
+
+
+def label_matrix(
+    verified: Observations,
+    unverified: Observations,
+    verified_rows: np.ndarray,
+    unverified_rows: np.ndarray,
+    species_ids: list[str],
+    absence_observations: float | None = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Label every covariate row for each of the given species, in one pass
+    over the observations. verified_rows and unverified_rows are the row of
+    each covariate row in the observations, -1 if it is not in them.
+
+    The label of a species in a pentad is
+    1 if the species was observed there (verified)
+    0 if it was not observed there at all, and the pentad has more
+      observations than the absence threshold of the species
+    -1 otherwise, which includes the pentads without verified observations
+
+    The absence threshold of each species is calculated from its verified
+    observations (see absence_thresholds), unless absence_observations is
+    given for all of them.
+
+    Returns the thresholds, and a covariate row x species int8 matrix of
+    the labels. Species are processed a block of columns at a time.
+    """
+    n_rows = len(verified_rows)
+    thresholds = np.full(len(species_ids), np.nan)
+    labels = np.full((n_rows, len(species_ids)), UNKNOWN, dtype=np.int8)
+
+    # The counts are stored as unsigned 16/32 bit ints, so add them up as int64
+    totals = _take(verified.row_totals().astype(np.int64), verified_rows) + _take(
+        unverified.row_totals().astype(np.int64), unverified_rows
+    )
+    observed = verified_rows >= 0
+
+    block = max(1, LABEL_BLOCK_VALUES // max(len(verified.pentads), n_rows, 1))
+    for start in range(0, len(species_ids), block):
+        block_ids = species_ids[start : start + block]
+        verified_counts = _columns(verified, block_ids)
+
+        if absence_observations:
+            block_thresholds = np.full(len(block_ids), float(absence_observations))
+        else:
+            block_thresholds = absence_thresholds(
+                verified_counts, verified.row_totals()
+            )
+        thresholds[start : start + len(block_ids)] = block_thresholds
+
+        target = _take(verified_counts, verified_rows)
+        others = _take(_columns(unverified, block_ids), unverified_rows)
+
+        with np.errstate(invalid="ignore"):
+            absent = (
+                (target == 0)
+                & (others == 0)
+                & (totals[:, np.newaxis] > block_thresholds)
+            )
+
+        block_labels = np.where(
+            target > 0, PRESENCE, np.where(absent, ABSENCE, UNKNOWN)
+        ).astype(np.int8)
+        block_labels[~observed] = UNKNOWN
+        labels[:, start : start + len(block_ids)] = block_labels
+
+    return thresholds, labels
@@ -5,25 +5,26 @@ from sklearn.metrics import roc_auc_score, accuracy_score, average_precision_sco
 from sklearn.model_selection import train_test_split
 
 from sklearn.ensemble import RandomForestClassifier
-from ..plot import plot_map
+from ..plot import map_files, plot_map
 from ..utils import get_species_name
 from sklearn.metrics import f1_score, precision_recall_curve, auc
 
 random.seed(42)
 np.random.seed(42)
 
-drop_cols = [
-    "target",
-    "latitude",
-    "longitude",
-    "pentad",
-]
+# Rows of the covariate matrix predicted at a time
+PREDICT_BLOCK_ROWS = 65536
 
 
-def train(balanced_df):
+def train(balanced_df, covariates: np.ndarray):
+    """
+    Train on the covariate rows of the pentads in balanced_df. The index of
+    balanced_df is the row of each pentad in the covariates matrix, so only
+    the training rows are gathered from it.
+    """
     balanced_df = balanced_df.sample(frac=1, random_state=42)
 
-    X = balanced_df.drop(columns=drop_cols)
+    X = covariates[balanced_df.index.to_numpy()]
     y = balanced_df["target"].to_numpy()
 
     X_train, X_test, y_train, y_test = train_test_split(
@@ -67,14 +68,27 @@ def train(balanced_df):
     return clf, results
 
 
-def predict(clf, training_data_df, positive_df, negative_df, species_id, output_dir):
-    to_predict_df = training_data_df[training_data_df["target"] == -1].copy()
+def predict_probabilities(clf, covariates: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """
+    The class 1 probability for the given rows of the covariates matrix,
+    predicted a block of rows at a time.
+    """
+    probabilities = np.empty(len(rows), dtype=np.float64)
+    for start in range(0, len(rows), PREDICT_BLOCK_ROWS):
+        block = rows[start : start + PREDICT_BLOCK_ROWS]
+        probabilities[start : start + len(block)] = clf.predict_proba(covariates[block])[:, 1]
+
+    return probabilities
 
-    proba_predictions = clf.predict_proba(to_predict_df.drop(columns=drop_cols))
-    # Extract the probability of class 1
-    class_1_probabilities = proba_predictions[:, 1]
 
-    to_predict_df["target"] = class_1_probabilities
+def predict(
+    clf, covariates, training_data_df, positive_df, negative_df, species_id, output_dir
+):
+    to_predict_df = training_data_df[training_data_df["target"] == -1].copy()
+
+    to_predict_df["target"] = predict_probabilities(
+        clf, covariates, to_predict_df.index.to_numpy()
+    )
 
     known_df = pd.concat([positive_df, negative_df])
 
@@ -85,7 +99,7 @@ def predict(clf, training_data_df, positive_df, negative_df, species_id, output_
     plot_map(
         combined_df,
         "target",
-        filename=f"{output_dir}/maps/{species_id}_{get_species_name(species_id)}_species_distribution",
+        filename=_map_filename(species_id, output_dir),
         alongside=False,
     )
 
@@ -94,8 +108,19 @@ def predict(clf, training_data_df, positive_df, negative_df, species_id, output_
     plot_map(
         combined_df,
         "target",
-        filename=f"{output_dir}/maps/{species_id}_{get_species_name(species_id)}_species_distribution_abs",
+        filename=_map_filename(species_id, output_dir, "_abs"),
         alongside=False,
     )
 
     return pentad_probabilities
+
+
+def _map_filename(species_id, output_dir, suffix=""):
+    return f"{output_dir}/maps/{species_id}_{get_species_name(species_id)}_species_distribution{suffix}"
+
+
+def distribution_map_files(species_id, output_dir) -> list[str]:
+    """The map files that predict saves for a species"""
+    return map_files(_map_filename(species_id, output_dir), alongside=False) + map_files(
+        _map_filename(species_id, output_dir, "_abs"), alongside=False
+    )
@@ -0,0 +1,104 @@
+import csv
+import json
+import os
+from datetime import datetime, timezone
+
+from ..data_prep.covariate_cache import cache_key, input_fingerprints
+
+MANIFEST_FILE = "run_manifest.json"
+
+DONE = "done"
+SKIPPED = "skipped"
+FAILED = "failed"
+
+# Species with these statuses do not need to run again, as long as their
+# inputs are unchanged and their outputs are all there
+COMPLETE_STATUSES = [DONE, SKIPPED]
+
+
+def manifest_path(output_dir: str) -> str:
+    """The manifest of the distribution runs writing to an output directory"""
+    return os.path.join(output_dir, MANIFEST_FILE)
+
+
+def load_run_manifest(output_dir: str) -> dict:
+    path = manifest_path(output_dir)
+    if not os.path.exists(path):
+        return {"inputs": {}, "species": {}}
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_run_manifest(output_dir: str, manifest: dict):
+    """Write the manifest atomically, so a crash never leaves half a file"""
+    path = manifest_path(output_dir)
+    tmp_path = f"{path}.tmp"
+
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def start_run(manifest: dict, input_paths: list[str], params: dict) -> str:
+    """
+    Fingerprint the inputs of a run into the manifest, and return the key
+    that the species of the run are recorded with. Inputs are only hashed
+    again if they changed since the manifest was written.
+    """
+    manifest["inputs"] = input_fingerprints(input_paths, manifest.get("inputs"))
+    manifest["params"] = params
+    manifest["key"] = cache_key(manifest["inputs"], params)
+    return manifest["key"]
+
+
+def record_species(
+    manifest: dict, species_id: str, status: str, key: str, outputs: list[str]
+):
+    manifest["species"][str(species_id)] = {
+        "status": status,
+        "key": key,
+        "outputs": outputs,
+        "finished_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+    }
+
+
+def is_complete(manifest: dict, species_id: str, key: str) -> bool:
+    """
+    Whether a species finished (or was skipped) on the same inputs, and all
+    of its outputs are still there
+    """
+    record = manifest["species"].get(str(species_id))
+    return (
+        record is not None
+        and record["status"] in COMPLETE_STATUSES
+        and record["key"] == key
+        and all(os.path.exists(p) for p in record["outputs"])
+    )
+
+
+def keep_results(results_file: str, species_ids: set[str]):
+    """
+    Keep only the last row of each of the given species in the training
+    results, dropping the rows of species that will run again and any
+    duplicate rows left by earlier restarts. The rows are kept as written.
+    """
+    if not os.path.exists(results_file):
+        return
+
+    with open(results_file, newline="") as f:
+        rows = list(csv.reader(f))
+    if not rows:
+        return
+
+    header, last_rows = rows[0], {}
+    for row in rows[1:]:
+        if row and row[0] in species_ids:
+            last_rows[row[0]] = row
+
+    tmp_path = f"{results_file}.tmp"
+    with open(tmp_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(last_rows.values())
+    os.replace(tmp_path, results_file)
@@ -1,12 +1,28 @@
 import os
 import csv
+import multiprocessing
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pandas as pd
 import numpy as np
 from ..utils import get_species_name
 
-from ..data_prep.utils import add_lat_long_from_pentad
-from ..data_prep.two_km_grid import add_lat_long_from_two_km_pentad
-from .random_forest import train, predict
+from .dataset import SpeciesDataset
+from .random_forest import distribution_map_files, train, predict
+from .run_manifest import (
+    DONE,
+    FAILED,
+    SKIPPED,
+    is_complete,
+    keep_results,
+    load_run_manifest,
+    record_species,
+    save_run_manifest,
+    start_run,
+)
+
+# The dataset of train_and_predict_all, inherited by its forked workers
+_dataset: SpeciesDataset | None = None
 
 
 def train_and_predict_all(
@@ -17,32 +33,189 @@ def train_and_predict_all(
     covariates_file: str,
     output_dir: str,
     use_2km_grid: bool = False,
+    workers: int = 1,
+    resume: bool = False,
 ):
+    """
+    Train and predict the distribution of every species in the bird list.
+
+    With workers > 1 the species are trained in a pool of worker processes,
+    the species with the most observations first so that the long runs do
+    not end up last. The workers are forked after the dataset is read, so
+    they share its observations and memory-mapped covariates rather than
+    being sent copies. Each worker writes the outputs of its own species,
+    the training results are appended to training_results.csv by this
+    process as they come in.
+
+    Where processes can not be forked (e.g. on Windows) the species are
+    trained one at a time instead.
+
+    A species that fails is recorded as failed and the others carry on, the
+    run raises an error once they are all done.
+
+    The status and outputs of each species are recorded in a run manifest in
+    the output directory, along with the fingerprints of the inputs. With
+    resume, species that already finished on the same inputs and whose
+    outputs are all there are not run again, and the training results of
+    the species that do run again are dropped from training_results.csv.
+    Without resume, training_results.csv starts over.
+    """
     # Read the bird list into a DataFrame
     bird_df = pd.read_csv(bird_list)
 
-    start = False
+    results_file = f"{output_dir}/training_results.csv"
+
+    manifest = load_run_manifest(output_dir)
+    if not resume:
+        manifest["species"] = {}
+
+    key = start_run(
+        manifest,
+        [
+            os.path.join(input_data_path, f)
+            for f in [
+                verified_observations_file,
+                unverified_observations_file,
+                covariates_file,
+            ]
+        ],
+        {"use_2km_grid": use_2km_grid},
+    )
+
+    species = []
+    complete = set()
 
     # Iterate through the DataFrame rows
     for _, row in bird_df.iterrows():
-
-        print(f"Processing: {row['SA_name']}", flush=True)
-
         sabap2_id = str(row["SABAP2_number"])
 
         if row["inat_name"] == "":
             print("Skipping: No inat_name for:", sabap2_id, row["SA_name"], flush=True)
             continue
 
-        train_and_predict(
-            sabap2_id,
-            input_data_path,
-            verified_observations_file,
-            unverified_observations_file,
-            covariates_file,
-            output_dir,
-            use_2km_grid
+        if resume and is_complete(manifest, sabap2_id, key):
+            complete.add(sabap2_id)
+            continue
+
+        species.append((sabap2_id, row["SA_name"]))
+
+    if resume:
+        print(f"Resuming: {len(complete)} species are already done", flush=True)
+    # Without resume nothing is complete, so the results of earlier runs are
+    # dropped along with their manifest entries
+    keep_results(results_file, complete)
+
+    save_run_manifest(output_dir, manifest)
+
+    def finish(sabap2_id: str, results: dict | None):
+        if results is None:
+            record_species(manifest, sabap2_id, SKIPPED, key, [])
+        else:
+            append_results_to_csv(results, results_file)
+            record_species(
+                manifest,
+                sabap2_id,
+                DONE,
+                key,
+                [_probabilities_file(sabap2_id, output_dir)]
+                + distribution_map_files(sabap2_id, output_dir),
+            )
+        save_run_manifest(output_dir, manifest)
+
+    # Keep going when a species fails, so the results of the others are
+    # still logged
+    failed = []
+
+    def fail(sabap2_id: str, error: Exception):
+        print(f"Failed: {sabap2_id} - {error!r}", flush=True)
+        traceback.print_exception(error)
+        failed.append(sabap2_id)
+        record_species(manifest, sabap2_id, FAILED, key, [])
+        save_run_manifest(output_dir, manifest)
+
+    # Read the observations and the covariates once for all of the species
+    dataset = SpeciesDataset(
+        input_data_path,
+        verified_observations_file,
+        unverified_observations_file,
+        covariates_file,
+        use_2km_grid,
+    )
+
+    # Label the covariate rows for all of the species in one pass, before
+    # any workers are forked so that they share the labels
+    dataset.compute_labels([sabap2_id for sabap2_id, _ in species])
+
+    if workers > 1 and "fork" not in multiprocessing.get_all_start_methods():
+        # The workers inherit the dataset, which only a forked process can do
+        print(
+            "Worker processes can not be forked on this platform, "
+            "training the species one at a time",
+            flush=True,
         )
+        workers = 1
+
+    if workers <= 1:
+        for sabap2_id, name in species:
+            print(f"Processing: {name}", flush=True)
+            try:
+                results = _train_and_predict_species(sabap2_id, dataset, output_dir)
+            except Exception as e:
+                fail(sabap2_id, e)
+                continue
+            finish(sabap2_id, results)
+    else:
+        _train_and_predict_in_workers(species, dataset, output_dir, workers, finish, fail)
+
+    if failed:
+        raise RuntimeError(f"Training failed for species: {', '.join(failed)}")
+
+
+def _train_and_predict_in_workers(
+    species: list[tuple[str, str]],
+    dataset: SpeciesDataset,
+    output_dir: str,
+    workers: int,
+    finish,
+    fail,
+):
+    """
+    Train the species in a pool of forked worker processes, the ones with the
+    most observations first. finish or fail is called with the outcome of
+    each species as it comes in.
+    """
+    global _dataset
+
+    species = sorted(species, key=lambda s: dataset.total_observations(s[0]), reverse=True)
+
+    _dataset = dataset
+    try:
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("fork")
+        ) as executor:
+            futures = {
+                executor.submit(
+                    _train_and_predict_worker, sabap2_id, name, output_dir
+                ): sabap2_id
+                for sabap2_id, name in species
+            }
+
+            for future in as_completed(futures):
+                sabap2_id = futures[future]
+                try:
+                    results = future.result()
+                except Exception as e:
+                    fail(sabap2_id, e)
+                    continue
+
+                finish(sabap2_id, results)
+    finally:
+        _dataset = None
+
+
+def _train_and_predict_worker(target_species_id: str, name: str, output_dir: str):
+    print(f"Processing: {name}", flush=True)
+    return _train_and_predict_species(target_species_id, _dataset, output_dir)
 
 
 def train_and_predict(
@@ -55,43 +228,97 @@ def train_and_predict(
     use_2km_grid: bool = False,
     absence_observations: int | None = None,
 ):
-    # Read the Feather files
-    verified_observations_df = pd.read_feather(
-        os.path.join(input_data_path, verified_observations_file)
+    """Train and predict the distribution of a single species"""
+    dataset = SpeciesDataset(
+        input_data_path,
+        verified_observations_file,
+        unverified_observations_file,
+        covariates_file,
+        use_2km_grid,
     )
 
-    if str(target_species_id) not in verified_observations_df:
-        print("Skipping: No target_species_id for:", target_species_id, flush=True)
-        return
+    results = _train_and_predict_species(
+        target_species_id, dataset, output_dir, absence_observations
+    )
+    if results is not None:
+        append_results_to_csv(results, f"{output_dir}/training_results.csv")
 
-    print(f"SUM: {sum(verified_observations_df[str(target_species_id)])}")
 
-    if sum(verified_observations_df[str(target_species_id)]) < 30:
-        print(
-            f"Skipping - Not enough observations with target species_id: {target_species_id} - Total: {sum(verified_observations_df[str(target_species_id)])}"
-        )
-        return
+def _train_and_predict_species(
+    target_species_id: str,
+    dataset: SpeciesDataset,
+    output_dir: str,
+    absence_observations: int | None = None,
+) -> dict | None:
+    """
+    Train the model of a species, and write its maps and pentad
+    probabilities. Returns the training results to log, or None if the
+    species was skipped.
+    """
+    training = prepare_training(target_species_id, dataset, absence_observations)
+    if training is None:
+        return None
 
-    unverified_observations_df = pd.read_feather(
-        os.path.join(input_data_path, unverified_observations_file)
+    covariates, training_data_df, positive_df, negative_df = training
+    balanced_df = pd.concat([positive_df, negative_df])
+
+    model, results = train(balanced_df, covariates.values)
+    results_to_log = {
+        "species_id": target_species_id,
+        "species_name": get_species_name(target_species_id),
+    }
+    results_to_log.update(results)
+
+    pentad_probabilities = predict(
+        model,
+        covariates.values,
+        training_data_df,
+        positive_df,
+        negative_df,
+        target_species_id,
+        output_dir,
     )
-    covariates_df = pd.read_feather(os.path.join(input_data_path, covariates_file))
-    if use_2km_grid:
-        covariates_df = add_lat_long_from_two_km_pentad(covariates_df)
-    else:
-        covariates_df = add_lat_long_from_pentad(covariates_df)
 
-    if not absence_observations:
-        absence_observations = calculate_target_species_ratio(
-            target_species_id, verified_observations_df
+    pentad_probabilities_sorted = pentad_probabilities.sort_index()
+
+    pentad_probabilities_sorted.to_csv(
+        _probabilities_file(target_species_id, output_dir), index=False
+    )
+
+    return results_to_log
+
+
+def _probabilities_file(species_id: str, output_dir: str) -> str:
+    return f"{output_dir}/pentad_probabilities/{species_id}.csv"
+
+
+def prepare_training(
+    target_species_id: str,
+    dataset: SpeciesDataset,
+    absence_observations: int | None = None,
+):
+    """
+    Label every row of the covariates of the dataset for the given species.
+    Returns the covariates, the training dataset and its presence and
+    pseudo-absence rows, or None if the species has too few observations to
+    be modelled.
+    """
+    if str(target_species_id) not in dataset.species_ids:
+        print("Skipping: No target_species_id for:", target_species_id, flush=True)
+        return None
+
+    target_observations = dataset.total_observations(target_species_id)
+    print(f"SUM: {target_observations}")
+
+    if target_observations < 30:
+        print(
+            f"Skipping - Not enough observations with target species_id: {target_species_id} - Total: {target_observations}"
         )
+        return None
 
     training_data_df = generate_training(
-        target_species_id,
-        verified_observations_df,
-        unverified_observations_df,
-        covariates_df,
-        absence_observations,
+        dataset.covariates_df,
+        dataset.species_labels(target_species_id, absence_observations),
     )
 
     positive_df = training_data_df.query("target == 1")
@@ -101,31 +328,12 @@ def train_and_predict(
         print(
             f"Skipping - Not enough pentads with target species_id: {target_species_id} - Total: {positive_df.shape[0]}"
         )
-        return
+        return None
 
     negative_df = training_data_df.query("target == 0")
     print("Total pseudo-absence: ", negative_df.shape[0])
 
-    balanced_df = pd.concat([positive_df, negative_df])
-
-    model, results = train(balanced_df)
-    results_to_log = {
-        "species_id": target_species_id,
-        "species_name": get_species_name(target_species_id),
-    }
-    results_to_log.update(results)
-
-    append_results_to_csv(results_to_log, f"{output_dir}/training_results.csv")
-
-    pentad_probabilities = predict(
-        model, training_data_df, positive_df, negative_df, target_species_id, output_dir
-    )
-
-    pentad_probabilities_sorted = pentad_probabilities.sort_index()
-
-    pentad_probabilities_sorted.to_csv(
-        f"{output_dir}/pentad_probabilities/{target_species_id}.csv", index=False
-    )
+    return dataset.covariates, training_data_df, positive_df, negative_df
 
 
 def append_results_to_csv(dict_data, file_path):
@@ -151,72 +359,19 @@ def append_results_to_csv(dict_data, file_path):
         writer.writerow(dict_data)
 
 
-def calculate_target_species_ratio(
-    target_species_id: str, observations_df: pd.DataFrame
-):
-    """
-    Calculate the ratio of the target species to the total number of observations
-    per pentad, for pentads where the target species count is greater than 0.
-    Then select the 10th percentile value of this and return the reciprocal.
-    """
-    # Filter rows where target species count is greater than 0
-    filtered_df = observations_df[observations_df[target_species_id] > 0]
-
-    # Calculate the ratio
-    ratio = filtered_df[target_species_id] / filtered_df["total_pentad_observations"]
-
-    # Calculate the 10th percentile of the ratio
-    tenth_percentile = np.percentile(ratio, 10)
-
-    # Return the reciprocal of the 10th percentile
-    return 1 / tenth_percentile if tenth_percentile != 0 else None
-
-
-def generate_training(
-    target_species_id: str,
-    verified_observations_df,
-    unverified_observations_df,
-    covariates_df,
-    absence_observations: int = 10,
-) -> pd.core.frame.DataFrame:
+def generate_training(covariates_df, labels: np.ndarray) -> pd.core.frame.DataFrame:
     """
-    Generate a training dataset for the given species. The returned dataset
-    will have the following columns:
+    Generate a training dataset for a species from its labels (see
+    label_matrix), with a row for each row of the covariate matrix
+    (covariates_df is its index). The returned dataset will have the
+    following columns:
     - pentad
-    - covariates: All of the scaled covariate columns
     - latitude, longitude
-    - target_observations: Total number of target species observations
-    - total_observations: Total number of observation records of all species
     - target
 
-    target =
-    1 if target_species_count > 0
-    0 if target_species_count == 0 and total_observations > threshold
-    -1 otherwise
+    The covariates themselves stay in the matrix, and are gathered by the
+    row index of the dataset when training and predicting.
     """
-
-    verified_observations_df["target"] = np.where(
-        verified_observations_df[target_species_id] > 0,
-        1,
-        np.where(
-            np.bitwise_and(
-                verified_observations_df[target_species_id] == 0,
-                np.bitwise_and(
-                    verified_observations_df["total_pentad_observations"]
-                    + unverified_observations_df["total_pentad_observations"]
-                    > absence_observations,
-                    unverified_observations_df[target_species_id] == 0,
-                ),
-            ),
-            0,
-            -1,
-        ),
-    )
-
-    # Left join with the covariates DataFrame
-    merged_df = covariates_df.merge(verified_observations_df, on="pentad", how="left")
-
-    # Select only the necessary columns for return
-    required_columns = covariates_df.columns.to_list() + ["target"]
-
-    return merged_df[required_columns]
+    training_data_df = covariates_df.copy()
+    training_data_df["target"] = labels
+    return training_data_df
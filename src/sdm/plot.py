@@ -3,6 +3,19 @@ import matplotlib.pyplot as plt
 from shapely.geometry import Point
 
 
+# The suffixes of the files of the full view and the scaled view of a map
+MAP_SUFFIXES = ["_africa", "_cropped"]
+
+
+def map_files(filename: str, alongside: bool = True) -> list[str]:
+    """The files that plot_map saves for a filename"""
+    return [
+        f"{filename}{suffix}.png"
+        for i, suffix in enumerate(MAP_SUFFIXES)
+        if not (alongside and i == 0)
+    ]
+
+
 def plot_map(df, column, colors=None, filename=None, alongside=True):
     map = gpd.GeoSeries([Point(v) for v in df[["longitude", "latitude"]].values])
 
@@ -59,7 +72,7 @@ def plot_map(df, column, colors=None, filename=None, alongside=True):
                 plt.close(fig)  # Close the figure to free up memory
                 continue
             else:
-                suffix = "_africa" if i == 0 else "_cropped"
+                suffix = MAP_SUFFIXES[i]
                 fig.savefig(f"{filename}{suffix}.png", dpi=1000)
                 plt.close(fig)  # Close the figure to free up memory
 
@@ -1,7 +1,8 @@
 import os
 import pandas as pd
 
-from .data_prep.utils import add_lat_long_from_pentad
+from .data_prep.sparse_observations import SparseObservations, is_sparse
+from .data_prep.utils import PENTAD_KEY_COLUMN, add_lat_long_from_pentad
 from .plot import plot_map
 
 
@@ -10,7 +11,13 @@ def get_total(df, species_id=None):
         return df[species_id].sum()
     else:
         columns_to_sum = df.columns.difference(
-            ["pentad", "latitude", "longitude", "total_pentad_observations"]
+            [
+                "pentad",
+                PENTAD_KEY_COLUMN,
+                "latitude",
+                "longitude",
+                "total_pentad_observations",
+            ]
         )
         return df[columns_to_sum].sum().sum()
 
@@ -19,7 +26,9 @@ def plot_it(df, species_id=None):
     if species_id is not None and species_id in df.columns:
         df["total"] = df[species_id].apply(lambda x: 0 if x == 0 else 1)
     else:
-        columns_to_sum = df.columns.difference(["pentad", "latitude", "longitude"])
+        columns_to_sum = df.columns.difference(
+            ["pentad", PENTAD_KEY_COLUMN, "latitude", "longitude"]
+        )
         df["total"] = df[columns_to_sum].sum(axis=1)
         df["total"] = df["total"].apply(lambda x: 0 if x == 0 else 1)
 
@@ -49,8 +58,19 @@ def get_stats(
     df = pd.read_feather(sabap2_path)
     print(f"Total SABAP2 observations: {get_total(df, species_id)}", flush=True)
 
-    df = pd.read_feather(combined_path)
-    print(f"Total observations: {get_total(df, species_id)}", flush=True)
+    if is_sparse(combined_path):
+        # Only the species column (or the row totals) is densified
+        observations = SparseObservations(combined_path)
+        print(f"Total observations: {observations.total(species_id)}", flush=True)
+
+        if species_id is not None and species_id in observations.columns:
+            df = observations.to_frame([species_id])
+        else:
+            df = observations.to_frame([])
+            df["observations"] = observations.row_totals()
+    else:
+        df = pd.read_feather(combined_path)
+        print(f"Total observations: {get_total(df, species_id)}", flush=True)
 
     if plot:
         df = add_lat_long_from_pentad(df)
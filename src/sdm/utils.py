@@ -1,7 +1,15 @@
+from functools import cache
+
 import pandas as pd
 from ..config import config
 
 
-def get_species_name(species_id: str):
+@cache
+def _species_names() -> pd.Series:
+    """The name of each species in the bird list, read once per process"""
     df = pd.read_csv(config["BIRD_LIST"])
-    return df[df['SABAP2_number'] == int(species_id)]['SA_name'].values[0]
\ No newline at end of file
+    return df.groupby("SABAP2_number")["SA_name"].first()
+
+
+def get_species_name(species_id: str):
+    return _species_names().loc[int(species_id)]
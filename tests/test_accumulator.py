@@ -0,0 +1,90 @@
+import glob
+import os
+import tracemalloc
+
+import numpy as np
+
+from src.sdm.data_prep.accumulator import MERGE_FAN_IN, CountAccumulator
+
+N_ROWS = 4_000
+N_COLUMNS = 250
+
+# 2GB of (row, column, count) int64 triples, streamed in batches
+INPUT_BYTES = 2 * 1024**3
+BATCH_SIZE = 200_000
+N_BATCHES = INPUT_BYTES // (BATCH_SIZE * 3 * np.dtype(np.int64).itemsize)
+
+MAX_SPARSE_ENTRIES = 100_000
+
+# The accumulator may not hold more than this at once, a small fraction of
+# the input and of the buffers that one read per spilled run would take
+MAX_TRACED_BYTES = 128 * 1024**2
+
+
+def _triples(seed: int = 0):
+    """Yield batches of random (rows, columns, counts), skewed to the low rows"""
+    rng = np.random.default_rng(seed)
+    for _ in range(N_BATCHES):
+        rows = (N_ROWS * rng.random(BATCH_SIZE) ** 2).astype(np.int64)
+        columns = rng.integers(0, N_COLUMNS, BATCH_SIZE)
+        counts = rng.integers(1, 5, BATCH_SIZE)
+        yield rows, columns, counts
+
+
+def _spilled_files(spill_dir) -> list[str]:
+    return glob.glob(os.path.join(spill_dir, "counts_*", "*"))
+
+
+def _dense_reference() -> np.ndarray:
+    totals = np.zeros(N_ROWS * N_COLUMNS, dtype=np.int64)
+    for rows, columns, counts in _triples():
+        totals += np.bincount(
+            rows * N_COLUMNS + columns, weights=counts, minlength=len(totals)
+        ).astype(np.int64)
+    return totals.reshape(N_ROWS, N_COLUMNS)
+
+
+def test_small_matrix_is_dense():
+    with CountAccumulator(3, 2) as counts:
+        counts.add([0, 2, 2], [1, 0, 0], [5, 1, 2])
+        assert counts.is_dense
+        np.testing.assert_array_equal(counts.to_dense(), [[0, 5], [0, 0], [3, 0]])
+
+
+def test_spilled_counts_match_dense_reference(tmp_path):
+    reference = _dense_reference()
+
+    tracemalloc.start()
+    try:
+        with CountAccumulator(
+            N_ROWS,
+            N_COLUMNS,
+            max_dense_cells=0,
+            max_sparse_entries=MAX_SPARSE_ENTRIES,
+            spill_dir=str(tmp_path),
+        ) as counts:
+            max_files = 0
+            for rows, columns, batch_counts in _triples():
+                counts.add(rows, columns, batch_counts)
+                max_files = max(max_files, len(_spilled_files(tmp_path)))
+
+            for first_row, block in counts.iter_blocks(block_rows=100):
+                np.testing.assert_array_equal(
+                    block, reference[first_row : first_row + len(block)]
+                )
+                del block
+
+            total = sum(block.sum() for _, block in counts.iter_blocks())
+
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert total == reference.sum()
+    # Every batch was spilled, and the runs (a keys and a counts file each)
+    # were merged as they piled up
+    assert counts.run_count > N_BATCHES
+    assert 0 < max_files < 2 * 3 * MERGE_FAN_IN
+    assert peak < MAX_TRACED_BYTES
+    # Closing removes the spilled runs
+    assert _spilled_files(tmp_path) == []
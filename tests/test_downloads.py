@@ -0,0 +1,255 @@
+import csv
+import hashlib
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from src.config import config
+from src.sdm.data_prep import downloads
+from src.sdm.data_prep.abap import (
+    DOWNLOAD_MANIFEST,
+    changed_species,
+    clear_changed_species,
+    download_all,
+)
+from src.sdm.data_prep.downloads import DownloadManifest, fetch, make_session
+
+SPECIES_IDS = ["1", "2", "3", "4", "5"]
+
+
+def _species_csv(sabap2_id: str, cards: int = 3) -> bytes:
+    """A species file shaped like the SABAP2 export"""
+    rows = ["Pentad,Taxonomic_name,Card"] + [
+        f"3355_18{20 + 5 * i},Species {sabap2_id},{i}" for i in range(cards)
+    ]
+    return ("\n".join(rows) + "\n").encode("utf-8")
+
+
+class SpeciesServer:
+    """
+    Serves a SABAP2 species file per id on the path of SABAP2_SPECIES_URL,
+    with an ETag of its content. The statuses queued for an id are returned
+    before its file, and every request is logged.
+    """
+
+    def __init__(self):
+        self.files = {sabap2_id: _species_csv(sabap2_id) for sabap2_id in SPECIES_IDS}
+        self.statuses = {}
+        self.retry_after = None
+        self.requests = []
+        self._lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                sabap2_id = self.path.split("/info/")[1].split("/")[0]
+                with server._lock:
+                    server.requests.append((sabap2_id, dict(self.headers)))
+                    queued = server.statuses.get(sabap2_id, [])
+                    status = queued.pop(0) if queued else None
+
+                if status is not None:
+                    self.send_response(status)
+                    if server.retry_after is not None:
+                        self.send_header("Retry-After", server.retry_after)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                body = server.files[sabap2_id]
+                etag = f'"{hashlib.md5(body).hexdigest()}"'
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+
+                self.send_response(200)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        host, port = self.httpd.server_address
+        self.url = config["SABAP2_SPECIES_URL"].replace(
+            "https://api.birdmap.africa", f"http://{host}:{port}"
+        )
+
+    def requested(self) -> list[str]:
+        return [sabap2_id for sabap2_id, _ in self.requests]
+
+
+@pytest.fixture
+def server():
+    species_server = SpeciesServer()
+    thread = threading.Thread(target=species_server.httpd.serve_forever, daemon=True)
+    thread.start()
+    yield species_server
+    species_server.httpd.shutdown()
+    species_server.httpd.server_close()
+
+
+@pytest.fixture
+def delays(monkeypatch):
+    """The sleeps between retries, which are recorded rather than waited"""
+    slept = []
+    monkeypatch.setattr(downloads.time, "sleep", slept.append)
+    return slept
+
+
+@pytest.fixture
+def bird_list(tmp_path):
+    path = tmp_path / "BirdList.csv"
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["SABAP2_number", "Common_name"])
+        writer.writerows([[sabap2_id, f"Bird {sabap2_id}"] for sabap2_id in SPECIES_IDS])
+    return str(path)
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    path = tmp_path / "abap2"
+    path.mkdir()
+    return str(path)
+
+
+def _download(bird_list: str, data_dir: str, server: SpeciesServer, **kwargs):
+    return download_all(
+        bird_list, data_dir, server.url, workers=2, requests_per_second=None, **kwargs
+    )
+
+
+def test_fetch_retries_server_errors_with_backoff(server, delays):
+    server.statuses["1"] = [503, 500, 502]
+
+    with make_session(1) as session:
+        response = fetch(session, server.url.format("1"), backoff=0.5)
+
+    assert response.content == server.files["1"]
+    assert server.requested() == ["1"] * 4
+    # Exponential backoff, with up to half the delay added as jitter
+    assert len(delays) == 3
+    for attempt, delay in enumerate(delays):
+        assert 0.5 * 2**attempt <= delay <= 0.75 * 2**attempt
+
+
+def test_fetch_uses_retry_after(server, delays):
+    server.statuses["1"] = [429]
+    server.retry_after = "7"
+
+    with make_session(1) as session:
+        fetch(session, server.url.format("1"))
+
+    assert delays == [7.0]
+
+
+def test_fetch_raises_once_retries_are_used_up(server, delays):
+    server.statuses["1"] = [503] * 3
+
+    with make_session(1) as session, pytest.raises(requests.HTTPError):
+        fetch(session, server.url.format("1"), retries=2)
+
+    assert server.requested() == ["1"] * 3
+
+
+def test_fetch_does_not_retry_client_errors(server, delays):
+    server.statuses["1"] = [404]
+
+    with make_session(1) as session, pytest.raises(requests.HTTPError):
+        fetch(session, server.url.format("1"))
+
+    assert server.requested() == ["1"]
+    assert delays == []
+
+
+def test_download_resumes_after_an_interrupted_run(server, delays, bird_list, data_dir):
+    # Species 4 keeps failing until the retries of the first run are used up
+    server.statuses["4"] = [500] * (downloads.DEFAULT_RETRIES + 1)
+
+    with pytest.raises(RuntimeError, match="1 species could not be downloaded"):
+        _download(bird_list, data_dir, server)
+
+    manifest = DownloadManifest(os.path.join(data_dir, DOWNLOAD_MANIFEST))
+    assert {i: manifest.get(i)["status"] for i in SPECIES_IDS} == {
+        "1": "done",
+        "2": "done",
+        "3": "done",
+        "4": "failed",
+        "5": "done",
+    }
+    assert not os.path.exists(os.path.join(data_dir, "4.csv"))
+    # No partial downloads are left behind
+    assert not [f for f in os.listdir(data_dir) if f.endswith(".part")]
+
+    server.requests.clear()
+    changed = _download(bird_list, data_dir, server)
+
+    # Only the species that failed is requested again
+    assert server.requested() == ["4"]
+    assert changed == ["4"]
+    # Nothing was combined in between, so the changes of both runs are kept
+    assert changed_species(data_dir) == SPECIES_IDS
+    for sabap2_id in SPECIES_IDS:
+        with open(os.path.join(data_dir, f"{sabap2_id}.csv"), "rb") as f:
+            assert f.read() == server.files[sabap2_id]
+
+
+def test_refresh_only_rewrites_changed_species(server, delays, bird_list, data_dir):
+    assert _download(bird_list, data_dir, server) == SPECIES_IDS
+    clear_changed_species(data_dir)
+    unchanged_mtime = os.stat(os.path.join(data_dir, "1.csv")).st_mtime_ns
+
+    server.files["2"] = _species_csv("2", cards=5)
+    server.files["3"] = b""
+    server.requests.clear()
+
+    changed = _download(bird_list, data_dir, server, refresh=True)
+
+    # Every species is requested with the ETag it was downloaded with
+    assert sorted(server.requested()) == SPECIES_IDS
+    assert all("If-None-Match" in headers for _, headers in server.requests)
+
+    assert changed == ["2", "3"]
+    assert changed_species(data_dir) == ["2", "3"]
+    assert os.stat(os.path.join(data_dir, "1.csv")).st_mtime_ns == unchanged_mtime
+    with open(os.path.join(data_dir, "2.csv"), "rb") as f:
+        assert f.read() == server.files["2"]
+    # The file of a species that is now empty is removed, not left stale
+    assert not os.path.exists(os.path.join(data_dir, "3.csv"))
+
+    with open(os.path.join(data_dir, DOWNLOAD_MANIFEST)) as f:
+        manifest = json.load(f)
+    assert manifest["1"]["status"] == "done"
+    assert manifest["3"]["status"] == "empty"
+
+    # Nothing changed since, so a second refresh is all 304s
+    assert _download(bird_list, data_dir, server, refresh=True) == []
+
+
+def test_changes_of_a_failed_refresh_are_kept(server, delays, bird_list, data_dir):
+    _download(bird_list, data_dir, server)
+    clear_changed_species(data_dir)
+
+    # Species 2 changes, but the refresh raises on species 4 before anything
+    # is combined
+    server.files["2"] = _species_csv("2", cards=5)
+    server.statuses["4"] = [500] * (downloads.DEFAULT_RETRIES + 1)
+    with pytest.raises(RuntimeError):
+        _download(bird_list, data_dir, server, refresh=True)
+
+    # Species 2 is unchanged since the last download and 4 now comes in
+    assert _download(bird_list, data_dir, server, refresh=True) == ["4"]
+    assert changed_species(data_dir) == ["2", "4"]
+
+    clear_changed_species(data_dir)
+    assert changed_species(data_dir) == []
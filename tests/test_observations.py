@@ -0,0 +1,130 @@
+import csv
+import os
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.config import config
+from src.sdm.data_prep import observations
+from src.sdm.data_prep.grids import PENTAD_GRID, get_grid
+from src.sdm.data_prep.observations import aggregate_by_pentad_and_sabap_ids
+from src.sdm.data_prep.species_columns import UNMATCHED_COLUMN
+
+# Pentads from 26S to 34S and 20E to 30E
+LATITUDES = range(26, 34)
+LONGITUDES = range(20, 30)
+
+# The first N_LISTED species are in the bird list, the others are counted as
+# unmatched
+N_SPECIES = 50
+N_LISTED = 40
+
+# About 120MB of occurrences, with some outside of the grid
+N_ROWS = 3_000_000
+BATCH_SIZE = 200_000
+OUTSIDE_SHARE = 0.01
+
+# Rows read at a time, small enough that a chunk is well within the bound
+CHUNK_SIZE = 50_000
+
+# Far less than the input file (let alone the occurrences read into a frame),
+# which holds as long as only a chunk and the count matrix are in memory
+MAX_TRACED_BYTES = 32 * 1024**2
+
+
+@pytest.fixture
+def pentad_grid(tmp_path, monkeypatch):
+    pentads = [
+        f"{lat:02d}{lat_min:02d}_{lng:02d}{lng_min:02d}"
+        for lat in LATITUDES
+        for lat_min in range(0, 60, 5)
+        for lng in LONGITUDES
+        for lng_min in range(0, 60, 5)
+    ]
+    pentad_list = tmp_path / "pentads.csv"
+    pd.DataFrame({"pentad": pentads}).to_csv(pentad_list, index=False)
+
+    monkeypatch.setitem(config, "PENTAD_LIST", str(pentad_list))
+    monkeypatch.setitem(config, "GRID_CACHE_DIR", str(tmp_path / "grid_cache"))
+    get_grid.cache_clear()
+    yield get_grid(PENTAD_GRID)
+    get_grid.cache_clear()
+
+
+@pytest.fixture
+def bird_list(tmp_path):
+    path = tmp_path / "BirdList.csv"
+    pd.DataFrame(
+        {
+            "SABAP2_number": range(1, N_LISTED + 1),
+            "ebirds_name": [f"Species {i}" for i in range(N_LISTED)],
+        }
+    ).to_csv(path, index=False)
+    return str(path)
+
+
+def _write_occurrences(path: str, grid) -> np.ndarray:
+    """
+    Write random occurrences at the centre of the grid cells, and return
+    their counts per cell (in grid order) and species.
+    """
+    rng = np.random.default_rng(0)
+    counts = np.zeros((len(grid), N_SPECIES), dtype=np.int64)
+
+    with open(path, "w", newline="") as f:
+        f.write("species\tdecimalLatitude\tdecimalLongitude\n")
+        for _ in range(N_ROWS // BATCH_SIZE):
+            cells = rng.integers(0, len(grid), BATCH_SIZE)
+            species = rng.integers(0, N_SPECIES, BATCH_SIZE)
+            latitudes = grid.centroid_latitudes[cells]
+            outside = rng.random(BATCH_SIZE) < OUTSIDE_SHARE
+            latitudes[outside] = 10.0
+
+            np.add.at(counts, (cells[~outside], species[~outside]), 1)
+            pd.DataFrame(
+                {
+                    "species": np.char.add("Species ", species.astype(str)),
+                    "decimalLatitude": latitudes,
+                    "decimalLongitude": grid.centroid_longitudes[cells],
+                }
+            ).to_csv(
+                f, sep="\t", header=False, index=False, quoting=csv.QUOTE_NONE
+            )
+
+    return counts
+
+
+def test_aggregate_memory_does_not_grow_with_the_input(
+    tmp_path, monkeypatch, pentad_grid, bird_list
+):
+    input_file = "occurrences.csv"
+    reference = _write_occurrences(str(tmp_path / input_file), pentad_grid)
+    monkeypatch.setattr(observations, "CHUNK_SIZE", CHUNK_SIZE)
+
+    tracemalloc.start()
+    try:
+        aggregate_by_pentad_and_sabap_ids(
+            str(tmp_path),
+            input_file,
+            "ebirds.feather",
+            bird_list,
+            PENTAD_GRID,
+            str(tmp_path),
+            "ebirds_name",
+        )
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert os.path.getsize(tmp_path / input_file) > 3 * MAX_TRACED_BYTES
+    assert peak < MAX_TRACED_BYTES
+
+    aggregate = pd.read_feather(tmp_path / "ebirds.feather").set_index("pentad")
+    aggregate = aggregate.loc[pentad_grid.cells]
+    for i in range(N_LISTED):
+        np.testing.assert_array_equal(aggregate[str(i + 1)], reference[:, i])
+    np.testing.assert_array_equal(
+        aggregate[UNMATCHED_COLUMN], reference[:, N_LISTED:].sum(axis=1)
+    )